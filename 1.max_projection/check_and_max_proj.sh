@@ -28,9 +28,8 @@ cd "$git_root/1.max_projection/scripts" || exit
 # run Python script for checking for incomplete sets and cleaning
 for patient in "${patient_array[@]}"; do
     echo "Processing patient: $patient"
-    python 0.cp_max_projection.py --patient "$patient"
-    python 1.get_the_middle_slice.py --patient "$patient"
-    python 2.get_the_middle_N_slice_max_proj.py --patient "$patient"
+    # all projection methods are computed in a single pass over the z-stacks
+    python 0.z_projection.py --patient "$patient"
 done
 
 conda deactivate
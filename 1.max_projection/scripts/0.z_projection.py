@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Perform z-projections and save the images
+# Each z-stack is read once and all projection methods are computed from the same stack:
+# - `0a.zmax_proj`: maximum projection across all z-slices
+# - `0b.middle_slice`: the middle most z-slice
+# - `0c.middle_n_slice_max_proj`: maximum projection of the middle n z-slices
+#
+# The same pass also computes per z-slice statistics (intensity percentiles and a variance of Laplacian focus score) of every z-stack.
+# These are saved to one plane statistics index per patient so that later stages can choose z-slices and flag empty z-stacks without reading the z-stacks again.
+
+# ## Import libraries
+
+# In[ ]:
+
+
+import functools
+import os
+import pathlib
+
+from image_analysis_2D.file_utils.arg_parsing_utils import (
+    check_for_missing_args,
+    parse_args,
+)
+from image_analysis_2D.file_utils.artifact_catalog import (
+    get_artifact_catalog_path,
+    record_patient_artifacts,
+)
+from image_analysis_2D.file_utils.notebook_init_utils import (
+    bandicoot_check,
+    init_notebook,
+)
+from image_analysis_2D.projection_utils.projection_parallel import (
+    run_zstack_projections_parallel,
+)
+from image_analysis_2D.projection_utils.zstack_projection import (
+    PROJECTION_METHODS,
+    middle_n_slice_indices,
+)
+
+root_dir, in_notebook = init_notebook()
+image_base_dir = bandicoot_check(
+    pathlib.Path(os.path.expanduser("~/mnt/bandicoot")).resolve(), root_dir
+)
+
+
+# In[ ]:
+
+
+if not in_notebook:
+    args_dict = parse_args()
+    patient = args_dict["patient"]
+    check_for_missing_args(
+        patient=patient,
+    )
+else:
+    patient = "NF0018_T6"
+
+
+# In[ ]:
+
+
+# input images directory
+images_dir = pathlib.Path(f"{image_base_dir}/data/{patient}/zstack_images/").resolve(
+    strict=True
+)
+# output images directory holding each of the projection directories
+output_base_dir = pathlib.Path(
+    f"{image_base_dir}/data/{patient}/2D_analysis/"
+).resolve()
+output_base_dir.mkdir(parents=True, exist_ok=True)
+
+
+# In[ ]:
+
+
+# set n (number of z-slices total including the middle slice)
+n = 3
+# add a projection method here to compute it in the same pass over the z-stacks
+projection_methods = {
+    **PROJECTION_METHODS,
+    "middle_n": {
+        **PROJECTION_METHODS["middle_n"],
+        "z_indices": functools.partial(middle_n_slice_indices, n=n),
+    },
+}
+# either stream each z-stack page by page into running projections, which bounds
+# memory to about two z-slices per z-stack instead of the whole stack,
+# or prefetch the next z-stacks on a reader thread and write the projections on a
+# writer thread so the disk and the CPU are busy at the same time
+streaming = False
+prefetch = 2
+# per z-slice statistics index of the patient
+plane_statistics_path = pathlib.Path(
+    f"{output_base_dir}/run_stats/{patient}_zstack_plane_statistics.parquet"
+)
+# manifest of the projections of the patient, outputs are recomputed when their
+# z-stack, the output itself or the projection parameters (e.g. n) changed
+manifest_path = pathlib.Path(
+    f"{output_base_dir}/run_stats/{patient}_z_projection_manifest.parquet"
+)
+
+
+# In[ ]:
+
+
+# each z-stack is projected in its own worker process
+# workers are sized from the available CPUs and memory
+run_summary = run_zstack_projections_parallel(
+    images_dir=images_dir,
+    output_base_dir=output_base_dir,
+    projection_methods=projection_methods,
+    streaming=streaming,
+    plane_statistics_path=plane_statistics_path,
+    prefetch=prefetch,
+    manifest_path=manifest_path,
+)
+
+
+# In[ ]:
+
+
+# save the per z-stack summary so failures are kept for reruns
+run_summary_path = pathlib.Path(
+    f"{output_base_dir}/run_stats/{patient}_z_projection_summary.parquet"
+)
+run_summary_path.parent.mkdir(parents=True, exist_ok=True)
+run_summary.to_parquet(run_summary_path, index=False)
+# record the outputs in the artifact catalog the completeness checks query
+record_patient_artifacts(
+    catalog_path=get_artifact_catalog_path(f"{image_base_dir}/data"),
+    data_dir=f"{image_base_dir}/data",
+    stage="projection",
+    patient=patient,
+)
@@ -9,8 +9,8 @@
 module load anaconda
 # initialize the correct shell for your machine to allow conda to work (see README for note on shell names)
 conda init bash
-# activate the CellProfiler environment
-conda activate gff_cp_env
+# activate the preprocessing environment
+conda activate gff_preprocessing_env
 
 # convert Jupyter notebooks to scripts
 
@@ -18,7 +18,7 @@ conda activate gff_cp_env
 cd scripts/ || exit 1
 
 patient="$1"
-python cp_illum_correction.py --patient "$patient"
+python basic_illum_correction.py --patient "$patient"
 
 conda deactivate
 
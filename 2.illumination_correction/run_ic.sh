@@ -1,8 +1,8 @@
 #!/bin/bash
 
-# activate the CellProfiler environment
+# activate the preprocessing environment
 conda init
-conda activate gff_cp_env
+conda activate gff_preprocessing_env
 
 # convert Jupyter notebooks to scripts
 jupyter nbconvert --to script --output-dir=scripts/ notebooks/*.ipynb
@@ -22,8 +22,9 @@ mapfile -t patient_array < "$patients_file"
 
 for patient in "${patient_array[@]}"; do
 echo "Processing patient: $patient"
-    # run Python script for performing illumination correction with CellProfiler
-    python cp_illum_correction.py --patient "$patient"
+    # run Python script for performing illumination correction with BaSiC
+    # (cp_illum_correction.py runs the CellProfiler pipeline instead)
+    python basic_illum_correction.py --patient "$patient"
 done
 
 conda deactivate
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Perform illumination correction in Python and save the images
+# One flat field (and optionally dark field) is estimated per projection method and channel from the projected images of every well_fov of the patient with BaSiC, and applied to each image in float32.
+# The corrected images are saved as `{well_fov}_{channel}_illumcorrect.tiff` in the same directories the CellProfiler pipeline (`cp_illum_correction`) writes to, without starting a CellProfiler process per well_fov.
+#
+# Note: BaSiC models the illumination of the whole patient as `image = baseline * flatfield + darkfield` and divides by the flat field, whereas `illum.cppipe` fits a polynomial per image and subtracts it from the fluorescence channels, so the corrected intensities differ from the CellProfiler outputs.
+
+# ## Import libraries
+
+# In[ ]:
+
+
+import os
+import pathlib
+
+from image_analysis_2D.file_utils.arg_parsing_utils import (
+    check_for_missing_args,
+    parse_args,
+)
+from image_analysis_2D.file_utils.artifact_catalog import (
+    get_artifact_catalog_path,
+    record_patient_artifacts,
+)
+from image_analysis_2D.file_utils.notebook_init_utils import (
+    bandicoot_check,
+    init_notebook,
+)
+from image_analysis_2D.illumination_utils.illumination_correction import (
+    ILLUMINATION_CHANNELS,
+    ILLUMINATION_CORRECTION_STAGES,
+    run_illumination_correction,
+)
+
+root_dir, in_notebook = init_notebook()
+image_base_dir = bandicoot_check(
+    pathlib.Path(os.path.expanduser("~/mnt/bandicoot")).resolve(), root_dir
+)
+
+
+# In[ ]:
+
+
+if not in_notebook:
+    args_dict = parse_args()
+    patient = args_dict["patient"]
+    check_for_missing_args(
+        patient=patient,
+    )
+else:
+    patient = "NF0055_T1"
+
+
+# ## Set paths and variables
+
+# In[ ]:
+
+
+# directory holding the projection and illumination correction directories
+analysis_dir = pathlib.Path(f"{image_base_dir}/data/{patient}/2D_analysis/").resolve(
+    strict=True
+)
+# estimate the flat field only, the dark field of our images is close to zero
+get_darkfield = False
+# None uses basicpy when it can be imported and the NumPy estimator otherwise
+backend = None
+# fit each channel on a stratified subset of the well_fovs (e.g.
+# ILLUMINATION_SUBSAMPLE_SIZE) rather than all of them, None fits all images
+subsample_size = None
+
+
+# ## Perform illumination correction on data
+
+# In[ ]:
+
+
+run_summary = run_illumination_correction(
+    analysis_dir=analysis_dir,
+    stages=ILLUMINATION_CORRECTION_STAGES,
+    channels=ILLUMINATION_CHANNELS,
+    backend=backend,
+    get_darkfield=get_darkfield,
+    subsample_size=subsample_size,
+)
+
+
+# In[ ]:
+
+
+# save the per stage and channel summary so failures are kept for reruns
+run_summary_path = pathlib.Path(
+    f"{analysis_dir}/run_stats/{patient}_illum_correction_summary.parquet"
+)
+run_summary_path.parent.mkdir(parents=True, exist_ok=True)
+run_summary.to_parquet(run_summary_path, index=False)
+# record the outputs in the artifact catalog the completeness checks query
+record_patient_artifacts(
+    catalog_path=get_artifact_catalog_path(f"{image_base_dir}/data"),
+    data_dir=f"{image_base_dir}/data",
+    stage="illumination_correction",
+    patient=patient,
+)
+run_summary
@@ -8,6 +8,13 @@ import os
 import pathlib
 
 import tqdm
+from image_analysis_2D.file_utils.artifact_catalog import (
+    ARTIFACT_STAGES,
+    get_artifact_catalog_path,
+    get_stage_status,
+    get_unscanned_stages,
+    record_patient_artifacts,
+)
 from notebook_init_utils import bandicoot_check, init_notebook
 
 root_dir, in_notebook = init_notebook()
@@ -27,43 +34,40 @@ patient_ids
 # In[3]:
 
 
-illumcorr_paths = [
-    "1a.zmax_proj_illum_correction",
-    "1b.middle_slice_illum_correction",
-    "1c.middle_n_slice_max_proj_illum_correction",
-]
-channels = ["405", "488", "555", "640"]
+# the stages record their outputs in the artifact catalog as they write them
+catalog_path = get_artifact_catalog_path(f"{image_base_dir}/data")
+# list the output directories of the stages not scanned yet for a patient, e.g.
+# stages that ran before the catalog existed, otherwise the catalog is only queried
+stages_to_scan = get_unscanned_stages(
+    catalog_path, ["projection", "illumination_correction"], patient_ids
+)
 
 
 # In[4]:
 
 
-expected_count = 0
-missing_count = 0
-missing_list = []
-for patient in tqdm.tqdm(patient_ids, desc="Patients"):
-    # get the number of well_fovs present from the zstack_images dir
-    well_fovs = pathlib.Path(f"{image_base_dir}/data/{patient}/zstack_images").glob("*")
-    well_fovs = [wf.stem for wf in well_fovs]
-    for well_fov in well_fovs:
-        for channel in channels:
-            for illum_corr_sub_path in illumcorr_paths:
-                expected_count += 1
-                illum_corr_path = pathlib.Path(
-                    f"{image_base_dir}/data/{patient}/2D_analysis/{illum_corr_sub_path}/{well_fov}/{well_fov}_{channel}_illumcorrect.tiff"
-                )
-                if not illum_corr_path.exists():
-                    missing_count += 1
-                    missing_list.append(illum_corr_path)
-print(f"Expected illumination corrected images: {expected_count}")
-print(f"Missing illumination corrected images: {missing_count}")
+for stage, patient in tqdm.tqdm(stages_to_scan, desc="Scanning stages"):
+    record_patient_artifacts(catalog_path, f"{image_base_dir}/data", stage, patient)
+# every expected image of the well_fovs in zstack_images, with why it needs a rerun
+stage_status = get_stage_status(
+    catalog_path, "illumination_correction", patients=patient_ids
+)
+missing = stage_status.loc[stage_status["reason"].notna()]
+print(f"Expected illumination corrected images: {len(stage_status)}")
+print(f"Missing illumination corrected images: {len(missing)}")
+print(missing["reason"].value_counts())
 
 
 # In[5]:
 
 
-missing_list = [str(x.parent) for x in missing_list]
-missing_list = list(set(missing_list))
+illum_corr_dirs = ARTIFACT_STAGES["illumination_correction"]["directories"]
+missing_list = sorted(
+    {
+        f"{image_base_dir}/data/{row.patient}/2D_analysis/{illum_corr_dirs[row.method]}/{row.well_fov}"
+        for row in missing.itertuples()
+    }
+)
 if len(missing_list) > 50:
     print(f"Missing {len(missing_list)} directories, not printing all.")
 else:
@@ -0,0 +1,22 @@
+#!/bin/bash
+
+module load anaconda
+# initialize the correct shell for your machine to allow conda to work (see README for note on shell names)
+conda init bash
+# activate the preprocessing environment
+conda activate GFF_segmentation
+
+input_file=$1
+# torch uses the CPUs of the allocation
+export IMAGE_ANALYSIS_2D_TORCH_THREADS="${SLURM_CPUS_PER_TASK:-1}"
+
+echo "Performing nuclei segmentation for every line of: $input_file"
+
+# segment the nuclei of every line with one Cellpose model instead of loading it per well_fov
+python scripts/segment_nuclei_worker.py \
+    --loadfile "$input_file" \
+    --clip_limit 0.02
+
+conda deactivate
+
+echo "Nuclei segmentation completed successfully."
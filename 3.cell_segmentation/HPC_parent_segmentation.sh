@@ -4,42 +4,78 @@ jupyter nbconvert --to script --output-dir=scripts/ notebooks/*.ipynb
 
 input_file="loadfiles/segmentation_loadfile.txt"
 
+# shard the loadfile and segment the nuclei of each shard in one job that loads the
+# Cellpose model once, so the shards run side by side and each pays the model load once.
+# A multiple of 3 keeps the 2D methods of a well_fov (consecutive lines) in one shard
+lines_per_shard=150
+cpus_per_shard=8
+shard_dir="loadfiles/nuclei_shards"
+rm -rf "$shard_dir"
+mkdir -p "$shard_dir" ./logs
+split -l "$lines_per_shard" -d -a 4 --additional-suffix=.txt "$input_file" "$shard_dir/shard_"
 
+# an empty loadfile gives no shards
+shopt -s nullglob
 patient_well_fov_counter=0
 # get the number of lines in the input file
 total_lines=$(wc -l < "$input_file")
 
-while IFS= read -r line; do
-    ((patient_well_fov_counter++))
-
-    # split the line into an array
-    IFS=$'\t' read -r -a parts <<< "$line"
-
-    patient="${parts[0]}"
-    well_fov="${parts[1]}"
-    twoD_method="${parts[2]}"
-
-    echo "Submitted [$patient_well_fov_counter/$total_lines] $patient - $well_fov - $twoD_method"
-
+for shard_file in "$shard_dir"/shard_*.txt; do
     number_of_jobs=$(squeue -u $USER | wc -l)
     while [ $number_of_jobs -gt 990 ]; do
         sleep 1s
         number_of_jobs=$(squeue -u $USER | wc -l)
     done
-    sbatch \
+    shard_name=$(basename "$shard_file" .txt)
+    nuclei_job_id=$(sbatch \
+        --parsable \
         --nodes=1 \
         --ntasks=1 \
+        --cpus-per-task="$cpus_per_shard" \
         --account=amc-general \
         --partition=amilan \
         --qos=normal \
-        --time=00:10:00 \
-        --output="./logs/segmentation_child_${patient}_${well_fov}-%j.out" \
-        HPC_child_segmentation.sh \
-        "$patient" \
-        "$well_fov" \
-        "$twoD_method"
-
-done < "$input_file"
+        --time=04:00:00 \
+        --output="./logs/nuclei_segmentation_worker_${shard_name}-%j.out" \
+        HPC_nuclei_segmentation_worker.sh \
+        "$shard_file")
+    echo "Submitted nuclei segmentation of $shard_file as job $nuclei_job_id"
+
+    # the children of a shard only wait for the nuclei of their own shard,
+    # a line whose nuclei mask is missing (e.g. the worker failed) is segmented by its child
+    while IFS= read -r line; do
+        ((patient_well_fov_counter++))
+
+        # split the line into an array
+        IFS=$'\t' read -r -a parts <<< "$line"
+
+        patient="${parts[0]}"
+        well_fov="${parts[1]}"
+        twoD_method="${parts[2]}"
+
+        echo "Submitted [$patient_well_fov_counter/$total_lines] $patient - $well_fov - $twoD_method"
+
+        number_of_jobs=$(squeue -u $USER | wc -l)
+        while [ $number_of_jobs -gt 990 ]; do
+            sleep 1s
+            number_of_jobs=$(squeue -u $USER | wc -l)
+        done
+        sbatch \
+            --nodes=1 \
+            --ntasks=1 \
+            --account=amc-general \
+            --partition=amilan \
+            --qos=normal \
+            --time=00:10:00 \
+            --dependency=afterany:"$nuclei_job_id" \
+            --output="./logs/segmentation_child_${patient}_${well_fov}-%j.out" \
+            HPC_child_segmentation.sh \
+            "$patient" \
+            "$well_fov" \
+            "$twoD_method"
+
+    done < "$shard_file"
+done
 
 
 echo "Cell segmentation preprocessing completed successfully."
@@ -15,17 +15,9 @@ twoD_method=$3
 echo "Performing segmentation for patient: $patient, well_fov: $well_fov, twoD_method: $twoD_method"
 
 # run Python script for running segmentation of compartments
-python 0.segment_nuclei.py \
-    --patient "$patient" \
-    --well_fov "$well_fov" \
-    --clip_limit 0.02 \
-    --twoD_method "$twoD_method"
-python 1.segment_cells.py \
-    --patient "$patient" \
-    --well_fov "$well_fov" \
-    --clip_limit 0.04 \
-    --twoD_method "$twoD_method"
-python 2.segment_organoids.py \
+# (the nuclei are segmented for every well_fov by HPC_nuclei_segmentation_worker.sh,
+# so segment_compartments.py reuses the nuclei mask and only segments the cells and organoids)
+python segment_compartments.py \
     --patient "$patient" \
     --well_fov "$well_fov" \
     --clip_limit 0.04 \
@@ -10,54 +10,17 @@ input_file="loadfiles/segmentation_loadfile.txt"
 
 conda activate GFF_segmentation_2D
 
-patient_well_fov_counter=0
-# get the number of lines in the input file
-total_lines=$(wc -l < "$input_file")
-
-while IFS= read -r line; do
-    ((patient_well_fov_counter++))
-
-    # split the line into an array
-    IFS=$'\t' read -r -a parts <<< "$line"
-
-    patient="${parts[0]}"
-    well_fov="${parts[1]}"
-    twoD_method="${parts[2]}"
-
-    echo "[$patient_well_fov_counter/$total_lines] $patient - $well_fov - $twoD_method"
-
-    # create the log file
-    log_file="./logs/segment_organoids_${patient}_${well_fov}_${twoD_method}.log"
-    if [ -f "$log_file" ]; then
-        rm "$log_file"
-    fi
-    mkdir -p "$(dirname "$log_file")"
-    touch "$log_file"
-
-    {
-        python scripts/0.segment_nuclei.py \
-            --patient "$patient" \
-            --well_fov "$well_fov" \
-            --clip_limit 0.02 \
-            --twoD_method "$twoD_method"
-
-        python scripts/1.segment_cells.py \
-            --patient "$patient" \
-            --well_fov "$well_fov" \
-            --clip_limit 0.04 \
-            --twoD_method "$twoD_method"
-
-        python scripts/2.segment_organoids.py \
-            --patient "$patient" \
-            --well_fov "$well_fov" \
-            --clip_limit 0.04 \
-            --twoD_method "$twoD_method"
-
-    } &> "$log_file"
-
-done < "$input_file"
-# done < <(tac "$input_file")
-#
+# segment the nuclei of every line with one Cellpose model instead of loading it per well_fov
+mkdir -p ./logs
+python scripts/segment_nuclei_worker.py \
+    --loadfile "$input_file" \
+    --clip_limit 0.02 &> ./logs/segment_nuclei_worker.log
+
+# segment the cells and organoids of every line in one process,
+# reusing the nuclei masks written by the worker
+python scripts/segment_compartments.py \
+    --loadfile "$input_file" \
+    --clip_limit 0.04 &> ./logs/segment_compartments.log
 
 conda deactivate
 
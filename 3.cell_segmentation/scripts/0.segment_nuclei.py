@@ -18,13 +18,22 @@ import matplotlib.pyplot as plt
 # Import dependencies
 import numpy as np
 import skimage
-import tifffile
 import torch
 from cellpose import models
 from image_analysis_2D.file_utils.arg_parsing_utils import (
     check_for_missing_args,
     parse_args,
 )
+from image_analysis_2D.file_utils.artifact_catalog import (
+    get_artifact_catalog_path,
+    try_record_well_fov_artifacts,
+)
+from image_analysis_2D.file_utils.file_reading import (
+    find_files_available,
+    image_exists,
+    read_image,
+)
+from image_analysis_2D.file_utils.file_writing import write_image
 from image_analysis_2D.file_utils.notebook_init_utils import (
     bandicoot_check,
     init_notebook,
@@ -33,7 +42,6 @@ from image_analysis_2D.file_utils.profiling_utils import (
     start_resource_profiling,
     stop_resource_profiling,
 )
-from skimage import io
 
 root_dir, in_notebook = init_notebook()
 image_base_dir = bandicoot_check(
@@ -79,15 +87,15 @@ else:
 if twoD_method == "zmax":
     input_dir = pathlib.Path(
         f"{image_base_dir}/data/{patient}/2D_analysis/0a.zmax_proj/{well_fov}"
-    ).resolve(strict=True)
+    ).resolve()
 elif twoD_method == "middle":
     input_dir = pathlib.Path(
         f"{image_base_dir}/data/{patient}/2D_analysis/0b.middle_slice/{well_fov}"
-    ).resolve(strict=True)
+    ).resolve()
 elif twoD_method == "middle_n":
     input_dir = pathlib.Path(
         f"{image_base_dir}/data/{patient}/2D_analysis/0c.middle_n_slice_max_proj/{well_fov}"
-    ).resolve(strict=True)
+    ).resolve()
 else:
     raise ValueError(f"Unknown twoD_method: {twoD_method}")
 
@@ -99,14 +107,13 @@ labels_path = input_dir / f"{well_fov}_nuclei_mask.tiff"
 # In[4]:
 
 
-if overwrite or not labels_path.exists():
-    image_extensions = {".tif", ".tiff"}
-    files = sorted(input_dir.glob("*"))
-    files = [str(x) for x in files if x.suffix in image_extensions]
+if overwrite or not image_exists(labels_path):
+    # lists both tiff files and images stored in the zarr backend
+    files = find_files_available(input_dir)
     # get the nuclei image
     for f in files:
         if "405" in f:
-            nuclei = io.imread(f)
+            nuclei = read_image(f)
     nuclei = np.array(nuclei)
     nuclei = skimage.exposure.equalize_adapthist(nuclei, clip_limit=clip_limit)
 
@@ -117,7 +124,16 @@ if overwrite or not labels_path.exists():
     labels, details, _ = model.eval(nuclei)
 
     # save the labels
-    tifffile.imwrite(labels_path, labels.astype(np.uint16))
+    write_image(labels_path, labels.astype(np.uint16))
+    # record the masks in the artifact catalog the completeness checks query
+    try_record_well_fov_artifacts(
+        catalog_path=get_artifact_catalog_path(f"{image_base_dir}/data"),
+        data_dir=f"{image_base_dir}/data",
+        stage="segmentation",
+        patient=patient,
+        well_fov=well_fov,
+        methods=[twoD_method],
+    )
 
 
 # In[5]:
@@ -13,21 +13,25 @@
 import os
 import pathlib
 
-import cucim
-import cupy
-import cupyx
-import cupyx.scipy.ndimage
 import matplotlib.pyplot as plt
 
 # Import dependencies
 import numpy as np
 import scipy
 import skimage
-import tifffile
 from image_analysis_2D.file_utils.arg_parsing_utils import (
     check_for_missing_args,
     parse_args,
 )
+from image_analysis_2D.file_utils.artifact_catalog import (
+    get_artifact_catalog_path,
+    try_record_well_fov_artifacts,
+)
+from image_analysis_2D.file_utils.file_reading import (
+    find_files_available,
+    read_image,
+)
+from image_analysis_2D.file_utils.file_writing import write_image
 from image_analysis_2D.file_utils.notebook_init_utils import (
     bandicoot_check,
     init_notebook,
@@ -40,7 +44,7 @@ from image_analysis_2D.segmentation_utils.segmentation_processing import (
     fill_holes_in_mask,
     remove_small_objects_preserve_labels,
 )
-from skimage import io, segmentation
+from skimage import segmentation
 
 root_dir, in_notebook = init_notebook()
 image_base_dir = bandicoot_check(
@@ -85,15 +89,15 @@ else:
 if twoD_method == "zmax":
     input_dir = pathlib.Path(
         f"{image_base_dir}/data/{patient}/2D_analysis/0a.zmax_proj/{well_fov}"
-    ).resolve(strict=True)
+    ).resolve()
 elif twoD_method == "middle":
     input_dir = pathlib.Path(
         f"{image_base_dir}/data/{patient}/2D_analysis/0b.middle_slice/{well_fov}"
-    ).resolve(strict=True)
+    ).resolve()
 elif twoD_method == "middle_n":
     input_dir = pathlib.Path(
         f"{image_base_dir}/data/{patient}/2D_analysis/0c.middle_n_slice_max_proj/{well_fov}"
-    ).resolve(strict=True)
+    ).resolve()
 else:
     raise ValueError(f"Unknown twoD_method: {twoD_method}")
 
@@ -108,16 +112,15 @@ cell_mask_path = input_dir / f"{well_fov}_cell_mask.tiff"
 
 connectivity = 1
 compactness = 1
-image_extensions = {".tif", ".tiff"}
-files = sorted(input_dir.glob("*"))
-files = [str(x) for x in files if x.suffix in image_extensions]
+# lists both tiff files and images stored in the zarr backend
+files = find_files_available(input_dir)
 # get the nuclei image
 for f in files:
     if "555" in f:
-        cell = io.imread(f)
+        cell = read_image(f)
     elif "nuclei_mask" in f:
         nuclei_mask_path = f
-        nuclei_mask = io.imread(f)
+        nuclei_mask = read_image(f)
 
 
 # In[ ]:
@@ -241,8 +244,17 @@ if in_notebook:
 
 
 # save the labels
-tifffile.imwrite(nuclei_mask_path, nuclei_mask.astype(np.uint16))
-tifffile.imwrite(cell_mask_path, cell_mask.astype(np.uint16))
+write_image(nuclei_mask_path, nuclei_mask.astype(np.uint16))
+write_image(cell_mask_path, cell_mask.astype(np.uint16))
+# record the masks in the artifact catalog the completeness checks query
+try_record_well_fov_artifacts(
+    catalog_path=get_artifact_catalog_path(f"{image_base_dir}/data"),
+    data_dir=f"{image_base_dir}/data",
+    stage="segmentation",
+    patient=patient,
+    well_fov=well_fov,
+    methods=[twoD_method],
+)
 
 
 # In[6]:
@@ -4,15 +4,17 @@
 # In[1]:
 
 
-import argparse
 import os
 import pathlib
-import sys
 
-import pandas as pd
-import tifffile
 import tqdm
-from arg_parsing_utils import check_for_missing_args, parse_args
+from image_analysis_2D.file_utils.artifact_catalog import (
+    get_artifact_catalog_path,
+    get_stage_status,
+    get_unscanned_stages,
+    record_patient_artifacts,
+    write_loadfile,
+)
 from notebook_init_utils import bandicoot_check, init_notebook
 
 root_dir, in_notebook = init_notebook()
@@ -32,54 +34,26 @@ patient_ids
 # In[3]:
 
 
-illumcorr_paths = [
-    "0a.zmax_proj",
-    "0b.middle_slice",
-    "0c.middle_n_slice_max_proj",
-]
-masks = ["organoid_mask", "nuclei_mask", "cell_mask"]
+# the segmentation scripts record their masks in the artifact catalog as they write them
+catalog_path = get_artifact_catalog_path(f"{image_base_dir}/data")
+# list the output directories of the stages not scanned yet for a patient, e.g.
+# stages that ran before the catalog existed, otherwise the catalog is only queried
+stages_to_scan = get_unscanned_stages(
+    catalog_path, ["projection", "segmentation"], patient_ids
+)
 
 
 # In[4]:
 
 
-expected_count = 0
-missing_count = 0
-missing_dict = {
-    "patient_id": [],
-    "twoD_method": [],
-    "well_fov": [],
-    "mask": [],
-    "missing_mask_path": [],
-}
-
-for patient in tqdm.tqdm(patient_ids, desc="Patients"):
-    for illum_corr_sub_path in illumcorr_paths:
-        illum_corr_path = pathlib.Path(
-            f"{image_base_dir}/data/{patient}/2D_analysis/{illum_corr_sub_path}/"
-        )
-        well_fovs = [wf.stem for wf in illum_corr_path.glob("*")]
-        for well_fov in well_fovs:
-            if well_fov == "run_stats":
-                continue
-            for mask in masks:
-                mask_path = pathlib.Path(
-                    f"{image_base_dir}/data/{patient}/2D_analysis/{illum_corr_sub_path}/{well_fov}/{well_fov}_{mask}.tiff"
-                ).resolve()
-                if "0a" in str(illum_corr_path.name):
-                    twoD_method = "zmax"
-                elif "0b" in str(illum_corr_path.name):
-                    twoD_method = "middle"
-                elif "0c" in str(illum_corr_path.name):
-                    twoD_method = "middle_n"
-                expected_count += 1
-                if not mask_path.exists():
-                    missing_count += 1
-                    missing_dict["patient_id"].append(patient)
-                    missing_dict["twoD_method"].append(twoD_method)
-                    missing_dict["well_fov"].append(well_fov)
-                    missing_dict["mask"].append(mask)
-                    missing_dict["missing_mask_path"].append(mask_path)
+for stage, patient in tqdm.tqdm(stages_to_scan, desc="Scanning stages"):
+    record_patient_artifacts(catalog_path, f"{image_base_dir}/data", stage, patient)
+# every expected mask with why it needs a rerun: missing, empty (see
+# 4.segmentation_object_check) or stale (older than its projection)
+stage_status = get_stage_status(catalog_path, "segmentation", patients=patient_ids)
+missing = stage_status.loc[stage_status["reason"].notna()]
+expected_count = len(stage_status)
+missing_count = len(missing)
 
 
 # In[5]:
@@ -93,8 +67,7 @@ print(f"Total number of missing masks: {missing_count:,}")
 # In[6]:
 
 
-df = pd.DataFrame(missing_dict)
-df.sort_values(by=["patient_id", "well_fov", "twoD_method"], inplace=True)
+df = missing.rename(columns={"patient": "patient_id", "method": "twoD_method"})
 df = (
     df.groupby(["patient_id", "well_fov", "twoD_method"])
     .size()
@@ -109,10 +82,7 @@ df.head()
 
 # write to the loadfile
 loadfile_path = pathlib.Path("../loadfiles/segmentation_loadfile.txt").resolve()
-loadfile_path.parent.mkdir(parents=True, exist_ok=True)
-with open(loadfile_path, "w") as f:
-    for idx, row in df.iterrows():
-        f.write(f"{row['patient_id']}\t{row['well_fov']}\t{row['twoD_method']}\n")
+write_loadfile(stage_status, loadfile_path, columns=["patient", "well_fov", "method"])
 
 
 # In[8]:
@@ -125,4 +95,3 @@ df.groupby("patient_id").agg(
         "missing_mask_count": ["sum"],
     }
 ).reset_index()
-
@@ -7,13 +7,18 @@
 import os
 import pathlib
 
-import numpy as np
-import pandas as pd
-import tifffile
 from image_analysis_2D.file_utils.arg_parsing_utils import (
     check_for_missing_args,
     parse_args,
 )
+from image_analysis_2D.file_utils.artifact_catalog import (
+    get_artifact_catalog_path,
+    get_artifacts,
+    get_unscanned_stages,
+    record_patient_artifacts,
+    set_artifact_status,
+)
+from image_analysis_2D.file_utils.file_reading import read_image
 from image_analysis_2D.file_utils.notebook_init_utils import (
     bandicoot_check,
     init_notebook,
@@ -34,75 +39,55 @@ image_base_dir = bandicoot_check(
 
 patient_ids_path = pathlib.Path(f"{root_dir}/data/patient_IDs.txt").resolve(strict=True)
 patient_ids = patient_ids_path.read_text().splitlines()
-validated_mask_images_path = pathlib.Path(
-    "../results/validated_mask_images.parquet"
-).resolve()
-validated_mask_images_path.parent.mkdir(parents=True, exist_ok=True)
-if validated_mask_images_path.exists():
-    validated_masks_list = pd.read_parquet(validated_mask_images_path)[
-        "validated_masks"
-    ].tolist()
-else:
-    validated_masks_list = []
+# masks are recorded in the artifact catalog as they are written, and the status of
+# each validated mask (valid or empty) is kept there until the mask is rewritten
+catalog_path = get_artifact_catalog_path(f"{image_base_dir}/data")
+# list the output directories of the stages not scanned yet for a patient, e.g.
+# stages that ran before the catalog existed, otherwise the catalog is only queried
+stages_to_scan = get_unscanned_stages(catalog_path, ["segmentation"], patient_ids)
 
 
 # In[5]:
 
 
-illumcorr_paths = [
-    "0a.zmax_proj",
-    "0b.middle_slice",
-    "0c.middle_n_slice_max_proj",
+for stage, patient in tqdm.tqdm(stages_to_scan, desc="Scanning stages"):
+    record_patient_artifacts(catalog_path, f"{image_base_dir}/data", stage, patient)
+# only the masks written since the last validation are read
+masks_to_validate = get_artifacts(catalog_path, "segmentation", status="present")
+masks_to_validate = masks_to_validate.loc[
+    masks_to_validate["patient"].isin(patient_ids)
 ]
-masks = ["organoid_mask", "nuclei_mask", "cell_mask"]
 
 
 # In[6]:
 
 
-expected_count = 0
-present_count = 0
-empty_count = 0
+valid_masks = []
 empty_masks = []
-for patient in tqdm.tqdm(patient_ids, desc="Patients", leave=True, unit="patient"):
-    for illum_corr_sub_path in illumcorr_paths:
-        illum_corr_path = pathlib.Path(
-            f"{image_base_dir}/data/{patient}/2D_analysis/{illum_corr_sub_path}/"
-        )
-        well_fovs = [wf.stem for wf in illum_corr_path.glob("*")]
-        for well_fov in tqdm.tqdm(
-            well_fovs,
-            desc=f"Processing well FOVs for patient {patient}",
-            leave=False,
-            unit="well FOV",
-        ):
-            for mask in masks:
-                mask_path = pathlib.Path(
-                    f"{image_base_dir}/data/{patient}/2D_analysis/{illum_corr_sub_path}/{well_fov}/{well_fov}_{mask}.tiff"
-                ).resolve()
-                expected_count += 1
-                if mask_path.exists() and str(mask_path) not in validated_masks_list:
-                    mask_image = tifffile.imread(mask_path)
-                    if np.unique(mask_image).size > 1:
-                        validated_masks_list.append(str(mask_path))
-                    else:
-                        empty_count += 1
-                        empty_masks.append(str(mask_path))
-                else:
-                    present_count += 1
+for mask_path in tqdm.tqdm(
+    masks_to_validate["path"], desc="Validating masks", leave=True, unit="mask"
+):
+    mask_image = read_image(mask_path)
+    # a mask with a single value has no objects
+    if mask_image.min() != mask_image.max():
+        valid_masks.append(mask_path)
+    else:
+        empty_masks.append(mask_path)
+# empty masks are listed for a rerun by 3.segmentation_checks
+set_artifact_status(catalog_path, valid_masks, "valid")
+set_artifact_status(catalog_path, empty_masks, "empty")
 print(
-    f"Validated {len(validated_masks_list)} masks out of {expected_count} expected masks, with {empty_count} empty masks."
+    f"Validated {len(masks_to_validate)} new masks, with {len(empty_masks)} empty masks."
 )
-print(f"{present_count / expected_count:.2%} of expected masks were validated.")
 
 
 # In[7]:
 
 
-df = pd.DataFrame({"validated_masks": validated_masks_list})
-df = df.astype(str)
-df.to_parquet(validated_mask_images_path, index=False)
-print(f"Total validated masks: {len(validated_masks_list)}")
+df = get_artifacts(catalog_path, "segmentation")
+df = df.loc[df["patient"].isin(patient_ids)]
+print(df["status"].value_counts())
+print(f"Total validated masks: {(df['status'] == 'valid').sum()}")
 
 
 # In[8]:
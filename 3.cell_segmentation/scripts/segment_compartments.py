@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Segment the nuclei, cells and organoids of each well_fov in one process
+# `0.segment_nuclei`, `1.segment_cells` and `2.segment_organoids` run as three processes per well_fov, each importing the segmentation libraries, with `1.segment_cells` reading back the nuclei mask written by `0.segment_nuclei` and both `1.segment_cells` and `2.segment_organoids` reading the 555 image.
+# This notebook reads the 405 and 555 images once per (patient, well_fov, twoD_method), keeps the nuclei mask in memory for the cell segmentation and writes the same three masks and run stats as the three notebooks.
+# An existing nuclei mask (e.g. from `segment_nuclei_worker`) is reused instead of being segmented again.
+
+# ## import libraries
+
+# In[ ]:
+
+
+import os
+import pathlib
+
+from image_analysis_2D.file_utils.arg_parsing_utils import (
+    check_for_missing_args,
+    parse_args,
+)
+from image_analysis_2D.file_utils.notebook_init_utils import (
+    bandicoot_check,
+    init_notebook,
+)
+from image_analysis_2D.segmentation_utils.compartment_segmentation import (
+    CELL_CLIP_LIMIT,
+    NUCLEI_CLIP_LIMIT,
+    run_compartment_segmentation_worker,
+)
+from image_analysis_2D.segmentation_utils.nuclei_segmentation import (
+    read_segmentation_loadfile,
+)
+
+root_dir, in_notebook = init_notebook()
+image_base_dir = bandicoot_check(
+    pathlib.Path(os.path.expanduser("~/mnt/bandicoot")).resolve(), root_dir
+)
+
+
+# ## parse args and set paths
+
+# If as a notebook, then it will run the hardcoded jobs.
+# However, if this is run as a script, the jobs are read from the loadfile, or a single job is given by the patient, well_fov and twoD_method.
+
+# In[ ]:
+
+
+if not in_notebook:
+    args_dict = parse_args()
+    loadfile = args_dict["loadfile"]
+    if loadfile is not None:
+        # the nuclei worker run before this script rewrites the nuclei of the jobs
+        # flagged to overwrite in the loadfile, so their nuclei masks are reused here
+        jobs = [
+            job[:3]
+            for job in read_segmentation_loadfile(
+                pathlib.Path(loadfile).resolve(strict=True)
+            )
+        ]
+    else:
+        patient = args_dict["patient"]
+        well_fov = args_dict["well_fov"]
+        twoD_method = args_dict["twoD_method"]
+        check_for_missing_args(
+            patient=patient,
+            well_fov=well_fov,
+            twoD_method=twoD_method,
+        )
+        jobs = [(patient, well_fov, twoD_method)]
+    cell_clip_limit = (
+        args_dict["clip_limit"]
+        if args_dict["clip_limit"] is not None
+        else CELL_CLIP_LIMIT
+    )
+else:
+    print("Running in a notebook")
+    cell_clip_limit = CELL_CLIP_LIMIT
+    jobs = [
+        ("NF0014_T1", "C4-2", "zmax"),
+        ("NF0014_T1", "C4-2", "middle"),
+        ("NF0014_T1", "C4-2", "middle_n"),
+    ]
+print(f"{len(jobs)} segmentation jobs")
+
+
+# ## Segment the compartments of each job
+
+# In[ ]:
+
+
+# the Cellpose model is only loaded if a nuclei mask has to be segmented
+job_summary = run_compartment_segmentation_worker(
+    jobs=jobs,
+    image_base_dir=image_base_dir,
+    nuclei_clip_limit=NUCLEI_CLIP_LIMIT,
+    cell_clip_limit=cell_clip_limit,
+)
+print(job_summary["status"].value_counts())
+
+
+# In[ ]:
+
+
+failed_jobs = job_summary.loc[job_summary["status"] == "failed"]
+if len(failed_jobs) > 0:
+    print(failed_jobs[["patient", "well_fov", "twoD_method"]])
+    raise RuntimeError(f"{len(failed_jobs)} segmentation job(s) failed")
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Segment the nuclei of every job of a loadfile with one Cellpose model
+# `0.segment_nuclei` imports torch and loads the Cellpose model once per well_fov and 2D method.
+# This notebook loads the model once and segments the nuclei of each (patient, well_fov, twoD_method) line of the loadfile, writing the same masks and run stats as `0.segment_nuclei`.
+
+# ## import libraries
+
+# In[ ]:
+
+
+import os
+import pathlib
+
+from image_analysis_2D.file_utils.arg_parsing_utils import (
+    check_for_missing_args,
+    parse_args,
+)
+from image_analysis_2D.file_utils.notebook_init_utils import (
+    bandicoot_check,
+    init_notebook,
+)
+from image_analysis_2D.segmentation_utils.nuclei_segmentation import (
+    load_nuclei_model,
+    read_segmentation_loadfile,
+    run_nuclei_segmentation_worker,
+)
+
+root_dir, in_notebook = init_notebook()
+image_base_dir = bandicoot_check(
+    pathlib.Path(os.path.expanduser("~/mnt/bandicoot")).resolve(), root_dir
+)
+
+
+# ## parse args and set paths
+
+# If as a notebook, then it will run the hardcoded jobs.
+# However, if this is run as a script, the jobs are read from the loadfile.
+
+# In[ ]:
+
+
+if not in_notebook:
+    args_dict = parse_args()
+    loadfile = args_dict["loadfile"]
+    clip_limit = args_dict["clip_limit"]
+    check_for_missing_args(
+        loadfile=loadfile,
+        clip_limit=clip_limit,
+    )
+    jobs = read_segmentation_loadfile(pathlib.Path(loadfile).resolve(strict=True))
+else:
+    print("Running in a notebook")
+    clip_limit = 0.02
+    jobs = [
+        ("NF0014_T1", "C4-2", "zmax"),
+        ("NF0014_T1", "C4-2", "middle"),
+        ("NF0014_T1", "C4-2", "middle_n"),
+    ]
+print(f"{len(jobs)} nuclei segmentation jobs")
+
+
+# ## Segment the nuclei of each job
+
+# In[ ]:
+
+
+# jobs segmented per model.eval call, 1 segments each job like 0.segment_nuclei;
+# 3 segments the three 2D methods of a well_fov (consecutive lines of the loadfile)
+# together, use it once benchmarks/cellpose_batch_benchmark.py shows it is faster
+# on the node the worker runs on
+images_per_batch = 1
+# tiles per forward pass of the network, None for the Cellpose default, torch uses
+# IMAGE_ANALYSIS_2D_TORCH_THREADS threads on the CPU when it is set
+batch_size = None
+# the model is loaded once for all of the jobs
+model = load_nuclei_model()
+job_summary = run_nuclei_segmentation_worker(
+    jobs=jobs,
+    image_base_dir=image_base_dir,
+    clip_limit=clip_limit,
+    model=model,
+    images_per_batch=images_per_batch,
+    batch_size=batch_size,
+)
+print(job_summary["status"].value_counts())
+
+
+# In[ ]:
+
+
+failed_jobs = job_summary.loc[job_summary["status"] == "failed"]
+if len(failed_jobs) > 0:
+    print(failed_jobs[["patient", "well_fov", "twoD_method"]])
+    raise RuntimeError(f"{len(failed_jobs)} nuclei segmentation job(s) failed")
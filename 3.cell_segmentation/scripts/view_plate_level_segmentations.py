@@ -17,6 +17,7 @@ from image_analysis_2D.file_utils.arg_parsing_utils import (
     parse_args,
 )
 from image_analysis_2D.file_utils.file_reading import read_zstack_image
+from image_analysis_2D.file_utils.io_pipeline import iter_prefetched
 from image_analysis_2D.file_utils.notebook_init_utils import (
     bandicoot_check,
     init_notebook,
@@ -131,6 +132,32 @@ def plot_plate_overview(
         y=0.98,
     )
 
+    # Get the first image file from each well that has data
+    well_image_files = {}
+    for row in rows:
+        for col in cols:
+            well_dir = available_wells.get(f"{row}{col}") or available_wells.get(
+                f"{row}{col:02d}"
+            )
+            if well_dir is None:
+                continue
+            image_files = sorted(list(well_dir.glob(f"*{image_sub_string_to_search}*")))
+            if image_files:
+                well_image_files[(row, col)] = image_files[0]
+
+    def read_well_image(well_image_file: tuple) -> np.ndarray:
+        image = tifffile.imread(well_image_file[1])
+        # downscale for faster display
+        if not "mask" in title_for_substring:
+            image = image[::10, ::10]
+        return image
+
+    # read the next wells on background threads while the current well is plotted
+    # images are yielded in the same row and column order as the loop below
+    prefetched_images = iter_prefetched(
+        well_image_files.items(), read_function=read_well_image, prefetch=8
+    )
+
     # Show in a grid one image per plate well
     for i, row in enumerate(rows):
         for j, col in enumerate(cols):
@@ -143,19 +170,10 @@ def plot_plate_overview(
                 well_position_no_zero in available_wells
                 or well_position in available_wells
             ):
-                well_dir = available_wells.get(
-                    well_position_no_zero
-                ) or available_wells.get(well_position)
-
-                # Get the first image file from this well
-                image_files = sorted(
-                    list(well_dir.glob(f"*{image_sub_string_to_search}*"))
-                )
-                if image_files:
-                    nuclei_mask = tifffile.imread(image_files[0])
-                    # downscale for faster display
-                    if not "mask" in title_for_substring:
-                        nuclei_mask = nuclei_mask[::10, ::10]
+                if (row, col) in well_image_files:
+                    _, nuclei_mask, read_error = next(prefetched_images)
+                    if read_error is not None:
+                        raise read_error
 
                     # Enhance contrast
                     if contrast_enhance:
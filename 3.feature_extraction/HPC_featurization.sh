@@ -52,42 +52,40 @@ PYTHON_BIN="$ENV_PATH/bin/python3"
 
 
 
+# start one apptainer instance of the CellProfiler image for the whole job
+# so every CellProfiler run is sent into it instead of setting up a container per run
+# the instance is stopped when this script exits, including on scancel or the time limit
+cellprofiler_image="$git_root/environments/cellprofiler.sif"
+if [ -f "$cellprofiler_image" ] && command -v apptainer &> /dev/null; then
+    instance_name="cellprofiler_${SLURM_JOB_ID:-$$}"
+    if apptainer instance start "$cellprofiler_image" "$instance_name"; then
+        export CELLPROFILER_APPTAINER_INSTANCE="$instance_name"
+        trap 'apptainer instance stop "$instance_name"' EXIT
+        trap 'exit 143' TERM
+    fi
+fi
+
 input_file="$git_root/3.feature_extraction/loadfiles/featurization_loadfile.txt"
 
 cd scripts/ || exit
-# set the counter to zero
-patient_well_fov_counter=0
-# get the number of lines in the input file
 total_lines=$(wc -l < "$input_file")
+echo "Processing $total_lines well_fovs of $input_file"
 
-
-while IFS= read -r line; do
-((patient_well_fov_counter++))
-
-    # split the line into an array
-    IFS=$'\t' read -r -a parts <<< "$line"
-
-    patient="${parts[0]}"
-    well_fov="${parts[1]}"
-
-    echo "  [$patient_well_fov_counter/$total_lines] Processing $patient - $well_fov"
-
-    log_file="../logs/featurize_organoids_${patient}_${well_fov}.log"
-    if [ -f "$log_file" ]; then
-        rm "$log_file"
-    fi
-    mkdir -p "$(dirname "$log_file")"
-    touch "$log_file"
-
-    # call cellprofiler to run the analysis
-    # this script runs all three max projection methods in parallel
-    {
-        "$PYTHON_BIN" cp_analysis.py \
-            --patient "$patient" \
-            --well_fov "$well_fov"
-    } &> "$log_file"
-
-done < "$input_file"
+log_file="../logs/featurize_organoids_$(basename "$input_file" .txt).log"
+if [ -f "$log_file" ]; then
+    rm "$log_file"
+fi
+mkdir -p "$(dirname "$log_file")"
+touch "$log_file"
+
+# call cellprofiler to run the analysis
+# one process runs every well_fov of the loadfile, so the CellProfiler worker pool
+# starts Java and loads the pipelines once for all of their runs
+# the loadfile flags the well_fovs whose databases exist but have to be rewritten
+{
+    "$PYTHON_BIN" cp_analysis.py \
+        --loadfile "$input_file"
+} &> "$log_file"
 
 cd ../ || exit
 
@@ -9,6 +9,14 @@ import pathlib
 import pprint
 
 import pandas as pd
+from image_analysis_2D.file_utils.artifact_catalog import (
+    ARTIFACT_STAGES,
+    get_artifact_catalog_path,
+    get_stage_status,
+    get_unscanned_stages,
+    record_patient_artifacts,
+    write_loadfile,
+)
 
 # Get from arg_parsing_utils import check_for_missing_args, parse_args
 from notebook_init_utils import bandicoot_check, init_notebook
@@ -40,79 +48,52 @@ patient_dirs.sort()
 # In[3]:
 
 
-# get a list of the well_fov directories for each patient
-well_fov_dirs = [
-    x
-    for patient_dir in patient_dirs
-    for x in pathlib.Path(
-        f"{patient_dir}/2D_analysis/1b.middle_slice_illum_correction"
-    ).iterdir()
-    if x.is_dir()
-]
-well_fov_dirs.sort()
-well_fov_df = pd.DataFrame(well_fov_dirs, columns=["dir_path"])
-well_fov_df["patient"] = well_fov_df["dir_path"].apply(
-    lambda x: str(x.parent).split("/")[-3]
+# the stages record their outputs in the artifact catalog as they write them
+catalog_path = get_artifact_catalog_path(patients_dir)
+# list the output directories of the stages not scanned yet for a patient, e.g.
+# stages that ran before the catalog existed, otherwise the catalog is only queried
+stages_to_scan = get_unscanned_stages(
+    catalog_path,
+    ["projection", "segmentation", "featurization"],
+    [patient_dir.name for patient_dir in patient_dirs],
 )
-well_fov_df["well_fov"] = well_fov_df["dir_path"].apply(lambda x: x.stem)
-well_fov_df
+for stage, patient in stages_to_scan:
+    record_patient_artifacts(catalog_path, patients_dir, stage, patient)
 
 
 # In[4]:
 
 
-present_files = 0
-missing_files = 0
-missing_files_list = []
-for index, row in well_fov_df.iterrows():
-    patient = row["patient"]
-    well_fov = row["well_fov"]
-    max_z_slice_dir_to_check = pathlib.Path(
-        f"{image_base_dir}/data/{patient}/2D_analysis/2a.cellprofiler_zmax_proj_output/{well_fov}/"
-    ).resolve()
-    middle_slice_dir_to_check = pathlib.Path(
-        f"{image_base_dir}/data/{patient}/2D_analysis/2b.cellprofiler_middle_slice_output/{well_fov}/"
-    ).resolve()
-    middle_n_slice_dir_to_check = pathlib.Path(
-        f"{image_base_dir}/data/{patient}/2D_analysis/2c.cellprofiler_middle_n_slice_max_proj_output/{well_fov}/"
-    ).resolve()
-    if not max_z_slice_dir_to_check.is_dir():
-        missing_files += 1
-        missing_files_list.append(str(max_z_slice_dir_to_check))
-    else:
-        present_files += 1
-    if not middle_slice_dir_to_check.is_dir():
-        missing_files += 1
-        missing_files_list.append(str(middle_slice_dir_to_check))
-    else:
-        present_files += 1
-    if not middle_n_slice_dir_to_check.is_dir():
-        missing_files += 1
-        missing_files_list.append(str(middle_n_slice_dir_to_check))
-    else:
-        present_files += 1
+# every expected database of the well_fovs in zstack_images, with why it needs a rerun
+stage_status = get_stage_status(catalog_path, "featurization", patients=patients)
+missing = stage_status.loc[stage_status["reason"].notna()]
+featurization_dirs = ARTIFACT_STAGES["featurization"]["directories"]
+missing_files_list = sorted(
+    {
+        f"{patients_dir}/{row.patient}/2D_analysis/{featurization_dirs[row.method]}/{row.well_fov}"
+        for row in missing.itertuples()
+    }
+)
 
 
 # In[5]:
 
 
-reruns_df = pd.DataFrame(missing_files_list, columns=["dir_path"])
-reruns_df["patient"] = reruns_df["dir_path"].apply(lambda x: str(x).split("/")[-4])
-reruns_df["well_fov"] = reruns_df["dir_path"].apply(lambda x: str(x).split("/")[-1])
-reruns_df.drop(columns=["dir_path"], inplace=True)
-reruns_df.drop_duplicates(inplace=True)
-pathlib.Path("../loadfiles/").mkdir(parents=True, exist_ok=True)
-reruns_df.to_csv(
-    f"../loadfiles/featurization_loadfile.txt", index=False, sep="\t", header=False
+reruns_df = write_loadfile(
+    stage_status,
+    "../loadfiles/featurization_loadfile.txt",
+    columns=["patient", "well_fov"],
 )
 
 
 # In[6]:
 
 
-print(f"Total directories checked: {len(well_fov_df) * 3}")
-print(f"Present directories: {present_files}")
-print(f"Missing directories: {missing_files}")
+print(f"Total databases checked: {len(stage_status)}")
+print(f"Present databases: {len(stage_status) - len(missing)}")
+print(f"Missing databases: {len(missing)}")
+print(missing["reason"].value_counts())
+print(f"Well_fovs to rerun: {len(reruns_df)}")
 print("Missing directories list:")
-if missing_files < 50:
+if len(missing_files_list) < 50:
     pprint.pprint(missing_files_list)
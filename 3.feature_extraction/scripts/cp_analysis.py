@@ -8,20 +8,37 @@
 # In[9]:
 
 
+import datetime
 import os
 import pathlib
 import pprint
 
-import psutil
-from image_analysis_2D.cp_utils.cp_utils import run_cellprofiler
+import pandas as pd
+from image_analysis_2D.cp_utils.apptainer_utils import get_cellprofiler_container
+from image_analysis_2D.cp_utils.cp_parallel import (
+    estimate_cellprofiler_job_memory,
+    get_cellprofiler_log_path,
+    run_cellprofiler_parallel,
+)
+from image_analysis_2D.cp_utils.cp_worker_pool import (
+    cellprofiler_core_available,
+    cellprofiler_worker_pool,
+    get_cellprofiler_worker_count,
+    submit_cellprofiler_job,
+    wait_for_cellprofiler_jobs,
+)
 from image_analysis_2D.featurization_utils.resource_profiling_utils import (
-    start_resource_profiling,
-    stop_resource_profiling,
+    save_process_profiling,
 )
 from image_analysis_2D.file_utils.arg_parsing_utils import (
     check_for_missing_args,
     parse_args,
 )
+from image_analysis_2D.file_utils.artifact_catalog import (
+    get_artifact_catalog_path,
+    read_loadfile,
+    try_record_well_fov_artifacts,
+)
 from image_analysis_2D.file_utils.notebook_init_utils import (
     bandicoot_check,
     init_notebook,
@@ -33,39 +50,44 @@ image_base_dir = bandicoot_check(
     root_dir,
 )
 
-if in_notebook:
-    import tqdm.notebook as tqdm
-else:
-    import tqdm
-
 
 # In[10]:
 
 
 if not in_notebook:
     args_dict = parse_args()
-    patient = args_dict["patient"]
-    well_fov = args_dict["well_fov"]
-    check_for_missing_args(
-        patient=patient,
-        well_fov=well_fov,
-    )
+    loadfile = args_dict["loadfile"]
+    if loadfile is not None:
+        # every well_fov of the loadfile runs in this process, so one worker pool runs
+        # all of their runs and each worker starts Java and loads the pipelines once
+        work_items_df = read_loadfile(
+            pathlib.Path(loadfile).resolve(strict=True), columns=["patient", "well_fov"]
+        )
+        run_name = pathlib.Path(loadfile).stem
+    else:
+        patient = args_dict["patient"]
+        well_fov = args_dict["well_fov"]
+        check_for_missing_args(
+            patient=patient,
+            well_fov=well_fov,
+        )
+        # rerun even if the databases exist, e.g. when they are stale
+        work_items_df = pd.DataFrame(
+            {
+                "patient": [patient],
+                "well_fov": [well_fov],
+                "overwrite": [args_dict["overwrite"]],
+            }
+        )
+        run_name = f"{patient}_{well_fov}"
 
 else:
     print("Running in a notebook")
-    well_fov = "C4-2"
-    patient = "NF0014_T1"
-
-
-max_projected_input = pathlib.Path(
-    f"{image_base_dir}/data/{patient}/2D_analysis/0a.zmax_proj/{well_fov}"
-).resolve(strict=True)
-middle_slice_input = pathlib.Path(
-    f"{image_base_dir}/data/{patient}/2D_analysis/0b.middle_slice/{well_fov}"
-).resolve(strict=True)
-middle_n_input = pathlib.Path(
-    f"{image_base_dir}/data/{patient}/2D_analysis/0c.middle_n_slice_max_proj/{well_fov}"
-).resolve(strict=True)
+    work_items_df = pd.DataFrame(
+        {"patient": ["NF0014_T1"], "well_fov": ["C4-2"], "overwrite": [False]}
+    )
+    run_name = "NF0014_T1_C4-2"
+print(f"{len(work_items_df)} well_fovs to featurize")
 
 
 # ## Set paths and variables
@@ -73,8 +95,8 @@ middle_n_input = pathlib.Path(
 # In[11]:
 
 
-# set the run type for the parallelization
-run_name = f"{patient}_{well_fov}"
+# logs of each CellProfiler run and the summary of the runs
+log_dir = pathlib.Path(f"logs/{run_name}")
 
 # set path for CellProfiler pipeline
 path_to_pipeline_sc = pathlib.Path(
@@ -83,8 +105,6 @@ path_to_pipeline_sc = pathlib.Path(
 path_to_pipeline_organoid = pathlib.Path(
     f"{root_dir}/3.feature_extraction/pipelines/analysis_organoid.cppipe"
 ).resolve(strict=True)
-# Get the plate name from the folder name
-plate_name = f"{patient}_{well_fov}"  # Get the folder name as the plate name
 
 output_base_dir = f"{root_dir}"
 
@@ -95,28 +115,52 @@ output_base_dir = f"{root_dir}"
 
 
 plate_info_dictionary = {}
+# well_fovs without projected images, reported with the failed runs
+missing_inputs = []
 # create plate info dictionary with all parts of the CellProfiler CLI command to run in parallel
-for images_dir in [middle_slice_input, max_projected_input, middle_n_input]:
-    if "zmax_proj" in str(images_dir):
-        output_path = f"{output_base_dir}/data/{patient}/2D_analysis/2a.cellprofiler_{str(images_dir.parent.name.split('0a.')[1])}_output/{well_fov}/"
-    elif "middle_slice" in str(images_dir):
-        output_path = f"{output_base_dir}/data/{patient}/2D_analysis/2b.cellprofiler_{str(images_dir.parent.name.split('0b.')[1])}_output/{well_fov}/"
-    elif "middle_n" in str(images_dir):
-        output_path = f"{output_base_dir}/data/{patient}/2D_analysis/2c.cellprofiler_{str(images_dir.parent.name.split('0c.')[1])}_output/{well_fov}/"
-    for object_type in ["single_cell", "organoid"]:
-        pipeline = (
-            path_to_pipeline_sc
-            if object_type == "single_cell"
-            else path_to_pipeline_organoid
-        )
-
-        plate_info_dictionary[
-            f"{plate_name}_{str(images_dir.parent.name)}_{object_type}"
-        ] = {
-            "path_to_images": images_dir,
-            "path_to_output": pathlib.Path(output_path).resolve(),
-            "path_to_pipeline": pipeline,
-        }
+for patient, well_fov, overwrite in work_items_df[
+    ["patient", "well_fov", "overwrite"]
+].itertuples(index=False, name=None):
+    # Get the plate name from the folder name
+    plate_name = f"{patient}_{well_fov}"
+    try:
+        max_projected_input = pathlib.Path(
+            f"{image_base_dir}/data/{patient}/2D_analysis/0a.zmax_proj/{well_fov}"
+        ).resolve(strict=True)
+        middle_slice_input = pathlib.Path(
+            f"{image_base_dir}/data/{patient}/2D_analysis/0b.middle_slice/{well_fov}"
+        ).resolve(strict=True)
+        middle_n_input = pathlib.Path(
+            f"{image_base_dir}/data/{patient}/2D_analysis/0c.middle_n_slice_max_proj/{well_fov}"
+        ).resolve(strict=True)
+    except FileNotFoundError as e:
+        print(f"Skipping {plate_name}, its projected images are missing: {e}")
+        missing_inputs.append(plate_name)
+        continue
+    for images_dir in [middle_slice_input, max_projected_input, middle_n_input]:
+        if "zmax_proj" in str(images_dir):
+            output_path = f"{output_base_dir}/data/{patient}/2D_analysis/2a.cellprofiler_{str(images_dir.parent.name.split('0a.')[1])}_output/{well_fov}/"
+        elif "middle_slice" in str(images_dir):
+            output_path = f"{output_base_dir}/data/{patient}/2D_analysis/2b.cellprofiler_{str(images_dir.parent.name.split('0b.')[1])}_output/{well_fov}/"
+        elif "middle_n" in str(images_dir):
+            output_path = f"{output_base_dir}/data/{patient}/2D_analysis/2c.cellprofiler_{str(images_dir.parent.name.split('0c.')[1])}_output/{well_fov}/"
+        for object_type in ["single_cell", "organoid"]:
+            pipeline = (
+                path_to_pipeline_sc
+                if object_type == "single_cell"
+                else path_to_pipeline_organoid
+            )
+
+            plate_info_dictionary[
+                f"{plate_name}_{str(images_dir.parent.name)}_{object_type}"
+            ] = {
+                "path_to_images": images_dir,
+                "path_to_output": pathlib.Path(output_path).resolve(),
+                "path_to_pipeline": pipeline,
+                "patient": patient,
+                "well_fov": well_fov,
+                "overwrite": overwrite,
+            }
 
 # view the dictionary to assess that all info is added correctly
 if in_notebook:
@@ -132,6 +176,11 @@ for plate_name, plate_info in plate_info_dictionary.items():
     if not plate_info["path_to_output"].exists():
         plate_info["path_to_output"].mkdir(parents=True, exist_ok=True)
     sqlite_files = list(plate_info["path_to_output"].glob("*.sqlite"))
+    if plate_info["overwrite"]:
+        # ExportToDatabase never overwrites, so the run starts without the old databases
+        for sqlite_file in sqlite_files:
+            sqlite_file.unlink()
+        sqlite_files = []
     if len(sqlite_files) == 0:
         plates_to_run[plate_name] = plate_info
     else:
@@ -159,34 +208,109 @@ try:
 except FileNotFoundError:
     print("No apptainer image found, running CellProfiler without apptainer.")
     path_to_apptainer_image = None
+# start one apptainer instance for all runs, or use the instance started by the calling shell script
+cellprofiler_container = get_cellprofiler_container(path_to_apptainer_image)
+
+# with cellprofiler_core installed in this environment, run all runs in one worker that
+# loads the pipelines and starts Java once instead of one CellProfiler process per run
+use_worker_pool = (
+    cellprofiler_container is None
+    and cellprofiler_core_available()
+    and len(plates_to_run) > 1
+)
+print(f"Using a CellProfiler worker pool: {use_worker_pool}")
 
 
 # In[8]:
 
 
+# the runs are independent, so they run concurrently, as many at a time as the CPUs
+# of the allocation and the free memory allow
+run_records = []
 if len(plates_to_run) == 0:
     print("All runs have already ran")
+elif use_worker_pool:
+    # the workers run many jobs each, so their Java start and pipeline loads are amortized
+    num_workers = get_cellprofiler_worker_count(
+        per_worker_memory=max(
+            estimate_cellprofiler_job_memory(plate_info["path_to_images"])
+            for plate_info in plates_to_run.values()
+        ),
+        number_of_jobs=len(plates_to_run),
+    )
+    log_dir.mkdir(parents=True, exist_ok=True)
+    with cellprofiler_worker_pool(
+        pipeline_paths=[path_to_pipeline_sc, path_to_pipeline_organoid],
+        num_workers=num_workers,
+    ) as worker_pool:
+        job_ids = [
+            submit_cellprofiler_job(
+                worker_pool,
+                path_to_pipeline=plate_info["path_to_pipeline"],
+                path_to_input=plate_info["path_to_images"],
+                path_to_output=plate_info["path_to_output"],
+                log_file=get_cellprofiler_log_path(log_dir, "cellprofiler", plate_name),
+            )
+            for plate_name, plate_info in plates_to_run.items()
+        ]
+        results = wait_for_cellprofiler_jobs(worker_pool, job_ids)
+    run_records = [
+        {
+            "name": plate_name,
+            "returncode": result["returncode"],
+            "start_time": datetime.datetime.fromtimestamp(result["start_time"]),
+            "duration_seconds": result["duration_seconds"],
+            "peak_rss_bytes": result["peak_rss_bytes"],
+        }
+        for plate_name, result in zip(plates_to_run, results)
+    ]
 else:
-    for plate_name, plate_info in tqdm.tqdm(plates_to_run.items()):
-        start_time, start_memory = start_resource_profiling()
-        run_cellprofiler(
-            path_to_pipeline=plate_info["path_to_pipeline"],
-            path_to_input=plate_info["path_to_images"],
-            path_to_output=plate_info["path_to_output"],
-            run_with_apptainer_interactive=path_to_apptainer_image,
-            log_file_name=f"{plate_name}.log",
-        )
-        # move the log file to the output directory
-        stop_resource_profiling(
-            start_time=start_time,
-            well_fov=well_fov,
-            patient_id=patient,
-            feature_type="cellprofiler2D",
-            channel="All",
-            compartment="All",
-            CPU_GPU="CPU",
-            output_file_dir=pathlib.Path(
-                f"{root_dir}/data/{patient}/2D_analysis/run_stats/{plate_name}_{well_fov}_profiling_stats.parquet"
-            ),
-            start_mem=start_memory,
-        )
+    run_records = run_cellprofiler_parallel(
+        plate_info_dictionary=plates_to_run,
+        run_name="cellprofiler",
+        run_with_apptainer_interactive=cellprofiler_container,
+        log_dir=log_dir,
+    )
+
+# profile each run from the process that ran it
+for run_record in run_records:
+    patient = plate_info_dictionary[run_record["name"]]["patient"]
+    well_fov = plate_info_dictionary[run_record["name"]]["well_fov"]
+    save_process_profiling(
+        start_time=run_record["start_time"].timestamp(),
+        time_elapsed=run_record["duration_seconds"],
+        peak_rss_mb=run_record["peak_rss_bytes"] / 1024**2,
+        returncode=run_record["returncode"],
+        well_fov=well_fov,
+        patient_id=patient,
+        feature_type="cellprofiler2D",
+        channel="All",
+        compartment="All",
+        CPU_GPU="CPU",
+        output_file_dir=pathlib.Path(
+            f"{root_dir}/data/{patient}/2D_analysis/run_stats/{run_record['name']}_{well_fov}_profiling_stats.parquet"
+        ),
+    )
+
+# record the databases in the artifact catalog the completeness checks query
+for patient, well_fov in sorted(
+    {
+        (plate_info["patient"], plate_info["well_fov"])
+        for plate_info in plate_info_dictionary.values()
+    }
+):
+    try_record_well_fov_artifacts(
+        catalog_path=get_artifact_catalog_path(f"{image_base_dir}/data"),
+        data_dir=f"{output_base_dir}/data",
+        stage="featurization",
+        patient=patient,
+        well_fov=well_fov,
+    )
+
+failed_runs = missing_inputs + [
+    run_record["name"] for run_record in run_records if run_record["returncode"] != 0
+]
+if len(failed_runs) > 0:
+    raise RuntimeError(
+        f"CellProfiler failed for {failed_runs}, see the logs in {log_dir}"
+    )
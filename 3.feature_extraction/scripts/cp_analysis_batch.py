@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Perform analysis over batches of well_fovs and split the SQLite databases per well_fov
+# `cp_analysis` starts one CellProfiler process per well_fov, projection method and object type.
+# This notebook runs one CellProfiler process per chunk of well_fovs of a patient from a `--file-list`, and splits the SQLite database of each chunk into the same `{well_fov}/gff_extracted_features_{object type}.sqlite` outputs by the `Well` and `Site` metadata of each image set.
+
+# ## Import libraries
+
+# In[ ]:
+
+
+import os
+import pathlib
+
+import pandas as pd
+from image_analysis_2D.cp_utils.apptainer_utils import get_cellprofiler_container
+from image_analysis_2D.cp_utils.cp_batch import (
+    CELLPROFILER_BATCH_CHUNK_SIZE,
+    get_pipeline_sqlite_name,
+    run_cellprofiler_batch,
+)
+from image_analysis_2D.file_utils.arg_parsing_utils import (
+    check_for_missing_args,
+    parse_args,
+)
+from image_analysis_2D.file_utils.artifact_catalog import (
+    get_artifact_catalog_path,
+    record_patient_artifacts,
+)
+from image_analysis_2D.file_utils.notebook_init_utils import (
+    bandicoot_check,
+    init_notebook,
+)
+
+root_dir, in_notebook = init_notebook()
+image_base_dir = bandicoot_check(
+    pathlib.Path(os.path.expanduser("~/mnt/bandicoot/NF1_organoid_data")).resolve(),
+    root_dir,
+)
+
+
+# In[ ]:
+
+
+if not in_notebook:
+    args_dict = parse_args()
+    patient = args_dict["patient"]
+    check_for_missing_args(
+        patient=patient,
+    )
+else:
+    print("Running in a notebook")
+    patient = "NF0014_T1"
+
+
+# ## Set paths and variables
+
+# In[ ]:
+
+
+# set path for CellProfiler pipelines
+pipelines = {
+    "single_cell": pathlib.Path(
+        f"{root_dir}/3.feature_extraction/pipelines/analysis_single_cell.cppipe"
+    ).resolve(strict=True),
+    "organoid": pathlib.Path(
+        f"{root_dir}/3.feature_extraction/pipelines/analysis_organoid.cppipe"
+    ).resolve(strict=True),
+}
+# projection stage -> CellProfiler output stage, as in cp_analysis
+stages = {
+    "0a.zmax_proj": "2a.cellprofiler_zmax_proj_output",
+    "0b.middle_slice": "2b.cellprofiler_middle_slice_output",
+    "0c.middle_n_slice_max_proj": "2c.cellprofiler_middle_n_slice_max_proj_output",
+}
+# number of well_fovs per CellProfiler process
+# larger chunks amortize more CellProfiler start ups, smaller chunks rerun less on a failure
+chunk_size = CELLPROFILER_BATCH_CHUNK_SIZE
+
+output_base_dir = f"{root_dir}"
+
+
+# In[ ]:
+
+
+try:
+    path_to_apptainer_image = pathlib.Path(
+        f"{root_dir}/environments/cellprofiler.sif"
+    ).resolve(strict=True)
+    print("Using apptainer image for CellProfiler run.")
+except FileNotFoundError:
+    print("No apptainer image found, running CellProfiler without apptainer.")
+    path_to_apptainer_image = None
+# start one apptainer instance for all runs, or use the instance started by the calling shell script
+cellprofiler_container = get_cellprofiler_container(path_to_apptainer_image)
+
+
+# ## Perform CellProfiler analysis on chunks of well_fovs
+
+# In[ ]:
+
+
+run_summaries = []
+for input_stage, output_stage in stages.items():
+    images_dir = pathlib.Path(
+        f"{image_base_dir}/data/{patient}/2D_analysis/{input_stage}"
+    ).resolve(strict=True)
+    output_dir = pathlib.Path(
+        f"{output_base_dir}/data/{patient}/2D_analysis/{output_stage}"
+    ).resolve()
+    for object_type, pipeline in pipelines.items():
+        sqlite_name = get_pipeline_sqlite_name(pipeline)
+        # only run the well_fovs without a database of this pipeline
+        well_fov_dirs = [
+            well_fov_dir
+            for well_fov_dir in sorted(images_dir.glob("*"))
+            if well_fov_dir.is_dir()
+            and not (output_dir / well_fov_dir.name / sqlite_name).exists()
+        ]
+        if len(well_fov_dirs) == 0:
+            print(f"All {object_type} databases present for {input_stage}, skipping.")
+            continue
+        run_summary = run_cellprofiler_batch(
+            path_to_pipeline=pipeline,
+            well_fov_dirs=well_fov_dirs,
+            output_dir=output_dir,
+            run_name=f"{patient}_{input_stage}_{object_type}",
+            chunk_size=chunk_size,
+            run_with_apptainer_interactive=cellprofiler_container,
+        )
+        run_summary.insert(0, "object_type", object_type)
+        run_summary.insert(0, "stage", output_stage)
+        run_summaries.append(run_summary)
+
+
+# In[ ]:
+
+
+# save the per well_fov summary so failed well_fovs are kept for reruns
+if len(run_summaries) > 0:
+    run_summary = pd.concat(run_summaries, ignore_index=True)
+    run_summary_path = pathlib.Path(
+        f"{output_base_dir}/data/{patient}/2D_analysis/run_stats/{patient}_cellprofiler_batch_summary.parquet"
+    )
+    run_summary_path.parent.mkdir(parents=True, exist_ok=True)
+    run_summary.to_parquet(run_summary_path, index=False)
+    print(run_summary["error"].notna().sum(), "well_fovs failed")
+    # record the split databases in the artifact catalog the completeness checks query
+    record_patient_artifacts(
+        catalog_path=get_artifact_catalog_path(f"{image_base_dir}/data"),
+        data_dir=f"{output_base_dir}/data",
+        stage="featurization",
+        patient=patient,
+    )
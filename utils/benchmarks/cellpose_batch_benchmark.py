@@ -0,0 +1,288 @@
+"""Benchmark batched Cellpose nuclei segmentation against one model.eval call per image."""
+
+import argparse
+import functools
+import pathlib
+import time
+from collections.abc import Callable
+
+import numpy as np
+import pandas as pd
+import skimage
+import tifffile
+from image_analysis_2D.segmentation_utils.nuclei_segmentation import (
+    load_nuclei_model,
+    segment_nuclei_images,
+    set_torch_threads,
+)
+
+
+def make_synthetic_nuclei_images(
+    n_images: int = 6,
+    shape: tuple[int, int] = (1024, 1024),
+    n_nuclei: int = 300,
+    seed: int = 0,
+) -> list[np.ndarray]:
+    """
+    Make equalized nuclei images with round, blurred nuclei on a noisy background.
+
+    Parameters
+    ----------
+    n_images : int, optional
+        Number of images, by default 6.
+    shape : tuple[int, int], optional
+        (Y, X) image shape, by default (1024, 1024).
+    n_nuclei : int, optional
+        Number of nuclei per image, by default 300.
+    seed : int, optional
+        Random seed, by default 0.
+
+    Returns
+    -------
+    list[np.ndarray]
+        The images, equalized like read_nuclei_image.
+    """
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(n_images):
+        image = rng.normal(200, 20, size=shape)
+        for y, x, radius in zip(
+            rng.integers(0, shape[0], n_nuclei),
+            rng.integers(0, shape[1], n_nuclei),
+            rng.integers(6, 14, n_nuclei),
+        ):
+            rows, columns = skimage.draw.disk((y, x), radius, shape=shape)
+            image[rows, columns] += 1500
+        image = skimage.filters.gaussian(image, sigma=2, preserve_range=True)
+        images.append(
+            skimage.exposure.equalize_adapthist(
+                image.clip(0, 65535).astype(np.uint16), clip_limit=0.02
+            )
+        )
+    return images
+
+
+def time_function(
+    function: Callable[[], list[np.ndarray]], repeats: int
+) -> tuple[float, list[np.ndarray]]:
+    """
+    Time a segmentation, returning the fastest time and its result.
+
+    Parameters
+    ----------
+    function : Callable[[], list[np.ndarray]]
+        The segmentation to time.
+    repeats : int
+        Number of timed calls.
+
+    Returns
+    -------
+    tuple[float, list[np.ndarray]]
+        The fastest time in seconds and the result.
+    """
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start_time)
+    return min(times), result
+
+
+def segment_in_batches(
+    model,
+    images: list[np.ndarray],
+    images_per_batch: int,
+    batch_size: int | None = None,
+) -> list[np.ndarray]:
+    """
+    Segment images with one ``model.eval`` call per ``images_per_batch`` images.
+
+    Parameters
+    ----------
+    model : cellpose.models.CellposeModel
+        Model from load_nuclei_model.
+    images : list[np.ndarray]
+        Equalized nuclei images.
+    images_per_batch : int
+        Number of images per model.eval call.
+    batch_size : int | None, optional
+        Number of tiles per forward pass, by default the Cellpose default.
+
+    Returns
+    -------
+    list[np.ndarray]
+        The label image of each image.
+    """
+    return [
+        label
+        for start in range(0, len(images), images_per_batch)
+        for label in segment_nuclei_images(
+            model, images[start : start + images_per_batch], batch_size=batch_size
+        )
+    ]
+
+
+def run_benchmark(
+    model,
+    images: list[np.ndarray],
+    images_per_batch: list[int],
+    batch_sizes: list[int | None],
+    threads: list[int | None],
+    repeats: int = 1,
+) -> pd.DataFrame:
+    """
+    Benchmark batched segmentation against one ``model.eval(image)`` per image.
+
+    Every batched result is compared with the single image result.
+
+    Parameters
+    ----------
+    model : cellpose.models.CellposeModel
+        Model from load_nuclei_model.
+    images : list[np.ndarray]
+        Equalized nuclei images.
+    images_per_batch : list[int]
+        Numbers of images per model.eval call to test.
+    batch_sizes : list[int | None]
+        Numbers of tiles per forward pass to test, None for the Cellpose
+        default.
+    threads : list[int | None]
+        torch thread counts to test, None for the torch default.
+    repeats : int, optional
+        Number of timed calls per configuration, by default 1.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per thread count and configuration, with the images per
+        minute and the speedup over the single image path.
+    """
+    # load the weights and warm up the network outside of the timed calls
+    model.eval(images[0])
+    records = []
+    for num_threads in threads:
+        num_threads = set_torch_threads(num_threads)
+        baseline_time, expected = time_function(
+            lambda: [model.eval(image)[0] for image in images], repeats
+        )
+        records.append(
+            {
+                "threads": num_threads,
+                "path": "single",
+                "images_per_batch": 1,
+                "batch_size": None,
+                "images_per_min": 60 * len(images) / baseline_time,
+                "speedup": 1.0,
+                "matches_single": True,
+            }
+        )
+        for n_images in images_per_batch:
+            for batch_size in batch_sizes:
+                batched_time, result = time_function(
+                    functools.partial(
+                        segment_in_batches,
+                        model,
+                        images,
+                        images_per_batch=n_images,
+                        batch_size=batch_size,
+                    ),
+                    repeats,
+                )
+                records.append(
+                    {
+                        "threads": num_threads,
+                        "path": "batched",
+                        "images_per_batch": n_images,
+                        "batch_size": batch_size,
+                        "images_per_min": 60 * len(images) / batched_time,
+                        "speedup": baseline_time / batched_time,
+                        "matches_single": all(
+                            np.array_equal(label, expected_label)
+                            for label, expected_label in zip(result, expected)
+                        ),
+                    }
+                )
+    return pd.DataFrame.from_records(records)
+
+
+def parse_benchmark_args() -> argparse.Namespace:
+    argparser = argparse.ArgumentParser(
+        description="Benchmark batched Cellpose nuclei segmentation."
+    )
+    argparser.add_argument(
+        "--images",
+        type=pathlib.Path,
+        nargs="+",
+        default=None,
+        help="405 images to segment, by default synthetic 1024x1024 images",
+    )
+    argparser.add_argument(
+        "--n-images",
+        type=int,
+        default=6,
+        help="Number of synthetic images",
+    )
+    argparser.add_argument(
+        "--images-per-batch",
+        type=int,
+        nargs="+",
+        default=[3, 6],
+        help="Numbers of images per model.eval call to test",
+    )
+    argparser.add_argument(
+        "--batch-size",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Numbers of tiles per forward pass to test, by default the Cellpose default",
+    )
+    argparser.add_argument(
+        "--threads",
+        type=int,
+        nargs="+",
+        default=None,
+        help="torch thread counts to test, by default the torch default",
+    )
+    argparser.add_argument(
+        "--gpu",
+        action="store_true",
+        help="Run the model on the GPU",
+    )
+    argparser.add_argument(
+        "--repeats",
+        type=int,
+        default=1,
+        help="Number of timed calls per configuration",
+    )
+    argparser.add_argument(
+        "--output",
+        type=pathlib.Path,
+        default=None,
+        help="Parquet file to save the results to",
+    )
+    return argparser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_benchmark_args()
+    if args.images is not None:
+        images = [
+            skimage.exposure.equalize_adapthist(
+                tifffile.imread(image_path), clip_limit=0.02
+            )
+            for image_path in args.images
+        ]
+    else:
+        images = make_synthetic_nuclei_images(n_images=args.n_images)
+    results = run_benchmark(
+        load_nuclei_model(use_GPU=args.gpu),
+        images,
+        images_per_batch=args.images_per_batch,
+        batch_sizes=args.batch_size if args.batch_size is not None else [None],
+        threads=args.threads if args.threads is not None else [None],
+        repeats=args.repeats,
+    )
+    with pd.option_context("display.width", 200, "display.max_rows", None):
+        print(results.round(2).to_string(index=False))
+    if args.output is not None:
+        results.to_parquet(args.output, index=False)
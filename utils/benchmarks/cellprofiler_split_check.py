@@ -0,0 +1,247 @@
+"""Check that splitting a chunk's CellProfiler database gives the databases of runs on each well_fov alone."""
+
+import argparse
+import contextlib
+import pathlib
+import sqlite3
+import subprocess
+import tempfile
+
+import numpy as np
+import pandas as pd
+from image_analysis_2D.cp_utils.cp_batch import (
+    compare_cellprofiler_sqlite,
+    get_pipeline_sqlite_name,
+    run_cellprofiler_batch,
+    split_cellprofiler_sqlite,
+)
+from image_analysis_2D.cp_utils.cp_parallel import build_cellprofiler_command
+
+# tables of an ExportToDatabase run with the "MyExpt_" prefix of the analysis pipelines
+SYNTHETIC_SCHEMA = [
+    'CREATE TABLE "MyExpt_Per_Image" (ImageNumber INTEGER PRIMARY KEY, '
+    "Image_Metadata_Well TEXT, Image_Metadata_Site TEXT, Image_Group_Number INTEGER, "
+    "Image_Group_Index INTEGER, Image_Count_Cells INTEGER, "
+    "Image_ExecutionTime_01Images REAL)",
+    'CREATE TABLE "MyExpt_Per_Cells" (ImageNumber INTEGER, '
+    "Cells_Number_Object_Number INTEGER, Cells_AreaShape_Area REAL, "
+    "PRIMARY KEY (ImageNumber, Cells_Number_Object_Number))",
+    'CREATE TABLE "MyExpt_Per_Experiment" (experiment_id INTEGER, '
+    "CellProfiler_Version TEXT, Run_Timestamp TEXT)",
+    'CREATE TABLE "MyExpt_Per_RelationshipTypes" (relationship_type_id INTEGER, '
+    "module_number INTEGER, relationship TEXT, object_name1 TEXT, object_name2 TEXT)",
+    'CREATE TABLE "MyExpt_Per_Relationships" (relationship_type_id INTEGER, '
+    "image_number1 INTEGER, object_number1 INTEGER, "
+    "image_number2 INTEGER, object_number2 INTEGER)",
+    'CREATE INDEX "MyExpt_Per_Relationships_index1" ON "MyExpt_Per_Relationships" '
+    "(image_number1, object_number1)",
+    'CREATE VIEW "MyExpt_Per_RelationshipsView" AS SELECT * FROM "MyExpt_Per_Relationships" '
+    'JOIN "MyExpt_Per_RelationshipTypes" USING (relationship_type_id)',
+]
+
+
+def write_synthetic_database(
+    sqlite_path: pathlib.Path, well_fovs: list[str], seed: int
+) -> None:
+    """
+    Write the database a CellProfiler run over the image sets of some well_fovs would export.
+
+    Each well_fov is one image set whose objects and relationships only depend on
+    the well_fov, so a run over several well_fovs and runs over each of them
+    differ in their image numbers, group indexes, execution times and timestamps.
+
+    Args:
+        sqlite_path (pathlib.Path): the database to write
+        well_fovs (list[str]): the ``{well}-{site}`` of the image sets, in run order
+        seed (int): random seed of the execution times and timestamps
+    """
+    rng = np.random.default_rng(seed)
+    with contextlib.closing(sqlite3.connect(sqlite_path)) as connection:
+        for sql in SYNTHETIC_SCHEMA:
+            connection.execute(sql)
+        connection.execute(
+            'INSERT INTO "MyExpt_Per_Experiment" VALUES (1, "4.2.8", ?)',
+            (f"2026-01-01T00:00:{rng.integers(60):02d}",),
+        )
+        connection.executemany(
+            'INSERT INTO "MyExpt_Per_RelationshipTypes" VALUES (?, ?, ?, ?, ?)',
+            [
+                (1, 7, "Parent", "Nuclei", "Cells"),
+                (2, 8, "Neighbors", "Cells", "Cells"),
+            ],
+        )
+        for image_number, well_fov in enumerate(well_fovs, start=1):
+            well, site = well_fov.split("-")
+            # objects depend on the well_fov only
+            well_fov_rng = np.random.default_rng(sum(map(ord, well_fov)))
+            number_of_cells = int(well_fov_rng.integers(3, 8))
+            connection.execute(
+                'INSERT INTO "MyExpt_Per_Image" VALUES (?, ?, ?, 1, ?, ?, ?)',
+                (
+                    image_number,
+                    well,
+                    site,
+                    image_number,
+                    number_of_cells,
+                    float(rng.random()),
+                ),
+            )
+            connection.executemany(
+                'INSERT INTO "MyExpt_Per_Cells" VALUES (?, ?, ?)',
+                [
+                    (image_number, object_number, float(well_fov_rng.random()))
+                    for object_number in range(1, number_of_cells + 1)
+                ],
+            )
+            connection.executemany(
+                'INSERT INTO "MyExpt_Per_Relationships" VALUES (?, ?, ?, ?, ?)',
+                [
+                    (1, image_number, object_number, image_number, object_number)
+                    for object_number in range(1, number_of_cells + 1)
+                ]
+                + [
+                    (2, image_number, object_number, image_number, object_number + 1)
+                    for object_number in range(1, number_of_cells)
+                ],
+            )
+        connection.commit()
+
+
+def check_synthetic_split(n_well_fovs: int = 5) -> pd.DataFrame:
+    """
+    Split a synthetic chunk database and compare it with synthetic single well_fov runs.
+
+    Args:
+        n_well_fovs (int, optional): number of well_fovs in the chunk (default is 5)
+
+    Returns:
+        pd.DataFrame: one row per well_fov with the tables that differ
+    """
+    well_fovs = [f"C{4 + index // 2}-{index % 2 + 1}" for index in range(n_well_fovs)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = pathlib.Path(tmp_dir)
+        write_synthetic_database(tmp_dir / "chunk.sqlite", well_fovs, seed=0)
+        written = split_cellprofiler_sqlite(
+            tmp_dir / "chunk.sqlite",
+            {well_fov: tmp_dir / "split" / well_fov for well_fov in well_fovs},
+        )
+        records = []
+        for seed, well_fov in enumerate(well_fovs, start=1):
+            expected_path = tmp_dir / "single" / well_fov / "chunk.sqlite"
+            expected_path.parent.mkdir(parents=True)
+            write_synthetic_database(expected_path, [well_fov], seed=seed)
+            records.append(
+                {
+                    "well_fov": well_fov,
+                    "different_tables": compare_cellprofiler_sqlite(
+                        written[well_fov], expected_path
+                    ),
+                }
+            )
+    return pd.DataFrame.from_records(records)
+
+
+def check_cellprofiler_split(
+    path_to_pipeline: pathlib.Path,
+    well_fov_dirs: list[pathlib.Path],
+    output_dir: pathlib.Path,
+    run_with_apptainer_interactive: pathlib.Path | None = None,
+) -> pd.DataFrame:
+    """
+    Run a pipeline over well_fovs in one chunk and on each well_fov alone and compare the databases.
+
+    Args:
+        path_to_pipeline (pathlib.Path): path to the CellProfiler .cppipe file
+        well_fov_dirs (list[pathlib.Path]): well_fov directories of a projection stage
+        output_dir (pathlib.Path): directory of the ``batched`` and ``single`` outputs
+        run_with_apptainer_interactive (pathlib.Path, optional): apptainer image to run CellProfiler in
+
+    Returns:
+        pd.DataFrame: one row per well_fov with the tables that differ
+    """
+    sqlite_name = get_pipeline_sqlite_name(path_to_pipeline)
+    run_cellprofiler_batch(
+        path_to_pipeline=path_to_pipeline,
+        well_fov_dirs=well_fov_dirs,
+        output_dir=output_dir / "batched",
+        run_name="split_check",
+        chunk_size=len(well_fov_dirs),
+        run_with_apptainer_interactive=run_with_apptainer_interactive,
+        log_dir=output_dir / "logs",
+    )
+    records = []
+    for well_fov_dir in well_fov_dirs:
+        single_dir = output_dir / "single" / well_fov_dir.name
+        single_dir.mkdir(parents=True, exist_ok=True)
+        subprocess.run(
+            build_cellprofiler_command(
+                path_to_pipeline=path_to_pipeline,
+                path_to_images=well_fov_dir,
+                path_to_output=single_dir,
+                run_with_apptainer_interactive=run_with_apptainer_interactive,
+            ),
+            check=True,
+            capture_output=True,
+        )
+        records.append(
+            {
+                "well_fov": well_fov_dir.name,
+                "different_tables": compare_cellprofiler_sqlite(
+                    output_dir / "batched" / well_fov_dir.name / sqlite_name,
+                    single_dir / sqlite_name,
+                ),
+            }
+        )
+    return pd.DataFrame.from_records(records)
+
+
+def parse_check_args() -> argparse.Namespace:
+    argparser = argparse.ArgumentParser(
+        description="Check that split chunk databases equal single well_fov runs."
+    )
+    argparser.add_argument(
+        "--pipeline",
+        type=pathlib.Path,
+        default=None,
+        help="CellProfiler pipeline to run, by default synthetic databases are checked",
+    )
+    argparser.add_argument(
+        "--well-fov-dirs",
+        type=pathlib.Path,
+        nargs="+",
+        default=None,
+        help="well_fov directories to run the pipeline on",
+    )
+    argparser.add_argument(
+        "--output-dir",
+        type=pathlib.Path,
+        default=pathlib.Path("cellprofiler_split_check"),
+        help="Directory of the CellProfiler outputs",
+    )
+    argparser.add_argument(
+        "--apptainer",
+        type=pathlib.Path,
+        default=None,
+        help="Apptainer image to run CellProfiler in",
+    )
+    return argparser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_check_args()
+    if args.pipeline is None:
+        results = check_synthetic_split()
+    else:
+        if args.well_fov_dirs is None:
+            raise ValueError("--well-fov-dirs is needed with --pipeline")
+        results = check_cellprofiler_split(
+            args.pipeline.resolve(),
+            [well_fov_dir.resolve() for well_fov_dir in args.well_fov_dirs],
+            args.output_dir.resolve(),
+            run_with_apptainer_interactive=args.apptainer,
+        )
+    print(results.to_string(index=False))
+    if any(
+        len(different_tables) > 0 for different_tables in results["different_tables"]
+    ):
+        raise SystemExit("Split databases differ from the single well_fov runs")
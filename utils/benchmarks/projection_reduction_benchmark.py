@@ -0,0 +1,210 @@
+"""Benchmark the threaded and numba z-reductions against the ndarray reductions."""
+
+import argparse
+import functools
+import pathlib
+import time
+from collections.abc import Callable
+
+import numpy as np
+import pandas as pd
+import tifffile
+from image_analysis_2D.projection_utils.reduction_kernels import (
+    get_reduction_output,
+    numba_available,
+    reduce_zstack,
+)
+from image_analysis_2D.projection_utils.zstack_projection import (
+    middle_n_slice_indices,
+)
+
+
+def make_synthetic_zstack(
+    shape: tuple[int, int, int] = (40, 2048, 2048), seed: int = 0
+) -> np.ndarray:
+    """
+    Make a uint16 z-stack with the background and noise of a raw stack.
+
+    Parameters
+    ----------
+    shape : tuple[int, int, int], optional
+        (Z, Y, X) z-stack shape, by default (40, 2048, 2048).
+    seed : int, optional
+        Random seed, by default 0.
+
+    Returns
+    -------
+    np.ndarray
+        The z-stack.
+    """
+    rng = np.random.default_rng(seed)
+    return rng.normal(500, 100, size=shape).clip(0, 65535).astype(np.uint16)
+
+
+def time_function(
+    function: Callable[[], np.ndarray], repeats: int
+) -> tuple[float, np.ndarray]:
+    """
+    Time a reduction, returning the fastest time and its result.
+
+    Parameters
+    ----------
+    function : Callable[[], np.ndarray]
+        The reduction to time.
+    repeats : int
+        Number of timed calls.
+
+    Returns
+    -------
+    tuple[float, np.ndarray]
+        The fastest time in seconds and the result.
+    """
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start_time)
+    return min(times), result
+
+
+def run_benchmark(
+    zstack: np.ndarray,
+    threads: list[int],
+    use_numba: bool,
+    n: int = 3,
+    repeats: int = 3,
+) -> pd.DataFrame:
+    """
+    Benchmark the reductions of a z-stack and of its middle n z-slices.
+
+    Every reduction is checked to be bit-identical to the ndarray reduction.
+
+    Parameters
+    ----------
+    zstack : np.ndarray
+        The (Z, Y, X) z-stack.
+    threads : list[int]
+        Thread counts to test.
+    use_numba : bool
+        Also test the numba kernels.
+    n : int, optional
+        Number of middle z-slices of the middle n projection, by default 3.
+    repeats : int, optional
+        Number of timed calls per configuration, by default 3.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per projection, reduction and backend.
+    """
+    inputs = {
+        "all_slices": zstack,
+        f"middle_{n}_slices": zstack[middle_n_slice_indices(zstack.shape[0], n=n)],
+    }
+    backends = [("numpy_threads", False)] + ([("numba", True)] if use_numba else [])
+    records = []
+    for projection, projection_input in inputs.items():
+        megabytes = projection_input.nbytes / 1024**2
+        for reduction in ["max", "mean", "sum"]:
+            baseline_time, expected = time_function(
+                functools.partial(getattr(projection_input, reduction), axis=0),
+                repeats,
+            )
+            records.append(
+                {
+                    "projection": projection,
+                    "reduction": reduction,
+                    "backend": "ndarray",
+                    "threads": 1,
+                    "MB_per_s": megabytes / baseline_time,
+                    "speedup": 1.0,
+                }
+            )
+            out = get_reduction_output(projection_input, reduction)
+            for backend, backend_uses_numba in backends:
+                if backend_uses_numba:
+                    # compile outside of the timed calls
+                    reduce_zstack(projection_input, reduction, out=out, use_numba=True)
+                for num_threads in threads:
+                    reduction_time, result = time_function(
+                        functools.partial(
+                            reduce_zstack,
+                            projection_input,
+                            reduction,
+                            out=out,
+                            num_threads=num_threads,
+                            use_numba=backend_uses_numba,
+                        ),
+                        repeats,
+                    )
+                    if result.tobytes() != expected.tobytes():
+                        raise ValueError(
+                            f"{backend} {reduction} with {num_threads} threads "
+                            "is not bit-identical to the ndarray reduction"
+                        )
+                    records.append(
+                        {
+                            "projection": projection,
+                            "reduction": reduction,
+                            "backend": backend,
+                            "threads": num_threads,
+                            "MB_per_s": megabytes / reduction_time,
+                            "speedup": baseline_time / reduction_time,
+                        }
+                    )
+    return pd.DataFrame.from_records(records)
+
+
+def parse_benchmark_args() -> argparse.Namespace:
+    argparser = argparse.ArgumentParser(
+        description="Benchmark the z-projection reductions."
+    )
+    argparser.add_argument(
+        "--zstack",
+        type=pathlib.Path,
+        default=None,
+        help="z-stack to benchmark, by default a synthetic 40x2048x2048 uint16 stack",
+    )
+    argparser.add_argument(
+        "--threads",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4, 8],
+        help="Thread counts to test",
+    )
+    argparser.add_argument(
+        "--no-numba",
+        action="store_true",
+        help="Skip the numba kernels even if numba is installed",
+    )
+    argparser.add_argument(
+        "--repeats",
+        type=int,
+        default=3,
+        help="Number of timed calls per configuration",
+    )
+    argparser.add_argument(
+        "--output",
+        type=pathlib.Path,
+        default=None,
+        help="Parquet file to save the results to",
+    )
+    return argparser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_benchmark_args()
+    if args.zstack is not None:
+        zstack = tifffile.imread(args.zstack)
+    else:
+        zstack = make_synthetic_zstack()
+    results = run_benchmark(
+        zstack,
+        threads=args.threads,
+        use_numba=numba_available() and not args.no_numba,
+        repeats=args.repeats,
+    )
+    with pd.option_context("display.width", 200, "display.max_rows", None):
+        print(results.round(2).to_string(index=False))
+    if args.output is not None:
+        results.to_parquet(args.output, index=False)
@@ -0,0 +1,210 @@
+"""Benchmark TIFF compression presets on 16-bit images and uint16 label masks."""
+
+import argparse
+import pathlib
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import skimage
+import tifffile
+from image_analysis_2D.file_utils.file_writing import (
+    TIFF_COMPRESSION_PRESETS,
+    write_tiff_atomic,
+)
+
+
+def make_synthetic_images(
+    shape: tuple[int, int] = (2048, 2048), seed: int = 0
+) -> dict[str, np.ndarray]:
+    """
+    Make a blob-like 16-bit image and its uint16 label mask.
+
+    Parameters
+    ----------
+    shape : tuple[int, int], optional
+        (Y, X) image shape, by default (2048, 2048).
+    seed : int, optional
+        Random seed, by default 0.
+
+    Returns
+    -------
+    dict[str, np.ndarray]
+        Mapping of image type to image.
+    """
+    rng = np.random.default_rng(seed)
+    blobs = skimage.data.binary_blobs(
+        length=max(shape), blob_size_fraction=0.02, rng=seed
+    )[: shape[0], : shape[1]]
+    signal = skimage.filters.gaussian(blobs.astype(np.float32), sigma=4)
+    image = 200 + 20_000 * signal + rng.normal(0, 50, size=shape)
+    return {
+        "image_16bit": np.clip(image, 0, 65535).astype(np.uint16),
+        "label_mask": skimage.measure.label(blobs).astype(np.uint16),
+    }
+
+
+def benchmark_write(
+    image: np.ndarray,
+    output_dir: pathlib.Path,
+    compression: str,
+    tile: tuple[int, int] | None,
+    maxworkers: int | None,
+    repeats: int = 3,
+) -> dict[str, float]:
+    """
+    Time writing and reading one image with one writer configuration.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        The image to write.
+    output_dir : pathlib.Path
+        Directory to write the benchmark files to.
+    compression : str
+        Name of a TIFF_COMPRESSION_PRESETS entry.
+    tile : tuple[int, int] | None
+        (Y, X) tile shape, None to write strips.
+    maxworkers : int | None
+        Number of encoding threads.
+    repeats : int, optional
+        Number of timed writes and reads, the fastest is reported, by default 3.
+
+    Returns
+    -------
+    dict[str, float]
+        Write and read throughput in MB/s and the compression ratio.
+    """
+    output_path = output_dir / f"benchmark_{compression}.tiff"
+    write_times, read_times = [], []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        write_tiff_atomic(
+            output_path,
+            image,
+            compression=compression,
+            tile=tile,
+            maxworkers=maxworkers,
+        )
+        write_times.append(time.perf_counter() - start_time)
+        start_time = time.perf_counter()
+        read_image = tifffile.imread(output_path, maxworkers=maxworkers)
+        read_times.append(time.perf_counter() - start_time)
+    if not np.array_equal(read_image, image):
+        raise ValueError(f"{compression} did not round trip the image losslessly")
+    megabytes = image.nbytes / 1024**2
+    return {
+        "write_MB_per_s": megabytes / min(write_times),
+        "read_MB_per_s": megabytes / min(read_times),
+        "compression_ratio": image.nbytes / output_path.stat().st_size,
+    }
+
+
+def run_benchmark(
+    images: dict[str, np.ndarray],
+    tiles: list[tuple[int, int] | None],
+    maxworkers_options: list[int | None],
+    repeats: int = 3,
+) -> pd.DataFrame:
+    """
+    Benchmark every compression preset, tile layout and thread count.
+
+    Parameters
+    ----------
+    images : dict[str, np.ndarray]
+        Mapping of image type to image.
+    tiles : list[tuple[int, int] | None]
+        Tile shapes to test, None for strips.
+    maxworkers_options : list[int | None]
+        Thread counts to test.
+    repeats : int, optional
+        Number of timed writes and reads per configuration, by default 3.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per image type and writer configuration.
+    """
+    records = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for image_type, image in images.items():
+            for compression in TIFF_COMPRESSION_PRESETS:
+                for tile in tiles:
+                    for maxworkers in maxworkers_options:
+                        records.append(
+                            {
+                                "image_type": image_type,
+                                "compression": compression,
+                                "tile": "strips"
+                                if tile is None
+                                else f"{tile[0]}x{tile[1]}",
+                                "maxworkers": maxworkers,
+                                **benchmark_write(
+                                    image,
+                                    pathlib.Path(tmp_dir),
+                                    compression=compression,
+                                    tile=tile,
+                                    maxworkers=maxworkers,
+                                    repeats=repeats,
+                                ),
+                            }
+                        )
+    return pd.DataFrame.from_records(records)
+
+
+def parse_benchmark_args() -> argparse.Namespace:
+    argparser = argparse.ArgumentParser(
+        description="Benchmark TIFF compression presets for the pipeline images."
+    )
+    argparser.add_argument(
+        "--image",
+        type=pathlib.Path,
+        default=None,
+        help="16-bit image to benchmark, by default a synthetic image",
+    )
+    argparser.add_argument(
+        "--mask",
+        type=pathlib.Path,
+        default=None,
+        help="uint16 label mask to benchmark, by default a synthetic mask",
+    )
+    argparser.add_argument(
+        "--maxworkers",
+        type=int,
+        nargs="+",
+        default=[1, 4],
+        help="Encoding thread counts to test",
+    )
+    argparser.add_argument(
+        "--repeats",
+        type=int,
+        default=3,
+        help="Number of timed writes and reads per configuration",
+    )
+    argparser.add_argument(
+        "--output",
+        type=pathlib.Path,
+        default=None,
+        help="Parquet file to save the results to",
+    )
+    return argparser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_benchmark_args()
+    images = make_synthetic_images()
+    if args.image is not None:
+        images["image_16bit"] = tifffile.imread(args.image)
+    if args.mask is not None:
+        images["label_mask"] = tifffile.imread(args.mask)
+    results = run_benchmark(
+        images,
+        tiles=[None, (256, 256)],
+        maxworkers_options=args.maxworkers,
+        repeats=args.repeats,
+    )
+    with pd.option_context("display.width", 200, "display.max_rows", None):
+        print(results.round(2).to_string(index=False))
+    if args.output is not None:
+        results.to_parquet(args.output, index=False)
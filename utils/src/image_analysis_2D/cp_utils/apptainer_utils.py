@@ -0,0 +1,137 @@
+"""
+This collection of functions starts a named apptainer instance of the CellProfiler image once, so CellProfiler
+runs are sent into the running container (``apptainer exec instance://<name>``) instead of each run setting up
+the container from the image. Without apptainer, CellProfiler is run as a plain subprocess.
+"""
+
+from __future__ import annotations
+
+import atexit
+import os
+import pathlib
+import shutil
+import signal
+import subprocess
+import sys
+from typing import Optional
+
+# environment variable holding the name of an instance started by the calling shell script,
+# e.g. once per SLURM job allocation, which is used and left running
+CELLPROFILER_INSTANCE_ENV_VAR = "CELLPROFILER_APPTAINER_INSTANCE"
+# prefix of the names of the instances started here
+CELLPROFILER_INSTANCE_PREFIX = "cellprofiler"
+
+
+def apptainer_available() -> bool:
+    """
+    Check if the apptainer command is on the PATH.
+
+    Returns:
+        bool: True if apptainer can be called
+    """
+    return shutil.which("apptainer") is not None
+
+
+def get_apptainer_instance_uri(instance_name: str) -> str:
+    """
+    Build the URI to pass to ``apptainer exec`` in place of an image to run in an instance.
+
+    Args:
+        instance_name (str): name of the apptainer instance
+
+    Returns:
+        str: ``instance://{instance_name}``
+    """
+    return f"instance://{instance_name}"
+
+
+def stop_apptainer_instance(instance_name: str) -> None:
+    """
+    Stop an apptainer instance, ignoring an instance that is already stopped.
+
+    Args:
+        instance_name (str): name of the apptainer instance
+    """
+    subprocess.run(
+        ["apptainer", "instance", "stop", instance_name],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=False,
+    )
+
+
+def _exit_on_sigterm(signum, frame) -> None:
+    """Exit on SIGTERM (e.g. a SLURM time limit or scancel) so the atexit teardown runs."""
+    sys.exit(128 + signum)
+
+
+def start_apptainer_instance(
+    path_to_apptainer_image: pathlib.Path,
+    instance_name: Optional[str] = None,
+) -> Optional[str]:
+    """
+    Start a named apptainer instance that is stopped when the Python process exits.
+
+    The instance binds the paths of ``APPTAINER_BINDPATH`` when it starts, as ``apptainer exec`` does.
+
+    Args:
+        path_to_apptainer_image (pathlib.Path): path to the CellProfiler .sif image
+        instance_name (str, optional): name of the instance (default is ``cellprofiler_{pid}``)
+
+    Returns:
+        Optional[str]: the instance URI to run CellProfiler in, None if the instance could not be started
+    """
+    if instance_name is None:
+        instance_name = f"{CELLPROFILER_INSTANCE_PREFIX}_{os.getpid()}"
+    result = subprocess.run(
+        ["apptainer", "instance", "start", str(path_to_apptainer_image), instance_name],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        check=False,
+    )
+    if result.returncode != 0:
+        print(f"Could not start apptainer instance {instance_name}: {result.stdout}")
+        return None
+    atexit.register(stop_apptainer_instance, instance_name)
+    # atexit does not run on SIGTERM by default, which would leave the instance running
+    if signal.getsignal(signal.SIGTERM) is signal.SIG_DFL:
+        signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    print(f"Started apptainer instance {instance_name}")
+    return get_apptainer_instance_uri(instance_name)
+
+
+def get_cellprofiler_container(
+    path_to_apptainer_image: Optional[pathlib.Path],
+    use_instance: bool = True,
+) -> Optional[str | pathlib.Path]:
+    """
+    Choose what CellProfiler runs in, to pass as ``run_with_apptainer_interactive``.
+
+    In order of preference: the instance named by ``CELLPROFILER_APPTAINER_INSTANCE``, an instance
+    started here, the image itself (``apptainer exec`` per run) and no container (plain subprocess).
+
+    Args:
+        path_to_apptainer_image (pathlib.Path, optional): path to the CellProfiler .sif image, None if there is no image
+        use_instance (bool, optional): run in an apptainer instance instead of per run containers (default is True)
+
+    Returns:
+        Optional[str | pathlib.Path]: an instance URI, the image path or None to run CellProfiler without apptainer
+    """
+    if path_to_apptainer_image is None:
+        return None
+    if not apptainer_available():
+        print("apptainer not found, running CellProfiler without apptainer.")
+        return None
+    if not use_instance:
+        return path_to_apptainer_image
+    if os.environ.get(CELLPROFILER_INSTANCE_ENV_VAR):
+        print(
+            f"Using apptainer instance {os.environ[CELLPROFILER_INSTANCE_ENV_VAR]} for CellProfiler runs."
+        )
+        return get_apptainer_instance_uri(os.environ[CELLPROFILER_INSTANCE_ENV_VAR])
+    instance_uri = start_apptainer_instance(path_to_apptainer_image)
+    if instance_uri is None:
+        print("Running CellProfiler with apptainer exec per run.")
+        return path_to_apptainer_image
+    return instance_uri
@@ -0,0 +1,442 @@
+"""
+This collection of functions runs CellProfiler once per chunk of well_fovs from a file list and splits the
+SQLite database of each chunk back into one database per well_fov.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import os
+import pathlib
+import re
+import shutil
+import sqlite3
+from typing import Dict, List, Optional
+
+import pandas as pd
+from image_analysis_2D.cp_utils.cp_parallel import (
+    build_cellprofiler_command,
+    estimate_cellprofiler_job_memory,
+    get_cellprofiler_log_path,
+    schedule_cellprofiler_jobs,
+)
+
+# number of well_fovs per CellProfiler process, larger chunks pay fewer
+# CellProfiler/JVM start ups but rerun more well_fovs when a chunk fails
+CELLPROFILER_BATCH_CHUNK_SIZE = 16
+# files the Images module of the pipelines keeps (images, but not "Merge" images)
+CELLPROFILER_IMAGE_EXTENSIONS = (".tif", ".tiff")
+# directory under a stage output directory holding the chunk runs until they are split
+CELLPROFILER_BATCH_DIR_NAME = "batches"
+# image number columns of the ExportToDatabase tables, ImageNumber in the per image
+# and per object tables and image_number1/image_number2 in Per_Relationships
+CELLPROFILER_IMAGE_NUMBER_COLUMN_PATTERN = r"ImageNumber\d*|image_number\d+"
+# columns that differ between any two runs of the same images
+CELLPROFILER_RUN_SPECIFIC_COLUMN_PATTERN = r".*(ExecutionTime|Timestamp).*"
+
+
+def get_pipeline_sqlite_name(path_to_pipeline: str | pathlib.Path) -> str:
+    """
+    Read the name of the SQLite database a pipeline's ExportToDatabase module writes.
+
+    Args:
+        path_to_pipeline (str | pathlib.Path): path to the CellProfiler .cppipe file
+
+    Raises:
+        ValueError: if the pipeline does not export to an SQLite database
+
+    Returns:
+        str: the database file name, e.g. ``gff_extracted_features_single-cell.sqlite``
+    """
+    match = re.search(
+        r"^\s*Name the SQLite database file:(.+)$",
+        pathlib.Path(path_to_pipeline).read_text(),
+        flags=re.MULTILINE,
+    )
+    if match is None:
+        raise ValueError(f"{path_to_pipeline} does not export to an SQLite database")
+    return match.group(1).strip()
+
+
+def get_cellprofiler_image_files(well_fov_dir: pathlib.Path) -> List[pathlib.Path]:
+    """
+    List the images of a well_fov that CellProfiler would load from its folder.
+
+    Args:
+        well_fov_dir (pathlib.Path): the well_fov directory of a projection stage
+
+    Returns:
+        List[pathlib.Path]: sorted image paths
+    """
+    return sorted(
+        image_file
+        for image_file in pathlib.Path(well_fov_dir).iterdir()
+        if image_file.suffix.lower() in CELLPROFILER_IMAGE_EXTENSIONS
+        and "Merge" not in image_file.name
+    )
+
+
+def chunk_well_fovs(
+    well_fov_dirs: List[pathlib.Path],
+    chunk_size: int = CELLPROFILER_BATCH_CHUNK_SIZE,
+) -> List[List[pathlib.Path]]:
+    """
+    Split well_fovs into chunks whose images can share one file list.
+
+    The pipelines match the images of an image set by order, so a chunk only
+    holds well_fovs with the same images (e.g. ``_405.tif`` ... ``_nuclei_mask.tiff``).
+    Well_fovs missing an image are chunked apart from the complete ones.
+
+    Args:
+        well_fov_dirs (List[pathlib.Path]): well_fov directories of a projection stage
+        chunk_size (int, optional): maximum number of well_fovs per chunk (default is CELLPROFILER_BATCH_CHUNK_SIZE)
+
+    Returns:
+        List[List[pathlib.Path]]: the chunks
+    """
+    image_set_groups: Dict[tuple, List[pathlib.Path]] = {}
+    for well_fov_dir in sorted(well_fov_dirs):
+        image_files = get_cellprofiler_image_files(well_fov_dir)
+        if len(image_files) == 0:
+            print(f"No images in {well_fov_dir}, skipping")
+            continue
+        image_set = tuple(
+            image_file.name.removeprefix(well_fov_dir.name)
+            for image_file in image_files
+        )
+        image_set_groups.setdefault(image_set, []).append(well_fov_dir)
+    return [
+        group[start : start + chunk_size]
+        for group in image_set_groups.values()
+        for start in range(0, len(group), max(1, chunk_size))
+    ]
+
+
+def write_file_list(
+    image_files: List[pathlib.Path], file_list_path: pathlib.Path
+) -> pathlib.Path:
+    """
+    Write the images of a chunk as a CellProfiler ``--file-list``, one path per line.
+
+    Args:
+        image_files (List[pathlib.Path]): the images
+        file_list_path (pathlib.Path): path of the text file to write
+
+    Returns:
+        pathlib.Path: the written file list
+    """
+    file_list_path = pathlib.Path(file_list_path)
+    file_list_path.parent.mkdir(parents=True, exist_ok=True)
+    file_list_path.write_text(
+        "".join(f"{pathlib.Path(image_file).resolve()}\n" for image_file in image_files)
+    )
+    return file_list_path
+
+
+def split_cellprofiler_sqlite(
+    sqlite_path: pathlib.Path,
+    output_dirs: Dict[str, pathlib.Path],
+    sqlite_name: Optional[str] = None,
+) -> Dict[str, pathlib.Path]:
+    """
+    Split the SQLite database of a chunk into one database per well_fov.
+
+    Image sets are assigned to well_fovs by their ``Image_Metadata_Well`` and
+    ``Image_Metadata_Site`` (``{Well}-{Site}``).
+    Every table, index and view is recreated in each database. Rows of tables with
+    image number columns (``ImageNumber``, and ``image_number1``/``image_number2`` in
+    Per_Relationships) are kept when all of them are image sets of the well_fov, and
+    the image numbers, and ``Image_Group_Index`` of the pipelines without groups, are
+    renumbered from 1, as a CellProfiler run on the well_fov alone numbers them.
+    The other tables (e.g. Per_Experiment, Per_RelationshipTypes) are copied whole.
+
+    Args:
+        sqlite_path (pathlib.Path): the SQLite database of the chunk
+        output_dirs (Dict[str, pathlib.Path]): output directory of each well_fov of the chunk
+        sqlite_name (str, optional): file name of the split databases (default is None, the chunk's file name)
+
+    Raises:
+        ValueError: if the database has no per image table with the well and site metadata
+
+    Returns:
+        Dict[str, pathlib.Path]: the database written for each well_fov found in the chunk database
+    """
+    sqlite_path = pathlib.Path(sqlite_path)
+    if sqlite_name is None:
+        sqlite_name = sqlite_path.name
+    written = {}
+    with contextlib.closing(sqlite3.connect(sqlite_path)) as connection:
+        schema = connection.execute(
+            "SELECT type, name, sql FROM sqlite_master "
+            "WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' "
+            "ORDER BY CASE type WHEN 'table' THEN 0 WHEN 'index' THEN 1 ELSE 2 END"
+        ).fetchall()
+        tables = [name for object_type, name, _ in schema if object_type == "table"]
+        image_number_columns = {
+            table: [
+                column[1]
+                for column in connection.execute(f'PRAGMA table_info("{table}")')
+                if re.fullmatch(CELLPROFILER_IMAGE_NUMBER_COLUMN_PATTERN, column[1])
+            ]
+            for table in tables
+        }
+        image_tables = [table for table in tables if table.endswith("Per_Image")]
+        if len(image_tables) != 1:
+            raise ValueError(f"Expected one per image table in {sqlite_path}")
+        try:
+            image_df = pd.read_sql(
+                "SELECT ImageNumber, Image_Metadata_Well, Image_Metadata_Site "
+                f'FROM "{image_tables[0]}"',
+                connection,
+            )
+        except pd.errors.DatabaseError as e:
+            raise ValueError(
+                f"{sqlite_path} has no Image_Metadata_Well/Image_Metadata_Site to split by"
+            ) from e
+        image_table_columns = [
+            column[1]
+            for column in connection.execute(f'PRAGMA table_info("{image_tables[0]}")')
+        ]
+        image_df["well_fov"] = (
+            image_df["Image_Metadata_Well"].astype(str)
+            + "-"
+            + image_df["Image_Metadata_Site"].astype(str)
+        )
+
+        for well_fov, well_fov_images in image_df.groupby("well_fov"):
+            if well_fov not in output_dirs:
+                print(f"{well_fov} in {sqlite_path} is not part of the chunk, skipping")
+                continue
+            output_path = pathlib.Path(output_dirs[well_fov]) / sqlite_name
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = output_path.with_name(f".{output_path.name}.{os.getpid()}.tmp")
+            try:
+                with contextlib.closing(sqlite3.connect(tmp_path)) as split_connection:
+                    for _, _, sql in schema:
+                        split_connection.execute(sql)
+                    split_connection.commit()
+                connection.execute("ATTACH DATABASE ? AS split", (str(tmp_path),))
+                connection.execute(
+                    "CREATE TEMP TABLE image_map (old INTEGER PRIMARY KEY, new INTEGER)"
+                )
+                connection.executemany(
+                    "INSERT INTO temp.image_map VALUES (?, ?)",
+                    [
+                        (int(image_number), new_image_number)
+                        for new_image_number, image_number in enumerate(
+                            sorted(well_fov_images["ImageNumber"]), start=1
+                        )
+                    ],
+                )
+                for table in tables:
+                    columns = image_number_columns[table]
+                    if len(columns) == 0:
+                        connection.execute(
+                            f'INSERT INTO split."{table}" SELECT * FROM main."{table}"'
+                        )
+                        continue
+                    # relationships between two image sets are kept when both are of the well_fov
+                    in_well_fov = " AND ".join(
+                        f'"{column}" IN (SELECT old FROM temp.image_map)'
+                        for column in columns
+                    )
+                    connection.execute(
+                        f'INSERT INTO split."{table}" SELECT * FROM main."{table}" '
+                        f"WHERE {in_well_fov}"
+                    )
+                    for column in columns:
+                        connection.execute(
+                            f'UPDATE split."{table}" SET "{column}" = '
+                            f'(SELECT new FROM temp.image_map WHERE old = "{column}")'
+                        )
+                # without groups, the group index of an image set is its image number
+                if "Image_Group_Index" in image_table_columns:
+                    connection.execute(
+                        f'UPDATE split."{image_tables[0]}" '
+                        "SET Image_Group_Index = ImageNumber"
+                    )
+                connection.commit()
+                connection.execute("DROP TABLE temp.image_map")
+                connection.execute("DETACH DATABASE split")
+                os.replace(tmp_path, output_path)
+            finally:
+                if tmp_path.exists():
+                    tmp_path.unlink()
+            written[well_fov] = output_path
+    return written
+
+
+def compare_cellprofiler_sqlite(
+    sqlite_path: pathlib.Path,
+    expected_sqlite_path: pathlib.Path,
+    ignore_column_pattern: str = CELLPROFILER_RUN_SPECIFIC_COLUMN_PATTERN,
+) -> List[str]:
+    """
+    Compare two CellProfiler databases table by table, e.g. a split database with a run on the well_fov alone.
+
+    Rows are compared regardless of their order, and columns that differ between
+    any two runs (execution times and timestamps) are left out.
+
+    Args:
+        sqlite_path (pathlib.Path): the database to check
+        expected_sqlite_path (pathlib.Path): the expected database
+        ignore_column_pattern (str, optional): regular expression of the columns to leave out
+            (default is CELLPROFILER_RUN_SPECIFIC_COLUMN_PATTERN)
+
+    Returns:
+        List[str]: the tables that are missing from either database or whose columns or rows differ
+    """
+    table_query = "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+    with (
+        contextlib.closing(sqlite3.connect(sqlite_path)) as connection,
+        contextlib.closing(
+            sqlite3.connect(expected_sqlite_path)
+        ) as expected_connection,
+    ):
+        tables = {name for (name,) in connection.execute(table_query)}
+        expected_tables = {name for (name,) in expected_connection.execute(table_query)}
+        different_tables = sorted(tables ^ expected_tables)
+        for table in sorted(tables & expected_tables):
+            table_dfs = []
+            for table_connection in (connection, expected_connection):
+                table_df = pd.read_sql(f'SELECT * FROM "{table}"', table_connection)
+                table_df = table_df.drop(
+                    columns=[
+                        column
+                        for column in table_df.columns
+                        if re.fullmatch(ignore_column_pattern, column)
+                    ]
+                )
+                if len(table_df.columns) > 0:
+                    table_df = table_df.sort_values(list(table_df.columns))
+                table_dfs.append(table_df.reset_index(drop=True))
+            if not table_dfs[0].equals(table_dfs[1]):
+                different_tables.append(table)
+    return different_tables
+
+
+def run_cellprofiler_batch(
+    path_to_pipeline: pathlib.Path,
+    well_fov_dirs: List[pathlib.Path],
+    output_dir: pathlib.Path,
+    run_name: str,
+    chunk_size: int = CELLPROFILER_BATCH_CHUNK_SIZE,
+    run_with_apptainer_interactive: Optional[pathlib.Path] = None,
+    max_jobs: Optional[int] = None,
+    memory_fraction: float = 0.8,
+    log_dir: pathlib.Path = pathlib.Path("./logs"),
+) -> pd.DataFrame:
+    """
+    Run a pipeline over many well_fovs with one CellProfiler process per chunk.
+
+    Each chunk's images are written to a file list and run with ``--file-list``
+    into ``{output_dir}/batches/{run_name}_{chunk}``; chunks run concurrently as
+    the CPUs and free memory allow (see cp_parallel.schedule_cellprofiler_jobs).
+    The database of each finished chunk is split into
+    ``{output_dir}/{well_fov}/{sqlite name}``, the layout of per well_fov runs,
+    and the chunk directory is removed.
+    Chunks that fail are kept for inspection and their well_fovs are reported.
+
+    Args:
+        path_to_pipeline (pathlib.Path): path to the CellProfiler .cppipe file (must export to SQLite)
+        well_fov_dirs (List[pathlib.Path]): well_fov directories of a projection stage to run
+        output_dir (pathlib.Path): output directory of the stage, holding one directory per well_fov
+        run_name (str): a given name for the run, used for the chunk directories and logs
+        chunk_size (int, optional): maximum number of well_fovs per CellProfiler process (default is CELLPROFILER_BATCH_CHUNK_SIZE)
+        run_with_apptainer_interactive (pathlib.Path | str, optional): apptainer image or instance URI to run CellProfiler in
+            (default is None)
+        max_jobs (int, optional): upper bound on the number of concurrent chunks (default is None, the number of available CPUs)
+        memory_fraction (float, optional): fraction of the available memory the chunks may use (default is 0.8)
+        log_dir (pathlib.Path, optional): directory for log files (default is ./logs)
+
+    Returns:
+        pd.DataFrame: one row per well_fov with the chunk, its return code, the split database and any error
+    """
+    output_dir = pathlib.Path(output_dir)
+    sqlite_name = get_pipeline_sqlite_name(path_to_pipeline)
+    chunks = chunk_well_fovs(well_fov_dirs, chunk_size)
+    jobs = []
+    for chunk_number, chunk in enumerate(chunks):
+        chunk_name = f"{run_name}_{chunk_number:04d}"
+        chunk_dir = output_dir / CELLPROFILER_BATCH_DIR_NAME / chunk_name
+        # start from an empty chunk directory, ExportToDatabase never overwrites
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+        file_list = write_file_list(
+            [
+                image_file
+                for well_fov_dir in chunk
+                for image_file in get_cellprofiler_image_files(well_fov_dir)
+            ],
+            chunk_dir / "file_list.txt",
+        )
+        jobs.append(
+            {
+                "name": chunk_name,
+                "command": build_cellprofiler_command(
+                    path_to_pipeline=path_to_pipeline,
+                    path_to_images=None,
+                    path_to_output=chunk_dir,
+                    run_with_apptainer_interactive=run_with_apptainer_interactive,
+                    file_list=file_list,
+                ),
+                # image sets are processed one at a time, so a chunk needs the memory of one well_fov
+                "memory": estimate_cellprofiler_job_memory(chunk[0]),
+                "log_file": get_cellprofiler_log_path(log_dir, run_name, chunk_name),
+            }
+        )
+
+    job_records = schedule_cellprofiler_jobs(
+        jobs,
+        max_jobs=max_jobs,
+        memory_fraction=memory_fraction,
+        summary_path=pathlib.Path(log_dir) / f"{run_name}_run_summary.parquet",
+    )
+
+    records = []
+    for chunk, job, job_record in zip(chunks, jobs, job_records):
+        chunk_dir = output_dir / CELLPROFILER_BATCH_DIR_NAME / job["name"]
+        output_dirs = {
+            well_fov_dir.name: output_dir / well_fov_dir.name for well_fov_dir in chunk
+        }
+        written = {}
+        error = None
+        if job_record["returncode"] != 0:
+            error = f"CellProfiler returned {job_record['returncode']}, see {job_record['log_file']}"
+        else:
+            try:
+                written = split_cellprofiler_sqlite(
+                    chunk_dir / sqlite_name, output_dirs, sqlite_name
+                )
+            except (OSError, ValueError, sqlite3.Error, pd.errors.DatabaseError) as e:
+                error = f"{type(e).__name__}: {e}"
+        for well_fov in output_dirs:
+            records.append(
+                {
+                    "well_fov": well_fov,
+                    "chunk": job["name"],
+                    "returncode": job_record["returncode"],
+                    "sqlite_file": (
+                        str(written[well_fov]) if well_fov in written else None
+                    ),
+                    "error": (
+                        error
+                        if error is not None or well_fov in written
+                        else f"No image set of {well_fov} in {chunk_dir / sqlite_name}"
+                    ),
+                }
+            )
+        if error is None and len(written) == len(output_dirs):
+            shutil.rmtree(chunk_dir)
+    batch_dir = output_dir / CELLPROFILER_BATCH_DIR_NAME
+    if batch_dir.is_dir() and not any(batch_dir.iterdir()):
+        batch_dir.rmdir()
+    run_summary = pd.DataFrame.from_records(
+        records, columns=["well_fov", "chunk", "returncode", "sqlite_file", "error"]
+    )
+    print(
+        f"Split outputs for {run_summary['sqlite_file'].notna().sum()} of "
+        f"{len(run_summary)} well_fovs into {output_dir}"
+    )
+    for error in run_summary["error"].dropna().unique():
+        print(f"Failed: {error}")
+    return run_summary
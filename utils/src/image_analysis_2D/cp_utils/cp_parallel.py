@@ -1,80 +1,375 @@
 """
-This collection of functions runs CellProfiler in parallel and can convert the results into log files
-for each process.
+This collection of functions runs CellProfiler in parallel, streaming the output of each process into
+its own log file and summarizing the runs.
+CellProfiler children are launched directly and admitted by the free memory of the node.
 """
 
-import logging
-import multiprocessing
+from __future__ import annotations
+
+import collections
+import datetime
 import os
 import pathlib
 import subprocess
-from concurrent.futures import Future, ProcessPoolExecutor
-from typing import List
+import time
+from collections.abc import Callable
+from typing import List, Optional
+
+import pandas as pd
+import psutil
+import tqdm
+from image_analysis_2D.file_utils.file_writing import write_parquet_atomic
+from image_analysis_2D.parallel_utils.parallel_utils import (
+    get_available_memory,
+    get_max_workers,
+    get_process_tree_rss,
+)
+
+# memory of a CellProfiler child before it loads any image (Python, JVM and pipeline)
+CELLPROFILER_BASELINE_MEMORY = 2 * 1024**3
+# CellProfiler holds the channels of an image set as float64 (4x a uint16 TIFF)
+# plus the intermediate images and objects of the pipeline
+CELLPROFILER_IMAGE_MEMORY_FACTOR = 16
+# number of channels of an image set
+CELLPROFILER_NUMBER_OF_CHANNELS = 5
 
 
-def results_to_log(
-    results: List[subprocess.CompletedProcess], log_dir: pathlib.Path, run_name: str
-) -> None:
+def get_cellprofiler_log_path(
+    log_dir: pathlib.Path, run_name: str, name: str
+) -> pathlib.Path:
     """
-    This function will take the list of subprocess.results from a CellProfiler parallelization run and
-    convert into a log file for each process.
+    Build the path of the log file of one CellProfiler run.
 
     Args:
-        results (List[subprocess.CompletedProcess]): the outputs from a subprocess.run
         log_dir (pathlib.Path): directory for log files
         run_name (str): a given name for the type of CellProfiler run being done on the plates (example: whole image features)
+        name (str): name of the plate or run
+
+    Returns:
+        pathlib.Path: ``{log_dir}/{run_name}_{name}.log``
+    """
+    return pathlib.Path(log_dir) / f"{run_name}_{name}.log"
+
+
+def summarize_cellprofiler_runs(job_records: List[dict]) -> pd.DataFrame:
+    """
+    Convert the records of CellProfiler runs into a summary table.
+
+    Args:
+        job_records (List[dict]): records returned by schedule_cellprofiler_jobs
+
+    Returns:
+        pd.DataFrame: one row per run with the name, return code, start time, duration, peak resident memory and log file
     """
-    # Set up logging format
-    log_format = "[%(asctime)s] [Process ID: %(process)d] %(message)s"
+    return pd.DataFrame.from_records(
+        [
+            {
+                "name": job_record["name"],
+                "returncode": job_record["returncode"],
+                "start_time": job_record["start_time"],
+                "duration_seconds": job_record["duration_seconds"],
+                "peak_rss_gb": job_record["peak_rss_bytes"] / 1024**3,
+                "log_file": (
+                    None
+                    if job_record["log_file"] is None
+                    else str(job_record["log_file"])
+                ),
+            }
+            for job_record in job_records
+        ],
+        columns=[
+            "name",
+            "returncode",
+            "start_time",
+            "duration_seconds",
+            "peak_rss_gb",
+            "log_file",
+        ],
+    )
+
 
-    # Run through each result to make individual log files
-    for result in results:
-        plate_name = result.args[6].name
-        output_string = result.stderr.decode("utf-8")
+def build_cellprofiler_command(
+    path_to_pipeline: str | pathlib.Path,
+    path_to_images: Optional[str | pathlib.Path],
+    path_to_output: str | pathlib.Path,
+    run_with_apptainer_interactive: Optional[pathlib.Path] = None,
+    plugins_directory: Optional[str | pathlib.Path] = None,
+    file_list: Optional[str | pathlib.Path] = None,
+) -> List[str]:
+    """
+    Build the command line of a headless CellProfiler run.
+
+    Args:
+        path_to_pipeline (str | pathlib.Path): path to the CellProfiler .cppipe file
+        path_to_images (str | pathlib.Path, optional): path to the input folder with the images, None with a file list
+        path_to_output (str | pathlib.Path): path to the output folder
+        run_with_apptainer_interactive (pathlib.Path | str, optional): apptainer image or instance URI to run CellProfiler in
+            (default is None)
+        plugins_directory (str | pathlib.Path, optional): directory of CellProfiler plugin modules (default is None)
+        file_list (str | pathlib.Path, optional): text file listing the images to run on, one per line,
+            used instead of the input folder (default is None)
 
-        # Set up a unique logger for each plate/process
-        logger = logging.getLogger(f"logger_{plate_name}")
-        log_file_path = log_dir / f"{run_name}_run.log"
+    Returns:
+        List[str]: the command
+    """
+    command = [
+        "cellprofiler",
+        "-c",
+        "-r",
+        "-p",
+        str(path_to_pipeline),
+    ]
+    if file_list is not None:
+        command.extend(["--file-list", str(file_list)])
+    else:
+        command.extend(["-i", str(path_to_images)])
+    command.extend(["-o", str(path_to_output)])
+    if run_with_apptainer_interactive:
+        command = [
+            "apptainer",
+            "exec",
+            str(run_with_apptainer_interactive),
+        ] + command
+    if plugins_directory is not None:
+        command.extend(["--plugins-directory", str(plugins_directory)])
+    return command
 
-        # Create file handler for the current process's log file
-        file_handler = logging.FileHandler(log_file_path)
-        file_handler.setFormatter(logging.Formatter(log_format))
-        logger.addHandler(file_handler)
-        logger.setLevel(logging.INFO)
 
-        # Log the results
-        logger.info(f"Plate Name: {plate_name}")
-        logger.info(f"Output String: {output_string}")
+def estimate_cellprofiler_job_memory(
+    path_to_images: str | pathlib.Path,
+    baseline_memory: int = CELLPROFILER_BASELINE_MEMORY,
+    image_memory_factor: int = CELLPROFILER_IMAGE_MEMORY_FACTOR,
+    number_of_channels: int = CELLPROFILER_NUMBER_OF_CHANNELS,
+) -> int:
+    """
+    Estimate the peak memory of a CellProfiler run from the size of its images.
 
-        # Clean up to prevent logging duplication
-        logger.removeHandler(file_handler)
-        file_handler.close()
+    Args:
+        path_to_images (str | pathlib.Path): path to the input folder with the images
+        baseline_memory (int, optional): memory in bytes before any image is loaded (default is CELLPROFILER_BASELINE_MEMORY)
+        image_memory_factor (int, optional): memory per byte of an image set on disk (default is CELLPROFILER_IMAGE_MEMORY_FACTOR)
+        number_of_channels (int, optional): number of images per image set (default is CELLPROFILER_NUMBER_OF_CHANNELS)
+
+    Returns:
+        int: estimated peak memory in bytes, using the largest images as one image set
+    """
+    image_sizes = sorted(
+        image_file.stat().st_size
+        for image_file in pathlib.Path(path_to_images).rglob("*.tif*")
+    )
+    return baseline_memory + image_memory_factor * sum(
+        image_sizes[-number_of_channels:]
+    )
+
+
+def schedule_cellprofiler_jobs(
+    jobs: List[dict],
+    max_jobs: Optional[int] = None,
+    memory_fraction: float = 0.8,
+    poll_interval: float = 1.0,
+    metrics_callback: Optional[Callable[[dict], None]] = None,
+    summary_path: Optional[pathlib.Path] = None,
+) -> List[dict]:
+    """
+    Run CellProfiler children concurrently, admitting them by free memory.
+
+    Jobs are started in order with subprocess.Popen while fewer than
+    ``max_jobs`` run and the available memory, less what the running jobs
+    are still expected to allocate, fits the next job's memory estimate.
+    One job always runs so a large job cannot stall the queue.
+    The estimate of the remaining jobs is raised to the largest peak
+    resident memory measured so far, and completions are handled as they
+    happen rather than in submission order.
+    The stdout and stderr of each child are written straight to its log
+    file as it runs, so logs can be followed before the run finishes and
+    no output is held in memory.
+
+    Args:
+        jobs (List[dict]): jobs with a ``name``, a ``command``, an estimated ``memory`` in bytes and optionally
+            a ``log_file`` (output is discarded without one)
+        max_jobs (int, optional): upper bound on the number of concurrent jobs (default is None, the number of available CPUs)
+        memory_fraction (float, optional): fraction of the available memory the jobs may use (default is 0.8)
+        poll_interval (float, optional): seconds between polls of the running jobs (default is 1.0)
+        metrics_callback (Callable[[dict], None], optional): called after every poll with the queue and running metrics
+            (``queued``, ``running``, ``completed``, ``failed``, ``running_jobs``, ``available_memory_gb``,
+            ``reserved_memory_gb``, ``running_rss_gb`` and ``job_memory_gb``), by default they are shown on a progress bar
+        summary_path (pathlib.Path, optional): parquet file rewritten with the summary of the finished runs
+            (see summarize_cellprofiler_runs) after every completion (default is None)
+
+    Raises:
+        MaxWorkerError: if max_jobs exceeds the number of available CPUs
+
+    Returns:
+        List[dict]: per job in submission order the ``name``, ``command``, ``returncode``, ``start_time``,
+        ``duration_seconds``, ``peak_rss_bytes`` and ``log_file``
+    """
+    max_jobs = get_max_workers(max_jobs, name="max_jobs")
+    queue = collections.deque(jobs)
+    running = {}
+    completed = {}
+    number_failed = 0
+    # largest peak resident memory of a finished job
+    observed_job_memory = 0
+    progress_bar = (
+        tqdm.tqdm(total=len(jobs), desc="CellProfiler runs")
+        if metrics_callback is None
+        else None
+    )
+    try:
+        while queue or running:
+            # admit jobs while the memory they still need fits
+            available_memory = get_available_memory(memory_fraction)
+            reserved_memory = sum(
+                max(0, job["memory"] - job["peak_rss_bytes"])
+                for job in running.values()
+            )
+            while queue and len(running) < max_jobs:
+                job_memory = max(queue[0]["memory"], observed_job_memory)
+                if running and reserved_memory + job_memory > available_memory:
+                    break
+                job = queue.popleft()
+                log_file = job.get("log_file")
+                if log_file is not None:
+                    pathlib.Path(log_file).parent.mkdir(parents=True, exist_ok=True)
+                    log_handle = open(log_file, "w")
+                    log_handle.write(f"# {' '.join(job['command'])}\n")
+                    log_handle.flush()
+                else:
+                    log_handle = None
+                running[job["name"]] = {
+                    "command": job["command"],
+                    "memory": job_memory,
+                    "log_file": log_file,
+                    "log_handle": log_handle,
+                    # the child writes to the file itself, nothing passes through this process
+                    "process": subprocess.Popen(
+                        job["command"],
+                        stdout=subprocess.DEVNULL if log_handle is None else log_handle,
+                        stderr=subprocess.STDOUT,
+                    ),
+                    "start_time": time.time(),
+                    "peak_rss_bytes": 0,
+                }
+                running[job["name"]]["psutil_process"] = psutil.Process(
+                    running[job["name"]]["process"].pid
+                )
+                reserved_memory += job_memory
+
+            time.sleep(poll_interval)
+
+            running_rss = 0
+            for name, job in list(running.items()):
+                rss = get_process_tree_rss(job["psutil_process"])
+                running_rss += rss
+                job["peak_rss_bytes"] = max(job["peak_rss_bytes"], rss)
+                returncode = job["process"].poll()
+                if returncode is None:
+                    continue
+                if job["log_handle"] is not None:
+                    job["log_handle"].close()
+                completed[name] = {
+                    "name": name,
+                    "command": job["command"],
+                    "returncode": returncode,
+                    "start_time": datetime.datetime.fromtimestamp(job["start_time"]),
+                    "duration_seconds": time.time() - job["start_time"],
+                    "peak_rss_bytes": job["peak_rss_bytes"],
+                    "log_file": job["log_file"],
+                }
+                observed_job_memory = max(observed_job_memory, job["peak_rss_bytes"])
+                number_failed += returncode != 0
+                del running[name]
+                if progress_bar is not None:
+                    progress_bar.update(1)
+                if summary_path is not None:
+                    write_parquet_atomic(
+                        summarize_cellprofiler_runs(list(completed.values())),
+                        summary_path,
+                    )
+
+            reserved_memory = sum(
+                max(0, job["memory"] - job["peak_rss_bytes"])
+                for job in running.values()
+            )
+            metrics = {
+                "queued": len(queue),
+                "running": len(running),
+                "completed": len(completed),
+                "failed": number_failed,
+                "running_jobs": sorted(running),
+                "available_memory_gb": psutil.virtual_memory().available / 1024**3,
+                "reserved_memory_gb": reserved_memory / 1024**3,
+                "running_rss_gb": running_rss / 1024**3,
+                "job_memory_gb": max(
+                    [job["memory"] for job in running.values()] + [observed_job_memory]
+                )
+                / 1024**3,
+            }
+            if metrics_callback is not None:
+                metrics_callback(metrics)
+            else:
+                progress_bar.set_postfix(
+                    queued=metrics["queued"],
+                    running=metrics["running"],
+                    failed=metrics["failed"],
+                    rss_gb=round(metrics["running_rss_gb"], 1),
+                    free_gb=round(metrics["available_memory_gb"], 1),
+                )
+    finally:
+        # do not leave children running if the scheduler is interrupted
+        for job in running.values():
+            job["process"].kill()
+            job["process"].wait()
+            if job["log_handle"] is not None:
+                job["log_handle"].close()
+        if progress_bar is not None:
+            progress_bar.close()
+    return [completed[job["name"]] for job in jobs]
 
 
 def run_cellprofiler_parallel(
     plate_info_dictionary: dict,
     run_name: str,
-    run_with_apptainer_interactive: Optional[pathlib.Path | None] = None,
-) -> None:
+    run_with_apptainer_interactive: Optional[pathlib.Path] = None,
+    max_jobs: Optional[int] = None,
+    per_job_memory: Optional[int] = None,
+    memory_fraction: float = 0.8,
+    metrics_callback: Optional[Callable[[dict], None]] = None,
+    log_dir: pathlib.Path = pathlib.Path("./logs"),
+) -> List[dict]:
     """
-    This function utilizes multi-processing to run CellProfiler pipelines in parallel.
+    This function runs CellProfiler pipelines in parallel, as many at a time as the CPUs and free memory allow.
+    The output of each run is streamed into ``{log_dir}/{run_name}_{plate_name}.log`` while it runs and a summary
+    of the finished runs (return code, duration and peak resident memory) is kept up to date in
+    ``{log_dir}/{run_name}_run_summary.parquet``.
 
     Args:
         plate_info_dictionary (dict): dictionary with all paths for CellProfiler to run a pipeline
         run_name (str): a given name for the type of CellProfiler run being done on the plates (example: whole image features)
+        run_with_apptainer_interactive (pathlib.Path | str, optional): apptainer image or instance URI to run CellProfiler in
+            (default is None)
+        max_jobs (int, optional): upper bound on the number of concurrent runs (default is None, the number of available CPUs)
+        per_job_memory (int, optional): memory estimate of one run in bytes
+            (default is None, estimated from the images of each run with estimate_cellprofiler_job_memory)
+        memory_fraction (float, optional): fraction of the available memory the runs may use (default is 0.8)
+        metrics_callback (Callable[[dict], None], optional): receives the live queue and running metrics
+            (see schedule_cellprofiler_jobs), by default they are shown on a progress bar
+        log_dir (pathlib.Path, optional): directory for log files (default is ./logs)
 
     Raises:
         FileNotFoundError: if paths to pipeline and images do not exist
+
+    Returns:
+        List[dict]: the per run records of schedule_cellprofiler_jobs
     """
-    # create a list of commands for each plate with their respective log file
-    commands = []
+    # create a list of jobs for each plate with their respective command
+    jobs = []
 
     # make logs directory
-    log_dir = pathlib.Path("./logs")
     os.makedirs(log_dir, exist_ok=True)
 
     # iterate through each plate in the dictionary
-    for _, info in plate_info_dictionary.items():
+    for plate_name, info in plate_info_dictionary.items():
         # set paths for CellProfiler
         path_to_pipeline = info["path_to_pipeline"]
         path_to_images = info["path_to_images"]
@@ -92,74 +387,44 @@ def run_cellprofiler_parallel(
         # make output directory if it is not already created
         pathlib.Path(path_to_output).mkdir(exist_ok=True, parents=True)
 
-        # Build command for each plate
-        command = (
-            [
-                "apptainer",
-                "exec",
-                str(run_with_apptainer_interactive),
-                "cellprofiler",
-                "-c",
-                "-r",
-                "-p",
-                path_to_pipeline,
-                "-i",
-                path_to_input,
-                "-o",
-                path_to_output,
-            ]
-            if run_with_apptainer_interactive
-            else [
-                "cellprofiler",
-                "-c",
-                "-r",
-                "-p",
-                path_to_pipeline,
-                "-i",
-                path_to_input,
-                "-o",
-                path_to_output,
-            ]
+        # Build command for each plate, with a plugin directory if using a plugin module in pipeline (must be include in dict)
+        jobs.append(
+            {
+                "name": plate_name,
+                "command": build_cellprofiler_command(
+                    path_to_pipeline=path_to_pipeline,
+                    path_to_images=path_to_images,
+                    path_to_output=path_to_output,
+                    run_with_apptainer_interactive=run_with_apptainer_interactive,
+                    plugins_directory=info.get("plugins_directory"),
+                ),
+                "memory": (
+                    per_job_memory
+                    if per_job_memory is not None
+                    else estimate_cellprofiler_job_memory(path_to_images)
+                ),
+                "log_file": get_cellprofiler_log_path(log_dir, run_name, plate_name),
+            }
         )
-        # add extension to command if using a plugin module in pipeline (must be include in dict)
-        if "plugins_directory" in info:
-            command.extend(["--plugins-directory", info["plugins_directory"]])
-        commands.append(command)
-
-    # set the number of CPUs/workers as the number of commands
-    num_processes = len(commands)
-
-    # make sure that the number of workers does not exceed the maximum number of workers for the machine
-    if num_processes > multiprocessing.cpu_count():
-        num_processes = multiprocessing.cpu_count()
-
-    # set parallelization executer to the number of commands
-    executor = ProcessPoolExecutor(max_workers=num_processes)
-
-    # creates a list of futures that are each CellProfiler process for each plate
-    futures: List[Future] = [
-        executor.submit(
-            subprocess.run,
-            args=command,
-            capture_output=True,
-        )
-        for command in commands
-    ]
 
-    # the list of CompletedProcesses holds all the information from the CellProfiler run
-    results: List[subprocess.CompletedProcess] = [future.result() for future in futures]
+    # run the plates as the CPUs and free memory allow, handling each as it completes
+    job_records = schedule_cellprofiler_jobs(
+        jobs,
+        max_jobs=max_jobs,
+        memory_fraction=memory_fraction,
+        metrics_callback=metrics_callback,
+        summary_path=log_dir / f"{run_name}_run_summary.parquet",
+    )
 
     print("All processes have been completed!")
 
-    # for each process, confirm that the process completed successfully and return a log file
-    for result in results:
-        plate_name = result.args[6].name
-        # convert the results into log files
-        results_to_log(results=results, log_dir=log_dir, run_name=run_name)
-        if result.returncode == 1:
+    # for each process, confirm that the process completed successfully
+    for job_record in job_records:
+        if job_record["returncode"] != 0:
             print(
-                f"A return code of {result.returncode} was returned for {plate_name}, which means there was an error in the CellProfiler run."
+                f"A return code of {job_record['returncode']} was returned for {job_record['name']}, which means there was an error in the CellProfiler run. "
+                f"See {job_record['log_file']}"
             )
 
-    # to avoid having multiple print statements due to for loop, confirmation that logs are converted is printed here
-    print("All results have been converted to log files!")
+    print(f"Logs and the run summary are in {log_dir}")
+    return job_records
@@ -12,6 +12,8 @@ import pathlib
 import subprocess
 from typing import Optional
 
+from image_analysis_2D.cp_utils.cp_worker_pool import run_cellprofiler_in_worker_pool
+
 
 def rename_sqlite_file(
     sqlite_dir_path: pathlib.Path, name: str, hardcode_sqlite_name: str
@@ -57,6 +59,7 @@ def run_cellprofiler(
     analysis_run: Optional[bool | False] = False,
     rename_sqlite_file_bool: Optional[bool | False] = False,
     log_file_name: Optional[str | None] = None,
+    worker_pool: Optional[dict | None] = None,
 ):
     """Run CellProfiler on data using LoadData CSV. It can be used for both a illumination correction pipeline and analysis pipeline.
 
@@ -67,6 +70,9 @@ def run_cellprofiler(
             path to the input folder with the images to be analyzed
         path_to_output (str):
             path to the output folder (the directory will be created if it doesn't already exist)
+        run_with_apptainer_interactive (pathlib.Path | str, optional):
+            apptainer image or instance URI (see apptainer_utils.get_cellprofiler_container) to run CellProfiler in,
+            CellProfiler is run directly if None (default is None)
         sqlite_name (str, optional):
             string with name for SQLite file for an analysis pipeline to either be renamed and/or to check to see if the
             run has already happened (default is None)
@@ -76,6 +82,9 @@ def run_cellprofiler(
             will rename the outputted SQLite file from the CellProfiler pipeline and rename it when using one
             pipeline for multiple datasets. If kept as default, the SQLite file will not be renamed and the sqlite_name is used to
             find if the analysis pipeline has already been ran (default is False)
+        worker_pool (dict, optional):
+            pool from cp_worker_pool.start_cellprofiler_worker_pool to run the pipeline on instead of starting a
+            CellProfiler process, the outputs are the same (default is None)
     """
 
     # check to make sure the paths to files are correct and they exists before running CellProfiler
@@ -124,12 +133,21 @@ def run_cellprofiler(
                 ]
             )
 
-            subprocess.run(
-                command,
-                stdout=cellprofiler_output_file,
-                stderr=cellprofiler_output_file,
-                check=True,
-            )
+            if worker_pool is not None:
+                run_cellprofiler_in_worker_pool(
+                    worker_pool=worker_pool,
+                    path_to_pipeline=path_to_pipeline,
+                    path_to_input=path_to_input,
+                    path_to_output=path_to_output,
+                    log_file=pathlib.Path(f"logs/{log_file_name}"),
+                )
+            else:
+                subprocess.run(
+                    command,
+                    stdout=cellprofiler_output_file,
+                    stderr=cellprofiler_output_file,
+                    check=True,
+                )
             print(
                 "The CellProfiler run has been completed with log. Please check log file for any errors."
             )
@@ -161,12 +179,21 @@ def run_cellprofiler(
                 "-o",
                 path_to_output,
             ]
-            subprocess.run(
-                command,
-                stdout=cellprofiler_output_file,
-                stderr=cellprofiler_output_file,
-                check=True,
-            )
+            if worker_pool is not None:
+                run_cellprofiler_in_worker_pool(
+                    worker_pool=worker_pool,
+                    path_to_pipeline=path_to_pipeline,
+                    path_to_input=path_to_input,
+                    path_to_output=path_to_output,
+                    log_file=pathlib.Path(f"logs/{log_file_name}"),
+                )
+            else:
+                subprocess.run(
+                    command,
+                    stdout=cellprofiler_output_file,
+                    stderr=cellprofiler_output_file,
+                    check=True,
+                )
 
         if rename_sqlite_file_bool:
             # rename the outputted .sqlite file to the specified sqlite name if running one analysis pipeline
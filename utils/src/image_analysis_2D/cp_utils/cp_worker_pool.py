@@ -0,0 +1,432 @@
+"""
+This collection of functions runs CellProfiler pipelines in long-lived worker processes through the
+cellprofiler_core API, so each worker imports CellProfiler, parses its pipelines and starts the JVM once
+instead of once per run.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import importlib.util
+import logging
+import math
+import multiprocessing
+import os
+import pathlib
+import queue
+import subprocess
+import threading
+import time
+import traceback
+from typing import Dict, Iterator, List, Optional
+
+import psutil
+from image_analysis_2D.parallel_utils.parallel_utils import (
+    get_memory_bound_worker_count,
+    get_process_tree_rss,
+)
+
+# seconds a worker gets to stop its JVM and exit before it is terminated
+CELLPROFILER_WORKER_SHUTDOWN_TIMEOUT = 60
+# seconds between checks that the workers are alive while waiting for results
+CELLPROFILER_WORKER_POLL_INTERVAL = 5.0
+# seconds between samples of the resident memory of a worker while it runs a job
+CELLPROFILER_WORKER_MEMORY_POLL_INTERVAL = 0.5
+# jobs each worker runs at least, so its JVM start and pipeline loads are paid once for many runs
+CELLPROFILER_WORKER_MIN_JOBS = 6
+
+
+def cellprofiler_core_available() -> bool:
+    """
+    Check if the cellprofiler_core API can be used for a worker pool.
+
+    Returns:
+        bool: True if cellprofiler_core is installed
+    """
+    return importlib.util.find_spec("cellprofiler_core") is not None
+
+
+def get_cellprofiler_worker_count(
+    per_worker_memory: int,
+    number_of_jobs: int,
+    min_jobs_per_worker: int = CELLPROFILER_WORKER_MIN_JOBS,
+    max_workers: Optional[int] = None,
+) -> int:
+    """
+    Size a worker pool from the available CPUs and memory, with at least ``min_jobs_per_worker`` jobs per worker.
+
+    Args:
+        per_worker_memory (int): estimated peak memory of one worker in bytes
+        number_of_jobs (int): number of jobs the pool runs
+        min_jobs_per_worker (int, optional): jobs each worker runs at least (default is CELLPROFILER_WORKER_MIN_JOBS)
+        max_workers (int, optional): upper bound on the number of workers (default is None, the number of CPUs)
+
+    Raises:
+        MaxWorkerError: if max_workers exceeds the number of available CPUs
+
+    Returns:
+        int: number of workers (at least 1)
+    """
+    return get_memory_bound_worker_count(
+        per_worker_memory=per_worker_memory,
+        number_of_tasks=math.ceil(number_of_jobs / max(1, min_jobs_per_worker)),
+        max_workers=max_workers,
+    )
+
+
+def _run_pipeline_job(pipeline, job: dict) -> None:
+    """
+    Run a loaded pipeline on the images of a folder like ``cellprofiler -c -r -p -i -o``.
+
+    Args:
+        pipeline (cellprofiler_core.pipeline.Pipeline): the loaded pipeline, copied so runs do not share state
+        job (dict): the job with ``path_to_input`` and ``path_to_output``
+
+    Raises:
+        RuntimeError: if a module failed to load or run
+    """
+    import cellprofiler_core.preferences as preferences
+    from cellprofiler_core.pipeline import LoadException, RunException
+
+    errors = []
+
+    def on_pipeline_event(caller, event):
+        if isinstance(event, (LoadException, RunException)):
+            errors.append(event)
+            # stop the run like the headless command line does
+            event.cancel_run = True
+
+    pipeline = pipeline.copy()
+    pipeline.add_listener(on_pipeline_event)
+    preferences.set_default_image_directory(str(job["path_to_input"]))
+    preferences.set_default_output_directory(str(job["path_to_output"]))
+    pathlib.Path(job["path_to_output"]).mkdir(parents=True, exist_ok=True)
+    # the files of the input folder, as the command line passes -i to the Images module
+    pipeline.add_pathnames_to_file_list(
+        [
+            str(path)
+            for path in sorted(pathlib.Path(job["path_to_input"]).resolve().rglob("*"))
+            if path.is_file()
+        ]
+    )
+    measurements = pipeline.run()
+    if measurements is not None:
+        measurements.close()
+    if errors:
+        raise RuntimeError(
+            f"{len(errors)} pipeline error(s), the first in "
+            f"{getattr(errors[0].module, 'module_name', 'the pipeline')}: {errors[0].error}"
+        )
+
+
+@contextlib.contextmanager
+def _track_peak_rss(
+    poll_interval: float = CELLPROFILER_WORKER_MEMORY_POLL_INTERVAL,
+) -> Iterator[dict]:
+    """
+    Sample the resident memory of this process and its children while the block runs.
+
+    Args:
+        poll_interval (float, optional): seconds between samples
+            (default is CELLPROFILER_WORKER_MEMORY_POLL_INTERVAL)
+
+    Yields:
+        dict: ``peak_rss_bytes``, the largest sample, final once the block exits
+    """
+    process = psutil.Process()
+    peak = {"peak_rss_bytes": get_process_tree_rss(process)}
+    stop = threading.Event()
+
+    def sample() -> None:
+        while not stop.wait(poll_interval):
+            peak["peak_rss_bytes"] = max(
+                peak["peak_rss_bytes"], get_process_tree_rss(process)
+            )
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        yield peak
+    finally:
+        stop.set()
+        sampler.join()
+        peak["peak_rss_bytes"] = max(
+            peak["peak_rss_bytes"], get_process_tree_rss(process)
+        )
+
+
+def _cellprofiler_worker(
+    pipeline_paths: List[str],
+    job_queue: multiprocessing.Queue,
+    result_queue: multiprocessing.Queue,
+) -> None:
+    """
+    Load the pipelines once, then run the jobs of the queue until a None job is received.
+
+    Args:
+        pipeline_paths (List[str]): resolved paths to the .cppipe files this worker runs
+        job_queue (multiprocessing.Queue): the jobs to run
+        result_queue (multiprocessing.Queue): the result of each job
+    """
+    import cellprofiler_core.preferences as preferences
+    from cellprofiler_core.pipeline import Pipeline
+    from cellprofiler_core.utilities.java import start_java, stop_java
+
+    # no display is needed or available on CPU-only compute nodes
+    preferences.set_headless()
+    preferences.set_awt_headless(True)
+    start_java()
+    try:
+        pipelines = {}
+        for pipeline_path in pipeline_paths:
+            pipelines[pipeline_path] = Pipeline()
+            pipelines[pipeline_path].load(pipeline_path)
+
+        while True:
+            job = job_queue.get()
+            if job is None:
+                break
+            start_time = time.time()
+            error = None
+            root_logger = logging.getLogger()
+            log_handler = None
+            with contextlib.ExitStack() as stack:
+                if job["log_file"] is not None:
+                    log_stream = stack.enter_context(open(job["log_file"], "a"))
+                    stack.enter_context(contextlib.redirect_stdout(log_stream))
+                    stack.enter_context(contextlib.redirect_stderr(log_stream))
+                    log_handler = logging.StreamHandler(log_stream)
+                    root_logger.addHandler(log_handler)
+                try:
+                    with _track_peak_rss() as peak:
+                        _run_pipeline_job(pipelines[job["path_to_pipeline"]], job)
+                except Exception:
+                    error = traceback.format_exc()
+                    print(error)
+                finally:
+                    if log_handler is not None:
+                        root_logger.removeHandler(log_handler)
+            result_queue.put(
+                {
+                    "job_id": job["job_id"],
+                    "returncode": 0 if error is None else 1,
+                    "error": error,
+                    "start_time": start_time,
+                    "duration_seconds": time.time() - start_time,
+                    "worker_pid": os.getpid(),
+                    # sampled while this job ran, so earlier jobs do not count,
+                    # and includes the JVM and pipelines the worker holds
+                    "peak_rss_bytes": peak["peak_rss_bytes"],
+                }
+            )
+    finally:
+        stop_java()
+
+
+def start_cellprofiler_worker_pool(
+    pipeline_paths: List[pathlib.Path], num_workers: int = 1
+) -> Dict:
+    """
+    Start worker processes that each load the pipelines and start the JVM once.
+
+    Workers are forked, as spawned workers would re-run the calling script, which has no
+    ``__main__`` guard when converted from a notebook. This process never starts the JVM
+    or imports CellProfiler, each worker does so after the fork.
+
+    Args:
+        pipeline_paths (List[pathlib.Path]): the .cppipe files the workers run,
+            e.g. analysis_single_cell.cppipe, analysis_organoid.cppipe and illum.cppipe
+        num_workers (int, optional): number of worker processes (default is 1)
+
+    Raises:
+        ImportError: if cellprofiler_core is not installed
+
+    Returns:
+        Dict: the worker pool, to pass to submit_cellprofiler_job and stop_cellprofiler_worker_pool
+    """
+    if not cellprofiler_core_available():
+        raise ImportError(
+            "The CellProfiler worker pool needs cellprofiler_core, run CellProfiler as a subprocess instead"
+        )
+    context = multiprocessing.get_context("fork")
+    pipeline_paths = [
+        str(pathlib.Path(pipeline_path).resolve(strict=True))
+        for pipeline_path in pipeline_paths
+    ]
+    job_queue = context.Queue()
+    result_queue = context.Queue()
+    processes = [
+        context.Process(
+            target=_cellprofiler_worker,
+            args=(pipeline_paths, job_queue, result_queue),
+            daemon=True,
+        )
+        for _ in range(max(1, num_workers))
+    ]
+    for process in processes:
+        process.start()
+    return {
+        "pipeline_paths": pipeline_paths,
+        "processes": processes,
+        "job_queue": job_queue,
+        "result_queue": result_queue,
+        "results": {},
+        "next_job_id": 0,
+    }
+
+
+def submit_cellprofiler_job(
+    worker_pool: Dict,
+    path_to_pipeline: pathlib.Path,
+    path_to_input: pathlib.Path,
+    path_to_output: pathlib.Path,
+    log_file: Optional[pathlib.Path] = None,
+) -> int:
+    """
+    Queue a CellProfiler run on the worker pool.
+
+    Args:
+        worker_pool (Dict): the pool from start_cellprofiler_worker_pool
+        path_to_pipeline (pathlib.Path): the .cppipe file, one of the pool's pipelines
+        path_to_input (pathlib.Path): path to the input folder with the images to be analyzed
+        path_to_output (pathlib.Path): path to the output folder
+        log_file (pathlib.Path, optional): file the output of the run is appended to (default is None)
+
+    Raises:
+        ValueError: if the pipeline was not loaded by the pool
+
+    Returns:
+        int: the job id to wait for
+    """
+    path_to_pipeline = str(pathlib.Path(path_to_pipeline).resolve())
+    if path_to_pipeline not in worker_pool["pipeline_paths"]:
+        raise ValueError(
+            f"{path_to_pipeline} is not one of the pool's pipelines: {worker_pool['pipeline_paths']}"
+        )
+    job_id = worker_pool["next_job_id"]
+    worker_pool["next_job_id"] += 1
+    worker_pool["job_queue"].put(
+        {
+            "job_id": job_id,
+            "path_to_pipeline": path_to_pipeline,
+            "path_to_input": str(path_to_input),
+            "path_to_output": str(path_to_output),
+            "log_file": None if log_file is None else str(log_file),
+        }
+    )
+    return job_id
+
+
+def wait_for_cellprofiler_jobs(worker_pool: Dict, job_ids: List[int]) -> List[dict]:
+    """
+    Wait for queued CellProfiler runs to finish.
+
+    Args:
+        worker_pool (Dict): the pool from start_cellprofiler_worker_pool
+        job_ids (List[int]): ids returned by submit_cellprofiler_job
+
+    Raises:
+        RuntimeError: if a worker died (e.g. the JVM crashed), as its job will never finish
+
+    Returns:
+        List[dict]: per job the ``job_id``, ``returncode``, ``error``, ``start_time``, ``duration_seconds``, ``worker_pid``
+        and ``peak_rss_bytes``, the peak resident memory of the worker while it ran the job
+    """
+    results = worker_pool["results"]
+    while any(job_id not in results for job_id in job_ids):
+        try:
+            result = worker_pool["result_queue"].get(
+                timeout=CELLPROFILER_WORKER_POLL_INTERVAL
+            )
+        except queue.Empty:
+            dead_workers = [
+                process
+                for process in worker_pool["processes"]
+                if process.exitcode is not None
+            ]
+            if dead_workers:
+                raise RuntimeError(
+                    f"CellProfiler worker(s) {[process.pid for process in dead_workers]} exited "
+                    f"with {[process.exitcode for process in dead_workers]} before finishing their jobs"
+                )
+            continue
+        results[result["job_id"]] = result
+    return [results.pop(job_id) for job_id in job_ids]
+
+
+def stop_cellprofiler_worker_pool(worker_pool: Dict) -> None:
+    """
+    Stop the workers after their queued jobs, terminating workers that do not exit.
+
+    Args:
+        worker_pool (Dict): the pool from start_cellprofiler_worker_pool
+    """
+    for process in worker_pool["processes"]:
+        if process.is_alive():
+            worker_pool["job_queue"].put(None)
+    for process in worker_pool["processes"]:
+        process.join(timeout=CELLPROFILER_WORKER_SHUTDOWN_TIMEOUT)
+        if process.is_alive():
+            process.terminate()
+            process.join()
+
+
+@contextlib.contextmanager
+def cellprofiler_worker_pool(
+    pipeline_paths: List[pathlib.Path], num_workers: int = 1
+) -> Iterator[Dict]:
+    """
+    Start a CellProfiler worker pool that is stopped when the block exits.
+
+    Args:
+        pipeline_paths (List[pathlib.Path]): the .cppipe files the workers run
+        num_workers (int, optional): number of worker processes (default is 1)
+
+    Yields:
+        Dict: the worker pool
+    """
+    worker_pool = start_cellprofiler_worker_pool(pipeline_paths, num_workers)
+    try:
+        yield worker_pool
+    finally:
+        stop_cellprofiler_worker_pool(worker_pool)
+
+
+def run_cellprofiler_in_worker_pool(
+    worker_pool: Dict,
+    path_to_pipeline: pathlib.Path,
+    path_to_input: pathlib.Path,
+    path_to_output: pathlib.Path,
+    log_file: Optional[pathlib.Path] = None,
+) -> None:
+    """
+    Run CellProfiler on the worker pool and wait, raising like ``subprocess.run(..., check=True)``.
+
+    Args:
+        worker_pool (Dict): the pool from start_cellprofiler_worker_pool
+        path_to_pipeline (pathlib.Path): the .cppipe file, one of the pool's pipelines
+        path_to_input (pathlib.Path): path to the input folder with the images to be analyzed
+        path_to_output (pathlib.Path): path to the output folder
+        log_file (pathlib.Path, optional): file the output of the run is appended to (default is None)
+
+    Raises:
+        subprocess.CalledProcessError: if the run failed, with the traceback as stderr
+    """
+    job_id = submit_cellprofiler_job(
+        worker_pool, path_to_pipeline, path_to_input, path_to_output, log_file
+    )
+    (result,) = wait_for_cellprofiler_jobs(worker_pool, [job_id])
+    if result["returncode"] != 0:
+        raise subprocess.CalledProcessError(
+            returncode=result["returncode"],
+            cmd=[
+                "cellprofiler_core worker",
+                "-p",
+                str(path_to_pipeline),
+                "-i",
+                str(path_to_input),
+                "-o",
+                str(path_to_output),
+            ],
+            stderr=result["error"],
+        )
@@ -126,3 +126,75 @@ def stop_resource_profiling(
     output_file_dir.parent.mkdir(parents=True, exist_ok=True)
     run_stats.to_parquet(output_file_dir)
     return True
+
+
+def save_process_profiling(
+    start_time: float,
+    time_elapsed: float,
+    peak_rss_mb: Optional[float],
+    returncode: int,
+    well_fov: str,
+    patient_id: str,
+    feature_type: str,
+    channel: str,
+    compartment: str,
+    CPU_GPU: str,
+    output_file_dir: pathlib.Path,
+) -> bool:
+    """
+    Save the profile of a run done by another process to a parquet file.
+
+    Runs dispatched to child processes (e.g. concurrent CellProfiler runs)
+    cannot be profiled with ``tracemalloc`` in this process, so the peak
+    resident memory measured for the child is saved instead, along with the
+    same identifying columns as :func:`stop_resource_profiling`.
+
+    Parameters
+    ----------
+    start_time : float
+        Unix timestamp the run started at.
+    time_elapsed : float
+        Wall-clock duration of the run in seconds.
+    peak_rss_mb : float, optional
+        Peak resident memory of the process in MB, None if it was not measured.
+    returncode : int
+        Return code of the run, 0 on success.
+    well_fov : str
+        Well and field of view for the run.
+    patient_id : str
+        Patient ID for the run.
+    feature_type : str
+        Feature type for the run (e.g., ``'cellprofiler2D'``).
+    channel : str
+        Channel name for the run.
+    compartment : str
+        Cellular compartment for the run.
+    CPU_GPU : str
+        Processing unit used (``'CPU'`` or ``'GPU'``).
+    output_file_dir : pathlib.Path
+        File path to save the run-statistics Parquet file.
+
+    Returns
+    -------
+    bool
+        ``True`` if the function ran successfully.
+    """
+    run_stats = pd.DataFrame(
+        {
+            "start_time": [start_time],
+            "end_time": [start_time + time_elapsed],
+            "peak_mem_rss_mb": [peak_rss_mb],
+            "time_taken_seconds": [time_elapsed],
+            "returncode": [returncode],
+            "gpu": [CPU_GPU],
+            "well_fov": [well_fov],
+            "patient_id": [patient_id],
+            "feature_type": [feature_type],
+            "channel": [channel],
+            "compartment": [compartment],
+        }
+    )
+
+    output_file_dir.parent.mkdir(parents=True, exist_ok=True)
+    run_stats.to_parquet(output_file_dir)
+    return True
@@ -41,6 +41,8 @@ def parse_args() -> dict[str, str | int | float | None]:
         - 'clip_limit': clip limit for contrast enhancement (e.g., 0.05)
         - 'compartment': compartment to process (e.g., 'Nuclei')
         - 'channel': channel to process (e.g., 'DAPI')
+        - 'loadfile': loadfile of the jobs to run (e.g., 'loadfiles/segmentation_loadfile.txt')
+        - 'overwrite': rewrite the outputs even if they exist
 
     Raises
     ------
@@ -120,6 +122,17 @@ def parse_args() -> dict[str, str | int | float | None]:
         default=None,
         help="2D z-projection method to use, e.g. 'zmax'",
     )
+    argparser.add_argument(
+        "--loadfile",
+        type=str,
+        default=None,
+        help="Tab separated loadfile of the jobs to run, e.g. 'loadfiles/segmentation_loadfile.txt'",
+    )
+    argparser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Rewrite the outputs even if they exist, e.g. when they are stale or empty",
+    )
 
     args = argparser.parse_args()
     well_fov = args.well_fov
@@ -134,6 +147,8 @@ def parse_args() -> dict[str, str | int | float | None]:
     output_features_subparent_name = args.output_features_subparent_name
     image_based_profiles_subparent_name = args.image_based_profiles_subparent_name
     twoD_method = args.twoD_method
+    loadfile = args.loadfile
+    overwrite = args.overwrite
 
     return {
         "well_fov": well_fov,
@@ -148,4 +163,6 @@ def parse_args() -> dict[str, str | int | float | None]:
         "output_features_subparent_name": output_features_subparent_name,
         "image_based_profiles_subparent_name": image_based_profiles_subparent_name,
         "twoD_method": twoD_method,
+        "loadfile": loadfile,
+        "overwrite": overwrite,
     }
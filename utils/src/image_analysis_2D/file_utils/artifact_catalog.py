@@ -0,0 +1,742 @@
+"""SQLite catalog of the outputs of every stage, to find what is missing or stale with one query."""
+
+from __future__ import annotations
+
+import contextlib
+import os
+import pathlib
+import sqlite3
+import time
+from collections.abc import Iterator
+
+import pandas as pd
+from image_analysis_2D.file_utils.zarr_store import get_zarr_location
+
+ARTIFACT_CATALOG_NAME = "artifact_catalog.sqlite"
+# seconds to wait on the lock of the catalog held by another job
+ARTIFACT_CATALOG_TIMEOUT = 120
+# stored as the user_version of the catalog, bump it when ARTIFACT_CATALOG_SCHEMA
+# or ARTIFACT_STAGES change so existing catalogs are updated on their next open
+ARTIFACT_CATALOG_VERSION = 1
+# statuses of a recorded artifact, the ones in ARTIFACT_COMPLETE_STATUSES are done
+ARTIFACT_STATUSES = {"present", "valid", "empty", "failed"}
+ARTIFACT_COMPLETE_STATUSES = ("present", "valid")
+# stage -> the stage its outputs are computed from (outputs older than any
+# of their inputs are stale), the directory under 2D_analysis for each 2D
+# method and the artifacts expected in the {well_fov} directory of each
+ARTIFACT_STAGES: dict[str, dict] = {
+    "projection": {
+        "upstream": None,
+        "directories": {
+            "zmax": "0a.zmax_proj",
+            "middle": "0b.middle_slice",
+            "middle_n": "0c.middle_n_slice_max_proj",
+        },
+        "artifacts": [
+            "{well_fov}_405.tif",
+            "{well_fov}_488.tif",
+            "{well_fov}_555.tif",
+            "{well_fov}_640.tif",
+            "{well_fov}_TRANS.tif",
+        ],
+    },
+    "illumination_correction": {
+        "upstream": "projection",
+        "directories": {
+            "zmax": "1a.zmax_proj_illum_correction",
+            "middle": "1b.middle_slice_illum_correction",
+            "middle_n": "1c.middle_n_slice_max_proj_illum_correction",
+        },
+        "artifacts": [
+            "{well_fov}_405_illumcorrect.tiff",
+            "{well_fov}_488_illumcorrect.tiff",
+            "{well_fov}_555_illumcorrect.tiff",
+            "{well_fov}_640_illumcorrect.tiff",
+        ],
+    },
+    "segmentation": {
+        "upstream": "projection",
+        "directories": {
+            "zmax": "0a.zmax_proj",
+            "middle": "0b.middle_slice",
+            "middle_n": "0c.middle_n_slice_max_proj",
+        },
+        "artifacts": [
+            "{well_fov}_organoid_mask.tiff",
+            "{well_fov}_nuclei_mask.tiff",
+            "{well_fov}_cell_mask.tiff",
+        ],
+    },
+    "featurization": {
+        "upstream": "segmentation",
+        "directories": {
+            "zmax": "2a.cellprofiler_zmax_proj_output",
+            "middle": "2b.cellprofiler_middle_slice_output",
+            "middle_n": "2c.cellprofiler_middle_n_slice_max_proj_output",
+        },
+        "artifacts": [
+            "gff_extracted_features_single-cell.sqlite",
+            "gff_extracted_features_organoid.sqlite",
+        ],
+    },
+}
+
+ARTIFACT_CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS well_fovs (
+    patient TEXT NOT NULL,
+    well_fov TEXT NOT NULL,
+    PRIMARY KEY (patient, well_fov)
+);
+CREATE TABLE IF NOT EXISTS expected_artifacts (
+    stage TEXT NOT NULL,
+    method TEXT NOT NULL,
+    artifact TEXT NOT NULL,
+    upstream TEXT,
+    PRIMARY KEY (stage, method, artifact)
+);
+CREATE TABLE IF NOT EXISTS artifacts (
+    stage TEXT NOT NULL,
+    patient TEXT NOT NULL,
+    well_fov TEXT NOT NULL,
+    method TEXT NOT NULL,
+    artifact TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size_bytes INTEGER,
+    mtime REAL NOT NULL,
+    status TEXT NOT NULL,
+    recorded_at REAL NOT NULL,
+    PRIMARY KEY (stage, patient, well_fov, method, artifact)
+);
+CREATE INDEX IF NOT EXISTS artifacts_by_well_fov
+    ON artifacts (patient, well_fov, method, stage);
+CREATE TABLE IF NOT EXISTS scanned_stages (
+    stage TEXT NOT NULL,
+    patient TEXT NOT NULL,
+    scanned_at REAL NOT NULL,
+    PRIMARY KEY (stage, patient)
+);
+"""
+
+
+def get_artifact_catalog_path(data_dir: str | pathlib.Path) -> pathlib.Path:
+    """
+    Get the path of the artifact catalog of a data directory.
+
+    Parameters
+    ----------
+    data_dir : str | pathlib.Path
+        The ``data`` directory holding one directory per patient.
+
+    Returns
+    -------
+    pathlib.Path
+        ``{data_dir}/artifact_catalog.sqlite``.
+    """
+    return pathlib.Path(data_dir) / ARTIFACT_CATALOG_NAME
+
+
+@contextlib.contextmanager
+def connect_artifact_catalog(
+    catalog_path: str | pathlib.Path,
+) -> Iterator[sqlite3.Connection]:
+    """
+    Open the artifact catalog, creating it if needed, and commit on exit.
+
+    The catalog is shared by concurrent jobs, so writers wait for the lock
+    rather than failing. The rollback journal is kept (no WAL) as the
+    catalog may live on a network file system. The schema is only written
+    when the catalog has no schema of ARTIFACT_CATALOG_VERSION, so opening
+    an existing catalog takes no write lock.
+
+    Parameters
+    ----------
+    catalog_path : str | pathlib.Path
+        Path to the catalog.
+
+    Yields
+    ------
+    sqlite3.Connection
+        The connection, committed when the block exits without an error.
+    """
+    pathlib.Path(catalog_path).parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(catalog_path, timeout=ARTIFACT_CATALOG_TIMEOUT)
+    try:
+        user_version = connection.execute("PRAGMA user_version").fetchone()[0]
+        if user_version != ARTIFACT_CATALOG_VERSION:
+            with connection:
+                connection.executescript(ARTIFACT_CATALOG_SCHEMA)
+                connection.execute("DELETE FROM expected_artifacts")
+                connection.executemany(
+                    "INSERT INTO expected_artifacts VALUES (?, ?, ?, ?)",
+                    [
+                        (stage, method, artifact, stage_info["upstream"])
+                        for stage, stage_info in ARTIFACT_STAGES.items()
+                        for method in stage_info["directories"]
+                        for artifact in stage_info["artifacts"]
+                    ],
+                )
+                connection.execute(f"PRAGMA user_version = {ARTIFACT_CATALOG_VERSION}")
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+def _list_zstack_well_fovs(data_dir: str | pathlib.Path, patient: str) -> list[str]:
+    """List the well_fov directories of the ``zstack_images`` directory of a patient."""
+    zstack_dir = pathlib.Path(data_dir) / patient / "zstack_images"
+    if not zstack_dir.is_dir():
+        return []
+    return sorted(entry.name for entry in os.scandir(zstack_dir) if entry.is_dir())
+
+
+def register_well_fovs(
+    catalog_path: str | pathlib.Path, data_dir: str | pathlib.Path, patient: str
+) -> list[str]:
+    """
+    Register the well_fovs of a patient from its ``zstack_images`` directory.
+
+    The registered well_fovs are the ones every stage is expected to have outputs for.
+
+    Parameters
+    ----------
+    catalog_path : str | pathlib.Path
+        Path to the catalog.
+    data_dir : str | pathlib.Path
+        The ``data`` directory holding one directory per patient.
+    patient : str
+        Patient ID.
+
+    Returns
+    -------
+    list[str]
+        The well_fovs of the patient.
+    """
+    well_fovs = _list_zstack_well_fovs(data_dir, patient)
+    with connect_artifact_catalog(catalog_path) as connection:
+        connection.executemany(
+            "INSERT OR IGNORE INTO well_fovs VALUES (?, ?)",
+            [(patient, well_fov) for well_fov in well_fovs],
+        )
+    return well_fovs
+
+
+def _stat_artifact(artifact_path: pathlib.Path) -> tuple[int | None, float] | None:
+    """Get the size and modification time of an output, None if it does not exist."""
+    try:
+        stat = artifact_path.stat()
+        return stat.st_size, stat.st_mtime
+    except FileNotFoundError:
+        pass
+    if artifact_path.suffix not in {".tif", ".tiff"}:
+        return None
+    # images of the zarr backend have no file, use the array metadata written with the array
+    store_path, key = get_zarr_location(artifact_path)
+    try:
+        return None, (store_path / key / "zarr.json").stat().st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def _find_well_fov_artifacts(
+    data_dir: str | pathlib.Path,
+    stage: str,
+    patient: str,
+    well_fov: str,
+    methods: list[str],
+    status: str,
+) -> tuple[list[dict], list[tuple]]:
+    """Find which outputs of a stage exist for a well_fov, as catalog rows and keys of the absent outputs."""
+    stage_info = ARTIFACT_STAGES[stage]
+    recorded_at = time.time()
+    present = []
+    absent = []
+    for method in methods:
+        well_fov_dir = (
+            pathlib.Path(data_dir)
+            / patient
+            / "2D_analysis"
+            / stage_info["directories"][method]
+            / well_fov
+        )
+        for artifact in stage_info["artifacts"]:
+            artifact_path = (
+                well_fov_dir / artifact.format(well_fov=well_fov)
+            ).absolute()
+            file_stat = _stat_artifact(artifact_path)
+            if file_stat is None:
+                absent.append((stage, patient, well_fov, method, artifact))
+                continue
+            present.append(
+                {
+                    "stage": stage,
+                    "patient": patient,
+                    "well_fov": well_fov,
+                    "method": method,
+                    "artifact": artifact,
+                    "path": str(artifact_path),
+                    "size_bytes": file_stat[0],
+                    "mtime": file_stat[1],
+                    "status": status,
+                    "recorded_at": recorded_at,
+                }
+            )
+    return present, absent
+
+
+def _write_artifacts(
+    connection: sqlite3.Connection, present: list[dict], absent: list[tuple]
+) -> None:
+    """Upsert the outputs that exist and delete the ones that do not."""
+    connection.executemany(
+        "INSERT OR IGNORE INTO well_fovs VALUES (?, ?)",
+        sorted({(row["patient"], row["well_fov"]) for row in present}),
+    )
+    connection.executemany(
+        "DELETE FROM artifacts WHERE stage = ? AND patient = ? AND well_fov = ? "
+        "AND method = ? AND artifact = ?",
+        absent,
+    )
+    # an unchanged output keeps the status of its validation
+    connection.executemany(
+        """
+        INSERT INTO artifacts VALUES (
+            :stage, :patient, :well_fov, :method, :artifact, :path,
+            :size_bytes, :mtime, :status, :recorded_at
+        )
+        ON CONFLICT (stage, patient, well_fov, method, artifact) DO UPDATE SET
+            path = excluded.path,
+            size_bytes = excluded.size_bytes,
+            mtime = excluded.mtime,
+            recorded_at = excluded.recorded_at,
+            status = CASE
+                WHEN artifacts.mtime = excluded.mtime
+                    AND artifacts.size_bytes IS excluded.size_bytes
+                    AND excluded.status = 'present'
+                THEN artifacts.status
+                ELSE excluded.status
+            END
+        """,
+        present,
+    )
+
+
+def record_well_fov_artifacts(
+    catalog_path: str | pathlib.Path,
+    data_dir: str | pathlib.Path,
+    stage: str,
+    patient: str,
+    well_fov: str,
+    methods: list[str] | None = None,
+    status: str = "present",
+) -> pd.DataFrame:
+    """
+    Record the outputs of a stage for one well_fov after they were written.
+
+    Outputs that exist are added or updated, outputs that do not are removed
+    from the catalog, so the catalog matches the files of the well_fov.
+    Unchanged outputs keep a ``valid`` or ``empty`` status from a validation.
+
+    Parameters
+    ----------
+    catalog_path : str | pathlib.Path
+        Path to the catalog.
+    data_dir : str | pathlib.Path
+        The ``data`` directory the stage wrote to.
+    stage : str
+        A key of ARTIFACT_STAGES.
+    patient : str
+        Patient ID.
+    well_fov : str
+        Well and field of view.
+    methods : list[str] | None, optional
+        2D methods to record, by default all methods of the stage.
+    status : str, optional
+        Status of the outputs that exist, by default "present".
+
+    Returns
+    -------
+    pd.DataFrame
+        The recorded outputs.
+    """
+    if stage not in ARTIFACT_STAGES:
+        raise ValueError(
+            f"Unknown stage {stage}, expected one of {list(ARTIFACT_STAGES)}"
+        )
+    if status not in ARTIFACT_STATUSES:
+        raise ValueError(
+            f"Unknown status {status}, expected one of {ARTIFACT_STATUSES}"
+        )
+    if methods is None:
+        methods = list(ARTIFACT_STAGES[stage]["directories"])
+    present, absent = _find_well_fov_artifacts(
+        data_dir, stage, patient, well_fov, methods, status
+    )
+    with connect_artifact_catalog(catalog_path) as connection:
+        connection.execute(
+            "INSERT OR IGNORE INTO well_fovs VALUES (?, ?)", (patient, well_fov)
+        )
+        _write_artifacts(connection, present, absent)
+    return pd.DataFrame.from_records(present)
+
+
+def try_record_well_fov_artifacts(
+    catalog_path: str | pathlib.Path,
+    data_dir: str | pathlib.Path,
+    stage: str,
+    patient: str,
+    well_fov: str,
+    methods: list[str] | None = None,
+) -> pd.DataFrame | None:
+    """
+    Record the outputs of a stage for one well_fov, printing a catalog error
+    instead of raising it.
+
+    Used by the jobs writing the outputs: the outputs are written by then, so
+    a catalog that stays locked past ARTIFACT_CATALOG_TIMEOUT does not fail
+    the job. The outputs it could not record are added by
+    record_patient_artifacts.
+
+    Parameters
+    ----------
+    catalog_path : str | pathlib.Path
+        Path to the catalog.
+    data_dir : str | pathlib.Path
+        The ``data`` directory the stage wrote to.
+    stage : str
+        A key of ARTIFACT_STAGES.
+    patient : str
+        Patient ID.
+    well_fov : str
+        Well and field of view.
+    methods : list[str] | None, optional
+        2D methods to record, by default all methods of the stage.
+
+    Returns
+    -------
+    pd.DataFrame | None
+        The recorded outputs, None if the catalog could not be written.
+    """
+    try:
+        return record_well_fov_artifacts(
+            catalog_path=catalog_path,
+            data_dir=data_dir,
+            stage=stage,
+            patient=patient,
+            well_fov=well_fov,
+            methods=methods,
+        )
+    except sqlite3.Error as e:
+        print(
+            f"Could not record the {stage} outputs of {patient} {well_fov} in "
+            f"{catalog_path}, run record_patient_artifacts to add them: {e}"
+        )
+        return None
+
+
+def record_patient_artifacts(
+    catalog_path: str | pathlib.Path,
+    data_dir: str | pathlib.Path,
+    stage: str,
+    patient: str,
+) -> pd.DataFrame:
+    """
+    Record the outputs of a stage for every well_fov directory of a patient.
+
+    Used by stages that run per patient, and to add outputs written before
+    the catalog existed. Each directory is listed once and the catalog is
+    updated in one transaction. The stage is then marked as scanned for the
+    patient, see get_unscanned_stages.
+
+    Parameters
+    ----------
+    catalog_path : str | pathlib.Path
+        Path to the catalog.
+    data_dir : str | pathlib.Path
+        The ``data`` directory the stage wrote to.
+    stage : str
+        A key of ARTIFACT_STAGES.
+    patient : str
+        Patient ID.
+
+    Returns
+    -------
+    pd.DataFrame
+        The recorded outputs.
+    """
+    if stage not in ARTIFACT_STAGES:
+        raise ValueError(
+            f"Unknown stage {stage}, expected one of {list(ARTIFACT_STAGES)}"
+        )
+    well_fovs = set(register_well_fovs(catalog_path, data_dir, patient))
+    for directory in ARTIFACT_STAGES[stage]["directories"].values():
+        stage_dir = pathlib.Path(data_dir) / patient / "2D_analysis" / directory
+        if stage_dir.is_dir():
+            well_fovs.update(
+                entry.name
+                for entry in os.scandir(stage_dir)
+                if entry.is_dir() and entry.name != "run_stats"
+            )
+    present = []
+    absent = []
+    for well_fov in sorted(well_fovs):
+        well_fov_present, well_fov_absent = _find_well_fov_artifacts(
+            data_dir,
+            stage,
+            patient,
+            well_fov,
+            list(ARTIFACT_STAGES[stage]["directories"]),
+            "present",
+        )
+        present.extend(well_fov_present)
+        absent.extend(well_fov_absent)
+    with connect_artifact_catalog(catalog_path) as connection:
+        _write_artifacts(connection, present, absent)
+        connection.execute(
+            "INSERT OR REPLACE INTO scanned_stages VALUES (?, ?, ?)",
+            (stage, patient, time.time()),
+        )
+    return pd.DataFrame.from_records(present)
+
+
+def set_artifact_status(
+    catalog_path: str | pathlib.Path, paths: list[str], status: str
+) -> None:
+    """
+    Set the status of recorded outputs, e.g. after validating them.
+
+    Parameters
+    ----------
+    catalog_path : str | pathlib.Path
+        Path to the catalog.
+    paths : list[str]
+        Paths of the outputs.
+    status : str
+        One of ARTIFACT_STATUSES.
+    """
+    if status not in ARTIFACT_STATUSES:
+        raise ValueError(
+            f"Unknown status {status}, expected one of {ARTIFACT_STATUSES}"
+        )
+    with connect_artifact_catalog(catalog_path) as connection:
+        connection.executemany(
+            "UPDATE artifacts SET status = ? WHERE path = ?",
+            [(status, str(path)) for path in paths],
+        )
+
+
+def get_artifacts(
+    catalog_path: str | pathlib.Path, stage: str, status: str | None = None
+) -> pd.DataFrame:
+    """
+    Get the recorded outputs of a stage.
+
+    Parameters
+    ----------
+    catalog_path : str | pathlib.Path
+        Path to the catalog.
+    stage : str
+        A key of ARTIFACT_STAGES.
+    status : str | None, optional
+        Only outputs with this status, by default all.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per recorded output.
+    """
+    query = "SELECT * FROM artifacts WHERE stage = ?"
+    parameters = [stage]
+    if status is not None:
+        query += " AND status = ?"
+        parameters.append(status)
+    with connect_artifact_catalog(catalog_path) as connection:
+        return pd.read_sql_query(query, connection, params=parameters)
+
+
+def get_unscanned_stages(
+    catalog_path: str | pathlib.Path, stages: list[str], patients: list[str]
+) -> list[tuple[str, str]]:
+    """
+    Get the stages whose output directories were never listed for a patient,
+    e.g. stages that ran before the catalog existed.
+
+    Outputs recorded by jobs that ran on single well_fovs do not tell if the
+    other outputs of the patient are recorded, so the output directories of
+    a stage are listed once per patient with record_patient_artifacts.
+
+    Parameters
+    ----------
+    catalog_path : str | pathlib.Path
+        Path to the catalog.
+    stages : list[str]
+        Keys of ARTIFACT_STAGES.
+    patients : list[str]
+        Patient IDs.
+
+    Returns
+    -------
+    list[tuple[str, str]]
+        The (stage, patient) pairs not scanned yet.
+    """
+    with connect_artifact_catalog(catalog_path) as connection:
+        scanned = set(
+            connection.execute("SELECT stage, patient FROM scanned_stages").fetchall()
+        )
+    return [
+        (stage, patient)
+        for stage in stages
+        for patient in patients
+        if (stage, patient) not in scanned
+    ]
+
+
+def get_stage_status(
+    catalog_path: str | pathlib.Path,
+    stage: str,
+    patients: list[str] | None = None,
+    data_dir: str | pathlib.Path | None = None,
+) -> pd.DataFrame:
+    """
+    Get every expected output of a stage and why it needs to be (re)computed.
+
+    The expected outputs are the artifacts of the stage for each 2D method of
+    each registered well_fov. The well_fovs in the ``zstack_images``
+    directory of each of ``patients`` are registered first. An output needs to be computed if it is
+    ``missing``, ``empty`` or ``failed``, or ``stale`` when it is older than
+    an output of the upstream stage for the same well_fov and method.
+
+    Parameters
+    ----------
+    catalog_path : str | pathlib.Path
+        Path to the catalog.
+    stage : str
+        A key of ARTIFACT_STAGES.
+    patients : list[str] | None, optional
+        Only these patients, by default all registered patients.
+    data_dir : str | pathlib.Path | None, optional
+        The ``data`` directory holding one directory per patient, by default
+        the directory of the catalog.
+
+    Returns
+    -------
+    pd.DataFrame
+        ``patient``, ``well_fov``, ``method``, ``artifact``, ``path`` and
+        ``reason``, which is None for complete outputs.
+    """
+    query = f"""
+        SELECT
+            well_fovs.patient,
+            well_fovs.well_fov,
+            expected.method,
+            expected.artifact,
+            recorded.path,
+            CASE
+                WHEN recorded.path IS NULL THEN 'missing'
+                WHEN recorded.status NOT IN {ARTIFACT_COMPLETE_STATUSES} THEN recorded.status
+                WHEN recorded.mtime < (
+                    SELECT MAX(upstream.mtime) FROM artifacts AS upstream
+                    WHERE upstream.stage = expected.upstream
+                        AND upstream.patient = well_fovs.patient
+                        AND upstream.well_fov = well_fovs.well_fov
+                        AND upstream.method = expected.method
+                ) THEN 'stale'
+            END AS reason
+        FROM well_fovs
+        CROSS JOIN expected_artifacts AS expected
+        LEFT JOIN artifacts AS recorded
+            ON recorded.stage = expected.stage
+            AND recorded.patient = well_fovs.patient
+            AND recorded.well_fov = well_fovs.well_fov
+            AND recorded.method = expected.method
+            AND recorded.artifact = expected.artifact
+        WHERE expected.stage = ?
+    """
+    parameters = [stage]
+    if patients is not None:
+        query += f" AND well_fovs.patient IN ({', '.join('?' * len(patients))})"
+        parameters.extend(patients)
+    query += " ORDER BY well_fovs.patient, well_fovs.well_fov, expected.method, expected.artifact"
+    if data_dir is None:
+        data_dir = pathlib.Path(catalog_path).parent
+    with connect_artifact_catalog(catalog_path) as connection:
+        connection.executemany(
+            "INSERT OR IGNORE INTO well_fovs VALUES (?, ?)",
+            [
+                (patient, well_fov)
+                for patient in patients or []
+                for well_fov in _list_zstack_well_fovs(data_dir, patient)
+            ],
+        )
+        return pd.read_sql_query(query, connection, params=parameters)
+
+
+def write_loadfile(
+    stage_status_df: pd.DataFrame,
+    loadfile_path: str | pathlib.Path,
+    columns: list[str],
+) -> pd.DataFrame:
+    """
+    Write the work list of the outputs that need to be (re)computed.
+
+    The jobs skip outputs that exist, so each work item ends with an
+    ``overwrite`` column, True when one of its outputs exists but is stale,
+    empty or failed and has to be rewritten.
+
+    Parameters
+    ----------
+    stage_status_df : pd.DataFrame
+        Output of get_stage_status.
+    loadfile_path : str | pathlib.Path
+        Tab separated file without a header, one line per unique work item.
+    columns : list[str]
+        Columns identifying a work item, e.g. ``["patient", "well_fov"]``.
+
+    Returns
+    -------
+    pd.DataFrame
+        The work items, with their ``overwrite`` column.
+    """
+    to_compute_df = stage_status_df.loc[stage_status_df["reason"].notna()]
+    work_items_df = (
+        to_compute_df.assign(overwrite=to_compute_df["reason"] != "missing")
+        .groupby(columns, sort=False)["overwrite"]
+        .any()
+        .reset_index()
+    )
+    pathlib.Path(loadfile_path).parent.mkdir(parents=True, exist_ok=True)
+    work_items_df.to_csv(loadfile_path, index=False, sep="\t", header=False)
+    return work_items_df
+
+
+def read_loadfile(
+    loadfile_path: str | pathlib.Path, columns: list[str]
+) -> pd.DataFrame:
+    """
+    Read a work list written by write_loadfile.
+
+    Parameters
+    ----------
+    loadfile_path : str | pathlib.Path
+        Tab separated file without a header.
+    columns : list[str]
+        Columns identifying a work item, as passed to write_loadfile.
+
+    Returns
+    -------
+    pd.DataFrame
+        The work items with their ``overwrite`` column, False for loadfiles
+        written without it.
+    """
+    names = columns + ["overwrite"]
+    if pathlib.Path(loadfile_path).stat().st_size == 0:
+        return pd.DataFrame(columns=names)
+    work_items_df = pd.read_csv(
+        loadfile_path, sep="\t", header=None, dtype=str, keep_default_na=False
+    )
+    work_items_df = work_items_df.iloc[:, : len(names)]
+    work_items_df.columns = names[: work_items_df.shape[1]]
+    if "overwrite" not in work_items_df:
+        work_items_df["overwrite"] = "False"
+    work_items_df["overwrite"] = work_items_df["overwrite"].str.strip() == "True"
+    return work_items_df
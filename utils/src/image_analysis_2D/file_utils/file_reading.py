@@ -3,11 +3,17 @@
 from __future__ import annotations
 
 import pathlib
-from typing import Iterable, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List, Sequence
 
 import numpy as np
 import skimage
 import tifffile
+from image_analysis_2D.file_utils.zarr_store import (
+    list_zarr_images,
+    read_zarr_image,
+    zarr_image_exists,
+)
 
 
 # ----------------------------------------------------------------------
@@ -19,6 +25,10 @@ def find_files_available(
 ) -> List[str]:
     """List available image files in a directory.
 
+    Images stored in the zarr backend for this ``{stage}/{well_fov}``
+    directory are listed with the paths they would have as files, so they
+    can be passed to the readers below like any other file.
+
     Parameters
     ----------
     input_dir : pathlib.Path
@@ -33,7 +43,48 @@ def find_files_available(
     """
     files = sorted(input_dir.glob("*"))
     files = [str(x) for x in files if x.suffix in image_extensions]
-    return files
+    files += [
+        f
+        for f in list_zarr_images(input_dir)
+        if pathlib.Path(f).suffix in image_extensions and f not in files
+    ]
+    return sorted(files)
+
+
+def image_exists(file_path: str | pathlib.Path) -> bool:
+    """
+    Check if an image exists as a file or in the zarr backend.
+
+    Parameters
+    ----------
+    file_path : str | pathlib.Path
+        The ``{stage}/{well_fov}/{file_name}`` path of the image.
+
+    Returns
+    -------
+    bool
+        True if the image exists in either backend.
+    """
+    return pathlib.Path(file_path).exists() or zarr_image_exists(file_path)
+
+
+def read_image(file_path: str | pathlib.Path) -> np.ndarray:
+    """
+    Read an image from its file or, if there is no file, from the zarr backend.
+
+    Parameters
+    ----------
+    file_path : str | pathlib.Path
+        The ``{stage}/{well_fov}/{file_name}`` path of the image.
+
+    Returns
+    -------
+    np.ndarray
+        The image as stored (no dtype conversion).
+    """
+    if not pathlib.Path(file_path).exists() and zarr_image_exists(file_path):
+        return read_zarr_image(file_path)
+    return tifffile.imread(file_path)
 
 
 def read_in_channels(
@@ -82,14 +133,153 @@ def read_in_channels(
     return loaded
 
 
-def read_zstack_image(file_path: str) -> np.ndarray:
+def get_zstack_shape(file_path: str | pathlib.Path) -> tuple[int, ...]:
+    """
+    Get the shape of a z-stack from its TIFF header without decoding any pixels.
+
+    Parameters
+    ----------
+    file_path : str | pathlib.Path
+        The path to the z-stack image file.
+
+    Returns
+    -------
+    tuple[int, ...]
+        The shape of the first image series, e.g. (Z, Y, X).
+    """
+    with tifffile.TiffFile(file_path) as tif:
+        return tuple(tif.series[0].shape)
+
+
+def read_zstack_pages(
+    file_path: str | pathlib.Path,
+    z_indices: Sequence[int] | None = None,
+    use_memmap: bool = True,
+) -> np.ndarray:
+    """
+    Read only the requested z-slices (IFD pages) of a z-stack.
+
+    Uncompressed, contiguous files are memory-mapped so only the bytes of the
+    requested z-slices are read from disk.
+    Otherwise only the requested pages are decoded.
+    Files whose pages do not map one-to-one onto z-slices fall back to
+    decoding the full series.
+
+    Parameters
+    ----------
+    file_path : str | pathlib.Path
+        The path to the z-stack image file.
+    z_indices : Sequence[int] | None, optional
+        The z-slices to read, by default None which reads every z-slice.
+    use_memmap : bool, optional
+        Memory-map the file when it is uncompressed and contiguous, by default True.
+
+    Returns
+    -------
+    np.ndarray
+        The (len(z_indices), Y, X) image of the requested z-slices.
+        If z_indices is None and the file is memory-mapped, a read-only
+        np.memmap of the full z-stack is returned.
+    """
+    with tifffile.TiffFile(file_path) as tif:
+        series = tif.series[0]
+        if use_memmap and series.dataoffset is not None:
+            zstack = tifffile.memmap(file_path, mode="r")
+            if z_indices is None:
+                return zstack
+            return np.asarray(zstack[list(z_indices)])
+        if z_indices is None:
+            return series.asarray()
+        if series.ndim == 3 and len(series.pages) == series.shape[0]:
+            # one IFD page per z-slice so only decode the pages we need
+            return np.stack([series.pages[z].asarray() for z in z_indices])
+        return series.asarray()[list(z_indices)]
+
+
+def iter_zstack_pages(
+    file_path: str | pathlib.Path,
+    z_indices: Sequence[int] | None = None,
+    read_ahead: bool = True,
+    use_memmap: bool = True,
+) -> Iterator[tuple[int, np.ndarray]]:
+    """
+    Stream the z-slices of a z-stack one page at a time.
+
+    Only one z-slice is held by the caller at a time, plus the next z-slice
+    being read on a background thread when ``read_ahead`` is set
+    (double buffering), so memory is bounded by about two z-slices.
+
+    Parameters
+    ----------
+    file_path : str | pathlib.Path
+        The path to the z-stack image file.
+    z_indices : Sequence[int] | None, optional
+        The z-slices to read in order, by default None which reads every z-slice.
+    read_ahead : bool, optional
+        Read the next z-slice while the caller processes the current one, by default True.
+    use_memmap : bool, optional
+        Memory-map the file when it is uncompressed and contiguous, by default True.
+
+    Yields
+    ------
+    tuple[int, np.ndarray]
+        The z-slice index and the (Y, X) z-slice.
+    """
+    with tifffile.TiffFile(file_path) as tif:
+        series = tif.series[0]
+        number_of_slices = series.shape[0]
+        if z_indices is None:
+            z_indices = range(number_of_slices)
+        z_indices = list(z_indices)
+        if use_memmap and series.dataoffset is not None:
+            zstack = tifffile.memmap(file_path, mode="r")
+
+            def read_page(z: int) -> np.ndarray:
+                return np.array(zstack[z])
+
+        elif series.ndim == 3 and len(series.pages) == number_of_slices:
+
+            def read_page(z: int) -> np.ndarray:
+                return series.pages[z].asarray()
+
+        else:
+            # pages do not map onto z-slices so the series has to be decoded
+            zstack = series.asarray()
+
+            def read_page(z: int) -> np.ndarray:
+                return zstack[z]
+
+        if not read_ahead:
+            for z in z_indices:
+                yield z, read_page(z)
+            return
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_page = None
+            for position, z in enumerate(z_indices):
+                page = next_page.result() if next_page is not None else read_page(z)
+                next_page = (
+                    executor.submit(read_page, z_indices[position + 1])
+                    if position + 1 < len(z_indices)
+                    else None
+                )
+                yield z, page
+
+
+def read_zstack_image(
+    file_path: str, z_indices: Sequence[int] | None = None
+) -> np.ndarray:
     """
     Reads in a z-stack image from a given file path and returns it as a numpy array.
+    Images without a file are read from the zarr backend.
 
     Parameters
     ----------
     file_path : str
         The path to the z-stack image file.
+    z_indices : Sequence[int] | None, optional
+        Only read these z-slices (see read_zstack_pages), by default None
+        which reads the full z-stack.
 
     Returns
     -------
@@ -102,7 +292,12 @@ def read_zstack_image(file_path: str) -> np.ndarray:
         If the image has less than 3 dimensions.
     """
 
-    img = tifffile.imread(file_path)
+    if z_indices is None:
+        img = read_image(file_path)
+    elif not pathlib.Path(file_path).exists() and zarr_image_exists(file_path):
+        img = read_zarr_image(file_path)[list(z_indices)]
+    else:
+        img = read_zstack_pages(file_path, z_indices=z_indices)
 
     if len(img.shape) > 5:
         # determine in any of the dimensions is size of 1?
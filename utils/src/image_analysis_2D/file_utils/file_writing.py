@@ -0,0 +1,247 @@
+"""Helpers for writing imaging files."""
+
+from __future__ import annotations
+
+import os
+import pathlib
+
+import numpy as np
+import pandas as pd
+import tifffile
+from image_analysis_2D.file_utils.zarr_store import (
+    get_storage_backend,
+    write_zarr_image,
+)
+
+# TIFF compression presets for write_tiff_atomic, name -> tifffile.imwrite arguments
+# the horizontal predictor stores differences between neighbouring pixels,
+# which compresses smooth 16-bit microscopy images and label masks much better
+# uncompressed ("none") is the default as every CellProfiler build can read it
+TIFF_COMPRESSION_PRESETS: dict[str, dict] = {
+    "none": {
+        "compression": None,
+        "predictor": None,
+        "compressionargs": None,
+    },
+    "zstd": {
+        "compression": "zstd",
+        "predictor": "horizontal",
+        "compressionargs": {"level": 5},
+    },
+    "deflate": {
+        "compression": "deflate",
+        "predictor": "horizontal",
+        "compressionargs": {"level": 6},
+    },
+    "lzw": {
+        "compression": "lzw",
+        "predictor": "horizontal",
+        "compressionargs": None,
+    },
+}
+# environment variable that selects the default TIFF compression preset
+TIFF_COMPRESSION_ENV_VAR = "IMAGE_ANALYSIS_2D_TIFF_COMPRESSION"
+
+
+def get_tiff_write_kwargs(
+    compression: str | None = None,
+    tile: tuple[int, int] | None = None,
+    maxworkers: int | None = None,
+) -> dict:
+    """
+    Build the tifffile.imwrite arguments of a compression preset.
+
+    Parameters
+    ----------
+    compression : str | None, optional
+        Name of a TIFF_COMPRESSION_PRESETS entry, by default None which reads
+        the IMAGE_ANALYSIS_2D_TIFF_COMPRESSION environment variable (default ``"none"``).
+    tile : tuple[int, int] | None, optional
+        (Y, X) tile shape (multiples of 16), by default None which writes strips.
+    maxworkers : int | None, optional
+        Number of threads encoding tiles or strips, by default None (tifffile default).
+
+    Returns
+    -------
+    dict
+        Keyword arguments for tifffile.imwrite.
+
+    Raises
+    ------
+    ValueError
+        If the compression preset is unknown.
+    """
+    if compression is None:
+        compression = os.environ.get(TIFF_COMPRESSION_ENV_VAR, "none")
+    compression = compression.lower()
+    if compression not in TIFF_COMPRESSION_PRESETS:
+        raise ValueError(
+            f"Unknown TIFF compression: {compression}, expected one of {sorted(TIFF_COMPRESSION_PRESETS)}"
+        )
+    write_kwargs = {
+        key: value
+        for key, value in TIFF_COMPRESSION_PRESETS[compression].items()
+        if value is not None
+    }
+    if tile is not None:
+        write_kwargs["tile"] = tile
+    if maxworkers is not None:
+        write_kwargs["maxworkers"] = maxworkers
+    return write_kwargs
+
+
+def write_tiff_atomic(
+    output_path: pathlib.Path,
+    image: np.ndarray,
+    compression: str | None = None,
+    tile: tuple[int, int] | None = None,
+    maxworkers: int | None = None,
+) -> pathlib.Path:
+    """
+    Write a TIFF so that readers never see a partially written file.
+
+    The image is written to a temporary file next to the output and then
+    renamed over the output path, which is atomic on POSIX file systems.
+    A killed job therefore leaves either no output or a complete output.
+
+    Parameters
+    ----------
+    output_path : pathlib.Path
+        Path of the TIFF to write.
+    image : np.ndarray
+        The image to write.
+    compression : str | None, optional
+        Name of a TIFF_COMPRESSION_PRESETS entry, by default None which reads
+        the IMAGE_ANALYSIS_2D_TIFF_COMPRESSION environment variable (default ``"none"``).
+    tile : tuple[int, int] | None, optional
+        (Y, X) tile shape (multiples of 16), by default None which writes strips.
+    maxworkers : int | None, optional
+        Number of threads encoding tiles or strips, by default None (tifffile default).
+
+    Returns
+    -------
+    pathlib.Path
+        The written output path.
+    """
+    write_kwargs = get_tiff_write_kwargs(
+        compression=compression, tile=tile, maxworkers=maxworkers
+    )
+    output_path = pathlib.Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    # the .tmp suffix keeps partial files out of the *.tif / *.tiff globs
+    tmp_path = output_path.with_name(f".{output_path.name}.{os.getpid()}.tmp")
+    try:
+        tifffile.imwrite(tmp_path, image, **write_kwargs)
+        os.replace(tmp_path, output_path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+    return output_path
+
+
+def write_parquet_atomic(df: pd.DataFrame, output_path: pathlib.Path) -> pathlib.Path:
+    """
+    Write a parquet file so that an interrupted run never leaves a truncated file.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The DataFrame to write.
+    output_path : pathlib.Path
+        Path of the parquet file to write.
+
+    Returns
+    -------
+    pathlib.Path
+        The written output path.
+    """
+    output_path = pathlib.Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = output_path.with_name(f".{output_path.name}.{os.getpid()}.tmp")
+    try:
+        df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, output_path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+    return output_path
+
+
+def write_npy_atomic(array: np.ndarray, output_path: pathlib.Path) -> pathlib.Path:
+    """
+    Write a .npy file so that an interrupted run never leaves a truncated file.
+
+    Parameters
+    ----------
+    array : np.ndarray
+        The array to write.
+    output_path : pathlib.Path
+        Path of the .npy file to write.
+
+    Returns
+    -------
+    pathlib.Path
+        The written output path.
+    """
+    output_path = pathlib.Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = output_path.with_name(f".{output_path.name}.{os.getpid()}.tmp")
+    try:
+        # a file object keeps np.save from appending .npy to the temporary name
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, output_path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+    return output_path
+
+
+def write_image(
+    output_path: pathlib.Path,
+    image: np.ndarray,
+    backend: str | None = None,
+    metadata: dict | None = None,
+    compression: str | None = None,
+    tile: tuple[int, int] | None = None,
+    maxworkers: int | None = None,
+) -> pathlib.Path:
+    """
+    Write an image with the selected storage backend.
+
+    With the tiff backend the image is written atomically to ``output_path``.
+    With the zarr backend it is written into the zarr store of its well_fov
+    (see zarr_store.get_zarr_location) and ``output_path`` itself is not created.
+
+    Parameters
+    ----------
+    output_path : pathlib.Path
+        The ``{stage}/{well_fov}/{file_name}`` path of the image.
+    image : np.ndarray
+        The image to write.
+    backend : str | None, optional
+        ``"tiff"`` or ``"zarr"``, by default None which reads the
+        IMAGE_ANALYSIS_2D_STORAGE_BACKEND environment variable (default ``"tiff"``).
+    metadata : dict | None, optional
+        Extra attributes stored with zarr arrays, by default None.
+    compression : str | None, optional
+        TIFF compression preset (see write_tiff_atomic), by default None.
+    tile : tuple[int, int] | None, optional
+        TIFF (Y, X) tile shape, by default None which writes strips.
+    maxworkers : int | None, optional
+        Number of threads encoding the TIFF, by default None (tifffile default).
+
+    Returns
+    -------
+    pathlib.Path
+        The written TIFF or zarr store path.
+    """
+    if get_storage_backend(backend) == "zarr":
+        return write_zarr_image(output_path, image, metadata=metadata)
+    return write_tiff_atomic(
+        output_path,
+        image,
+        compression=compression,
+        tile=tile,
+        maxworkers=maxworkers,
+    )
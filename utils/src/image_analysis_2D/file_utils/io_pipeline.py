@@ -0,0 +1,209 @@
+"""Prefetching producer/consumer pipeline that overlaps image reads, compute and writes."""
+
+from __future__ import annotations
+
+import collections
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any
+
+import numpy as np
+
+
+def get_nbytes(data: Any) -> int:
+    """
+    Get the number of bytes held by the arrays in a (nested) result.
+
+    Parameters
+    ----------
+    data : Any
+        An array, or a dict, list or tuple of arrays.
+
+    Returns
+    -------
+    int
+        Total bytes of the arrays, 0 for anything else.
+    """
+    if isinstance(data, np.ndarray):
+        return data.nbytes
+    if isinstance(data, dict):
+        return sum(get_nbytes(value) for value in data.values())
+    if isinstance(data, (list, tuple)):
+        return sum(get_nbytes(value) for value in data)
+    return 0
+
+
+def _read_item(read_function: Callable[[Any], Any], item: Any) -> tuple[Any, Any]:
+    """Read one item, returning the exception instead of raising it."""
+    try:
+        return read_function(item), None
+    except Exception as e:
+        return None, e
+
+
+def iter_prefetched(
+    items: Iterable[Any],
+    read_function: Callable[[Any], Any],
+    num_readers: int = 2,
+    prefetch: int = 4,
+    max_memory_bytes: int | None = None,
+) -> Iterator[tuple[Any, Any, Exception | None]]:
+    """
+    Read items on background threads ahead of the consumer.
+
+    Up to ``prefetch`` reads are in flight or waiting to be consumed.
+    With ``max_memory_bytes`` no new read is started while the decoded data
+    waiting to be consumed exceeds the budget (back-pressure), but at least
+    one read is always in flight so the pipeline cannot stall.
+    Items are yielded in their input order.
+
+    Parameters
+    ----------
+    items : Iterable[Any]
+        Items to read, e.g. file paths.
+    read_function : Callable[[Any], Any]
+        Reads one item, e.g. tifffile.imread.
+    num_readers : int, optional
+        Number of reader threads, by default 2.
+    prefetch : int, optional
+        Maximum number of items read ahead of the consumer, by default 4.
+    max_memory_bytes : int | None, optional
+        Memory budget of the read ahead items, by default None (no budget).
+
+    Yields
+    ------
+    tuple[Any, Any, Exception | None]
+        The item, the data read (None on error) and the read error (or None).
+    """
+    items = iter(items)
+    end_of_items = object()
+    pending: collections.deque[tuple[Any, Future]] = collections.deque()
+    with ThreadPoolExecutor(max_workers=max(1, num_readers)) as executor:
+
+        def prefetched_bytes() -> int:
+            return sum(
+                get_nbytes(future.result()[0]) for _, future in pending if future.done()
+            )
+
+        def fill() -> None:
+            while len(pending) < max(1, prefetch):
+                if (
+                    max_memory_bytes is not None
+                    and len(pending) > 0
+                    and prefetched_bytes() >= max_memory_bytes
+                ):
+                    return
+                item = next(items, end_of_items)
+                if item is end_of_items:
+                    return
+                pending.append((item, executor.submit(_read_item, read_function, item)))
+
+        fill()
+        while pending:
+            item, future = pending.popleft()
+            data, error = future.result()
+            fill()
+            yield item, data, error
+            # drop the reference before refilling so the budget sees it freed
+            del data
+            fill()
+
+
+def run_io_pipeline(
+    items: Iterable[Any],
+    read_function: Callable[[Any], Any],
+    compute_function: Callable[[Any, Any], Any],
+    write_function: Callable[[Any, Any], None] | None = None,
+    num_readers: int = 2,
+    num_writers: int = 1,
+    prefetch: int = 4,
+    max_memory_bytes: int | None = None,
+) -> list[dict[str, Any]]:
+    """
+    Overlap the reads, compute and writes of a per-file loop.
+
+    Items are read ahead on reader threads (see iter_prefetched), computed on
+    the calling thread in input order and their results written on writer
+    threads.
+    Results waiting to be written count against ``max_memory_bytes`` too:
+    compute waits for the oldest writes while the budget is exceeded.
+    Errors are caught per item so one bad file does not stop the loop.
+
+    Parameters
+    ----------
+    items : Iterable[Any]
+        Items to process, e.g. file paths.
+    read_function : Callable[[Any], Any]
+        Reads one item.
+    compute_function : Callable[[Any, Any], Any]
+        Computes the result of an item from the item and its data.
+    write_function : Callable[[Any, Any], None] | None, optional
+        Writes the result of an item, by default None which returns the
+        results instead of writing them.
+    num_readers : int, optional
+        Number of reader threads, by default 2.
+    num_writers : int, optional
+        Number of writer threads, by default 1.
+    prefetch : int, optional
+        Maximum number of items read ahead of the compute step, by default 4.
+    max_memory_bytes : int | None, optional
+        Memory budget of the read ahead data and of the results waiting to be
+        written, by default None (no budget).
+
+    Returns
+    -------
+    list[dict[str, Any]]
+        One record per item in input order with the ``item``, the ``result``
+        (None when written) and the ``error`` (None on success).
+    """
+    records = []
+    pending_writes: collections.deque[tuple[dict, Future, int]] = collections.deque()
+
+    def finish_oldest_write() -> None:
+        record, future, _ = pending_writes.popleft()
+        try:
+            future.result()
+        except Exception as e:
+            record["error"] = e
+
+    with ThreadPoolExecutor(max_workers=max(1, num_writers)) as writer:
+        for item, data, error in iter_prefetched(
+            items,
+            read_function,
+            num_readers=num_readers,
+            prefetch=prefetch,
+            max_memory_bytes=max_memory_bytes,
+        ):
+            record = {"item": item, "result": None, "error": error}
+            records.append(record)
+            if error is not None:
+                continue
+            try:
+                result = compute_function(item, data)
+            except Exception as e:
+                record["error"] = e
+                continue
+            del data
+            if write_function is None:
+                record["result"] = result
+                continue
+            pending_writes.append(
+                (
+                    record,
+                    writer.submit(write_function, item, result),
+                    get_nbytes(result),
+                )
+            )
+            del result
+            while pending_writes and pending_writes[0][1].done():
+                finish_oldest_write()
+            # back-pressure: wait for the oldest writes while over the budget
+            while (
+                max_memory_bytes is not None
+                and len(pending_writes) > 1
+                and sum(nbytes for _, _, nbytes in pending_writes) >= max_memory_bytes
+            ):
+                finish_oldest_write()
+        while pending_writes:
+            finish_oldest_write()
+    return records
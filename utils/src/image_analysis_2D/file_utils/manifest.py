@@ -0,0 +1,369 @@
+"""Content-hash manifests that decide which outputs of a stage are stale."""
+
+from __future__ import annotations
+
+import functools
+import hashlib
+import inspect
+import os
+import pathlib
+from collections.abc import Callable
+from typing import Any
+
+import pandas as pd
+from image_analysis_2D.file_utils.file_writing import write_parquet_atomic
+
+# bytes read per sampled block of the fast hash
+FAST_HASH_BLOCK_SIZE = 1024**2
+# number of evenly spaced blocks (including the first and last) of the fast hash
+FAST_HASH_NUMBER_OF_BLOCKS = 8
+
+
+def compute_fast_hash(
+    file_path: str | pathlib.Path,
+    block_size: int = FAST_HASH_BLOCK_SIZE,
+    number_of_blocks: int = FAST_HASH_NUMBER_OF_BLOCKS,
+) -> str:
+    """
+    Hash the size and evenly spaced blocks of a file.
+
+    Large raw z-stacks are not read in full: the first, last and evenly
+    spaced blocks in between are hashed together with the file size, which
+    catches truncated, replaced and re-acquired files at a fraction of the
+    cost of a full checksum.
+    Files smaller than the sampled blocks are hashed in full.
+
+    Parameters
+    ----------
+    file_path : str | pathlib.Path
+        Path to the file.
+    block_size : int, optional
+        Bytes per sampled block, by default FAST_HASH_BLOCK_SIZE.
+    number_of_blocks : int, optional
+        Number of sampled blocks, by default FAST_HASH_NUMBER_OF_BLOCKS.
+
+    Returns
+    -------
+    str
+        Hex digest of the file.
+    """
+    file_size = os.path.getsize(file_path)
+    hasher = hashlib.blake2b(str(file_size).encode(), digest_size=16)
+    with open(file_path, "rb") as f:
+        if file_size <= block_size * number_of_blocks:
+            hasher.update(f.read())
+            return hasher.hexdigest()
+        last_offset = file_size - block_size
+        for block in range(number_of_blocks):
+            f.seek(last_offset * block // (number_of_blocks - 1))
+            hasher.update(f.read(block_size))
+    return hasher.hexdigest()
+
+
+def compute_checksum(file_path: str | pathlib.Path, chunk_size: int = 1024**2) -> str:
+    """
+    Compute the full blake2b checksum of a file.
+
+    Parameters
+    ----------
+    file_path : str | pathlib.Path
+        Path to the file.
+    chunk_size : int, optional
+        Bytes read at a time, by default 1 MiB.
+
+    Returns
+    -------
+    str
+        Hex digest of the file.
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def get_file_signature(
+    file_path: str | pathlib.Path, prefix: str, full_checksum: bool = False
+) -> dict[str, int | str | None]:
+    """
+    Get the size, modification time and hash of a file for a manifest entry.
+
+    Parameters
+    ----------
+    file_path : str | pathlib.Path
+        Path to the file.
+    prefix : str
+        Prefix of the column names, e.g. ``"input"`` or ``"output"``.
+    full_checksum : bool, optional
+        Hash the whole file rather than sampled blocks, by default False.
+
+    Returns
+    -------
+    dict[str, int | str | None]
+        ``{prefix}_size``, ``{prefix}_mtime_ns`` and ``{prefix}_hash``.
+        All are None for images without a file (e.g. the zarr backend).
+    """
+    file_path = pathlib.Path(file_path)
+    if not file_path.is_file():
+        return {
+            f"{prefix}_size": None,
+            f"{prefix}_mtime_ns": None,
+            f"{prefix}_hash": None,
+        }
+    stat = file_path.stat()
+    return {
+        f"{prefix}_size": stat.st_size,
+        f"{prefix}_mtime_ns": stat.st_mtime_ns,
+        f"{prefix}_hash": (
+            compute_checksum(file_path)
+            if full_checksum
+            else compute_fast_hash(file_path)
+        ),
+    }
+
+
+def describe_callable(function: Callable) -> str:
+    """
+    Describe a function by its name and effective keyword arguments.
+
+    Defaults and arguments bound by functools.partial are included, so
+    ``middle_n_slice_indices`` and ``partial(middle_n_slice_indices, n=3)``
+    have the same description.
+
+    Parameters
+    ----------
+    function : Callable
+        The function.
+
+    Returns
+    -------
+    str
+        e.g. ``"module.middle_n_slice_indices(n=3)"``.
+    """
+    arguments = []
+    base_function = function
+    while isinstance(base_function, functools.partial):
+        arguments = [repr(argument) for argument in base_function.args] + arguments
+        base_function = base_function.func
+    try:
+        parameters = inspect.signature(function).parameters.values()
+    except (TypeError, ValueError):
+        # e.g. numpy ufuncs
+        parameters = []
+    arguments += [
+        f"{parameter.name}={parameter.default!r}"
+        for parameter in parameters
+        if parameter.default is not inspect.Parameter.empty
+    ]
+    module = (
+        getattr(base_function, "__module__", None) or type(base_function).__module__
+    )
+    name = getattr(base_function, "__qualname__", None) or getattr(
+        base_function, "__name__", repr(base_function)
+    )
+    return f"{module}.{name}({', '.join(arguments)})"
+
+
+def get_parameter_version(parameters: Any) -> str:
+    """
+    Hash the code and parameters that produce an output.
+
+    Functions are described by their module, name and bound partial
+    arguments so the version changes when e.g. ``n`` of the middle n
+    projection changes, but not between Python sessions.
+
+    Parameters
+    ----------
+    parameters : Any
+        Nested dicts, lists, tuples, functions and plain values.
+
+    Returns
+    -------
+    str
+        Hex digest of the parameters.
+    """
+
+    def canonicalize(value: Any) -> Any:
+        if isinstance(value, dict):
+            return {
+                str(key): canonicalize(value[key]) for key in sorted(value, key=str)
+            }
+        if isinstance(value, (list, tuple)):
+            return [canonicalize(item) for item in value]
+        if callable(value):
+            return describe_callable(value)
+        return repr(value)
+
+    return hashlib.blake2b(
+        repr(canonicalize(parameters)).encode(), digest_size=16
+    ).hexdigest()
+
+
+def is_input_unchanged(entry: dict, input_path: str | pathlib.Path) -> bool:
+    """
+    Check if an input still matches its manifest entry.
+
+    The size and modification time are compared first; only when the
+    modification time changed (e.g. a copy) is the fast hash recomputed.
+
+    Parameters
+    ----------
+    entry : dict
+        The manifest entry.
+    input_path : str | pathlib.Path
+        Path to the input file.
+
+    Returns
+    -------
+    bool
+        True if the input is unchanged.
+    """
+    stat = pathlib.Path(input_path).stat()
+    if stat.st_size != entry["input_size"]:
+        return False
+    if stat.st_mtime_ns == entry["input_mtime_ns"]:
+        return True
+    return compute_fast_hash(input_path) == entry["input_hash"]
+
+
+def is_output_valid(
+    entry: dict, output_path: str | pathlib.Path, verify_checksum: bool = False
+) -> bool:
+    """
+    Check if an output still matches its manifest entry.
+
+    A truncated or overwritten output has a different size or modification
+    time; ``verify_checksum`` also rehashes the output to catch silent
+    corruption.
+    Outputs without a file (e.g. the zarr backend) are not checked.
+
+    Parameters
+    ----------
+    entry : dict
+        The manifest entry.
+    output_path : str | pathlib.Path
+        Path to the output file.
+    verify_checksum : bool, optional
+        Recompute the full checksum of the output, by default False.
+
+    Returns
+    -------
+    bool
+        True if the output is valid.
+    """
+    output_path = pathlib.Path(output_path)
+    if entry["output_size"] is None or pd.isna(entry["output_size"]):
+        return True
+    if not output_path.is_file():
+        return False
+    stat = output_path.stat()
+    if (
+        stat.st_size != entry["output_size"]
+        or stat.st_mtime_ns != entry["output_mtime_ns"]
+    ):
+        return False
+    if verify_checksum:
+        return compute_checksum(output_path) == entry["output_hash"]
+    return True
+
+
+def load_manifest(manifest_path: pathlib.Path | None) -> pd.DataFrame:
+    """
+    Load the manifest of a stage.
+
+    Parameters
+    ----------
+    manifest_path : pathlib.Path | None
+        Path to the manifest parquet file.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per output, or an empty DataFrame if there is no manifest.
+    """
+    if manifest_path is None or not pathlib.Path(manifest_path).exists():
+        return pd.DataFrame()
+    return pd.read_parquet(manifest_path)
+
+
+def get_manifest_entries(
+    manifest_df: pd.DataFrame,
+    key_columns: tuple[str, str] = ("input_file", "output_file"),
+) -> dict[str, dict[str, dict]]:
+    """
+    Group the manifest entries by input and output file.
+
+    Parameters
+    ----------
+    manifest_df : pd.DataFrame
+        The manifest.
+    key_columns : tuple[str, str], optional
+        Columns to group by, by default ("input_file", "output_file").
+
+    Returns
+    -------
+    dict[str, dict[str, dict]]
+        Mapping of input file to output file to manifest entry.
+    """
+    manifest_entries: dict[str, dict[str, dict]] = {}
+    for entry in manifest_df.to_dict("records"):
+        manifest_entries.setdefault(entry[key_columns[0]], {})[
+            entry[key_columns[1]]
+        ] = entry
+    return manifest_entries
+
+
+def update_manifest(
+    manifest_path: pathlib.Path,
+    new_entries_df: pd.DataFrame,
+    key_columns: list[str] = ["input_file", "output_file"],
+) -> pd.DataFrame:
+    """
+    Add or replace entries of the manifest of a stage.
+
+    Parameters
+    ----------
+    manifest_path : pathlib.Path
+        Path to the manifest parquet file.
+    new_entries_df : pd.DataFrame
+        Entries of the outputs that were (re)computed.
+    key_columns : list[str], optional
+        Columns identifying an entry, by default ["input_file", "output_file"].
+
+    Returns
+    -------
+    pd.DataFrame
+        The updated manifest.
+    """
+    manifest_df = load_manifest(manifest_path)
+    if len(manifest_df) > 0 and len(new_entries_df) > 0:
+        replaced = manifest_df.set_index(key_columns).index.isin(
+            new_entries_df.set_index(key_columns).index
+        )
+        manifest_df = manifest_df.loc[~replaced]
+    manifest_df = pd.concat([manifest_df, new_entries_df], ignore_index=True)
+    if len(manifest_df) > 0:
+        manifest_df = manifest_df.sort_values(key_columns, ignore_index=True)
+    write_parquet_atomic(manifest_df, manifest_path)
+    return manifest_df
+
+
+def pop_manifest_entries(records: list[dict]) -> pd.DataFrame:
+    """
+    Move the manifest entries out of the summary records of a stage.
+
+    Parameters
+    ----------
+    records : list[dict]
+        Summary records holding a ``manifest_entries`` list, modified in place.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per output that was (re)computed.
+    """
+    manifest_entries = []
+    for record in records:
+        manifest_entries.extend(record.pop("manifest_entries", []))
+    return pd.DataFrame.from_records(manifest_entries)
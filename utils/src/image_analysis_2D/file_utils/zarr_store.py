@@ -0,0 +1,234 @@
+"""Optional Zarr storage backend with one chunked, compressed store per well_fov."""
+
+from __future__ import annotations
+
+import os
+import pathlib
+
+import numpy as np
+
+# environment variable that selects the storage backend of the image writers
+STORAGE_BACKEND_ENV_VAR = "IMAGE_ANALYSIS_2D_STORAGE_BACKEND"
+STORAGE_BACKENDS = {"tiff", "zarr"}
+# directory under 2D_analysis holding one {well_fov}.zarr store per well_fov
+ZARR_STORE_DIRNAME = "zarr_store"
+# spatial chunk size, each image is a single shard so it is one file on disk
+ZARR_CHUNK_SIZE = 512
+
+
+def get_storage_backend(backend: str | None = None) -> str:
+    """
+    Get the storage backend to write images with.
+
+    Parameters
+    ----------
+    backend : str | None, optional
+        ``"tiff"`` or ``"zarr"``, by default None which reads the
+        IMAGE_ANALYSIS_2D_STORAGE_BACKEND environment variable (default ``"tiff"``).
+
+    Returns
+    -------
+    str
+        The storage backend.
+
+    Raises
+    ------
+    ValueError
+        If the backend is unknown.
+    """
+    if backend is None:
+        backend = os.environ.get(STORAGE_BACKEND_ENV_VAR, "tiff")
+    backend = backend.lower()
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(
+            f"Unknown storage backend: {backend}, expected one of {sorted(STORAGE_BACKENDS)}"
+        )
+    return backend
+
+
+def _import_zarr():
+    """Import zarr, which is only needed for the zarr backend."""
+    try:
+        import zarr
+    except ImportError as e:
+        raise ImportError(
+            "The zarr storage backend requires zarr>=3, "
+            "install it with `pip install image-analysis-2d[zarr]`"
+        ) from e
+    return zarr
+
+
+def get_zarr_location(image_path: str | pathlib.Path) -> tuple[pathlib.Path, str]:
+    """
+    Map a ``{stage}/{well_fov}/{file_name}`` image path onto the zarr backend.
+
+    e.g. ``2D_analysis/0a.zmax_proj/C4-2/C4-2_405.tif`` is stored as the
+    ``0a.zmax_proj/C4-2_405`` array of ``2D_analysis/zarr_store/C4-2.zarr``.
+
+    Parameters
+    ----------
+    image_path : str | pathlib.Path
+        Path the image has with the tiff backend.
+
+    Returns
+    -------
+    tuple[pathlib.Path, str]
+        The path to the well_fov zarr store and the array key within it.
+    """
+    image_path = pathlib.Path(image_path)
+    well_fov_dir = image_path.parent
+    stage_dir = well_fov_dir.parent
+    store_path = stage_dir.parent / ZARR_STORE_DIRNAME / f"{well_fov_dir.name}.zarr"
+    return store_path, f"{stage_dir.name}/{image_path.stem}"
+
+
+def zarr_image_exists(image_path: str | pathlib.Path) -> bool:
+    """
+    Check if an image is stored in its well_fov zarr store.
+
+    Parameters
+    ----------
+    image_path : str | pathlib.Path
+        Path the image has with the tiff backend.
+
+    Returns
+    -------
+    bool
+        True if the array exists.
+    """
+    store_path, key = get_zarr_location(image_path)
+    # the array metadata is a plain file so no zarr import is needed
+    return (store_path / key / "zarr.json").exists()
+
+
+def write_zarr_image(
+    image_path: str | pathlib.Path,
+    image: np.ndarray,
+    metadata: dict | None = None,
+    chunk_size: int = ZARR_CHUNK_SIZE,
+) -> pathlib.Path:
+    """
+    Write an image into its well_fov zarr store.
+
+    The image is chunked along y and x, compressed with blosc zstd and stored
+    in a single shard so each image is one data file on disk.
+
+    Parameters
+    ----------
+    image_path : str | pathlib.Path
+        Path the image has with the tiff backend.
+    image : np.ndarray
+        The (Y, X) or (Z, Y, X) image to write.
+    metadata : dict | None, optional
+        Extra attributes stored with the array, by default None.
+    chunk_size : int, optional
+        Chunk size along y and x, by default ZARR_CHUNK_SIZE.
+
+    Returns
+    -------
+    pathlib.Path
+        The path to the well_fov zarr store.
+    """
+    zarr = _import_zarr()
+    image_path = pathlib.Path(image_path)
+    store_path, key = get_zarr_location(image_path)
+    image = np.asarray(image)
+    chunks = (1,) * (image.ndim - 2) + tuple(
+        min(chunk_size, size) for size in image.shape[-2:]
+    )
+    group = zarr.open_group(store_path, mode="a")
+    array = group.create_array(
+        key,
+        shape=image.shape,
+        dtype=image.dtype,
+        chunks=chunks,
+        shards=image.shape,
+        compressors=zarr.codecs.BloscCodec(
+            cname="zstd", clevel=5, shuffle="bitshuffle"
+        ),
+        overwrite=True,
+    )
+    array[...] = image
+    array.attrs.update(
+        {
+            "file_name": image_path.name,
+            "axes": ["z", "y", "x"][-image.ndim :],
+            **(metadata or {}),
+        }
+    )
+    return store_path
+
+
+def read_zarr_image(image_path: str | pathlib.Path) -> np.ndarray:
+    """
+    Read an image from its well_fov zarr store.
+
+    Parameters
+    ----------
+    image_path : str | pathlib.Path
+        Path the image has with the tiff backend.
+
+    Returns
+    -------
+    np.ndarray
+        The image.
+    """
+    zarr = _import_zarr()
+    store_path, key = get_zarr_location(image_path)
+    group = zarr.open_group(store_path, mode="r")
+    return group[key][...]
+
+
+def list_zarr_images(input_dir: str | pathlib.Path) -> list[str]:
+    """
+    List the images of a ``{stage}/{well_fov}`` directory stored in the zarr backend.
+
+    Parameters
+    ----------
+    input_dir : str | pathlib.Path
+        The ``{stage}/{well_fov}`` directory the images have with the tiff backend.
+
+    Returns
+    -------
+    list[str]
+        Sorted paths the images have with the tiff backend.
+    """
+    input_dir = pathlib.Path(input_dir)
+    store_path, stage = get_zarr_location(input_dir / "_")
+    stage = stage.split("/")[0]
+    if not (store_path / stage / "zarr.json").exists():
+        return []
+    zarr = _import_zarr()
+    stage_group = zarr.open_group(store_path, mode="r")[stage]
+    return sorted(
+        str(input_dir / array.attrs.get("file_name", f"{name}.tiff"))
+        for name, array in stage_group.arrays()
+    )
+
+
+def export_zarr_images_to_tiff(input_dir: str | pathlib.Path) -> list[str]:
+    """
+    Write the zarr images of a ``{stage}/{well_fov}`` directory out as TIFFs.
+
+    CellProfiler only reads TIFFs, so stages that hand images to CellProfiler
+    export them from the zarr backend first.
+
+    Parameters
+    ----------
+    input_dir : str | pathlib.Path
+        The ``{stage}/{well_fov}`` directory to write the TIFFs to.
+
+    Returns
+    -------
+    list[str]
+        Paths of the TIFFs that were written.
+    """
+    # imported here to avoid a circular import with file_writing
+    from image_analysis_2D.file_utils.file_writing import write_tiff_atomic
+
+    exported_files = []
+    for image_path in list_zarr_images(input_dir):
+        if not pathlib.Path(image_path).exists():
+            write_tiff_atomic(pathlib.Path(image_path), read_zarr_image(image_path))
+            exported_files.append(image_path)
+    return exported_files
@@ -0,0 +1,927 @@
+"""In-process BaSiC illumination correction of the projected images of a patient."""
+
+from __future__ import annotations
+
+import collections
+import pathlib
+import re
+import time
+
+import numpy as np
+import pandas as pd
+import scipy.ndimage
+import skimage
+from image_analysis_2D.file_utils.file_reading import (
+    find_files_available,
+    image_exists,
+    read_image,
+)
+from image_analysis_2D.file_utils.file_writing import write_image, write_npy_atomic
+from image_analysis_2D.file_utils.io_pipeline import iter_prefetched, run_io_pipeline
+from image_analysis_2D.file_utils.manifest import get_parameter_version
+
+# projection stage -> illumination corrected stage under 2D_analysis
+ILLUMINATION_CORRECTION_STAGES: dict[str, str] = {
+    "0a.zmax_proj": "1a.zmax_proj_illum_correction",
+    "0b.middle_slice": "1b.middle_slice_illum_correction",
+    "0c.middle_n_slice_max_proj": "1c.middle_n_slice_max_proj_illum_correction",
+}
+ILLUMINATION_CHANNELS: list[str] = ["405", "488", "555", "640", "TRANS"]
+# suffix CellProfiler's SaveImages appended to the corrected images
+ILLUMINATION_CORRECTION_SUFFIX = "_illumcorrect"
+# images are downsampled to working_size x working_size to estimate the
+# illumination functions, as BaSiC does
+ILLUMINATION_WORKING_SIZE = 128
+ILLUMINATION_BACKENDS = {"basicpy", "numpy"}
+# bump when the estimation changes in a way the parameters do not capture
+ILLUMINATION_CACHE_VERSION = 1
+# directory under 2D_analysis holding the cached illumination functions
+ILLUMINATION_CACHE_DIR_NAME = "illumination_functions"
+ILLUMINATION_FIELDS = ["flatfield", "darkfield"]
+# number of images the subsampled estimation mode fits on per channel
+ILLUMINATION_SUBSAMPLE_SIZE = 64
+# metrics of compare_illumination_functions reported by the convergence check
+ILLUMINATION_CONVERGENCE_METRICS = [
+    "flatfield_rmse",
+    "flatfield_max_abs_error",
+    "darkfield_rmse",
+]
+
+
+def get_illumination_backend(backend: str | None = None) -> str:
+    """
+    Get the backend that estimates the illumination functions.
+
+    Parameters
+    ----------
+    backend : str | None, optional
+        ``"basicpy"`` or ``"numpy"``, by default None which uses basicpy if
+        it can be imported and the NumPy estimator otherwise.
+
+    Returns
+    -------
+    str
+        The backend.
+
+    Raises
+    ------
+    ValueError
+        If the backend is unknown.
+    """
+    if backend is None:
+        try:
+            import basicpy  # noqa: F401
+        except ImportError as e:
+            print(f"Could not import basicpy ({e}), using the NumPy estimator")
+            return "numpy"
+        return "basicpy"
+    if backend not in ILLUMINATION_BACKENDS:
+        raise ValueError(
+            f"Unknown illumination backend: {backend}, expected one of {sorted(ILLUMINATION_BACKENDS)}"
+        )
+    return backend
+
+
+def get_channel_image_files(
+    input_dir: pathlib.Path, channels: list[str] = ILLUMINATION_CHANNELS
+) -> dict[str, list[str]]:
+    """
+    Group the projected images of every well_fov of a stage by channel.
+
+    Segmentation masks in the same directories are left out.
+
+    Parameters
+    ----------
+    input_dir : pathlib.Path
+        Projection stage directory, e.g. ``2D_analysis/0a.zmax_proj``.
+    channels : list[str], optional
+        Channels to include, by default ILLUMINATION_CHANNELS.
+
+    Returns
+    -------
+    dict[str, list[str]]
+        Sorted ``{well_fov}/{well_fov}_{channel}`` image paths of each channel.
+    """
+    channel_image_files: dict[str, list[str]] = {channel: [] for channel in channels}
+    for well_fov_dir in sorted(x for x in input_dir.glob("*") if x.is_dir()):
+        for image_file in find_files_available(well_fov_dir):
+            channel = pathlib.Path(image_file).stem.split("_")[-1]
+            if channel in channel_image_files:
+                channel_image_files[channel].append(image_file)
+    return channel_image_files
+
+
+def get_illumination_output_path(
+    image_file: str | pathlib.Path, output_dir: pathlib.Path
+) -> pathlib.Path:
+    """
+    Build the output path of an illumination corrected image.
+
+    e.g. ``0a.zmax_proj/C4-2/C4-2_405.tif`` ->
+    ``{output_dir}/C4-2/C4-2_405_illumcorrect.tiff``, the name CellProfiler used.
+
+    Parameters
+    ----------
+    image_file : str | pathlib.Path
+        Path to the projected image.
+    output_dir : pathlib.Path
+        Illumination corrected stage directory.
+
+    Returns
+    -------
+    pathlib.Path
+        Path to write the corrected image to.
+    """
+    image_file = pathlib.Path(image_file)
+    return (
+        output_dir
+        / image_file.parent.name
+        / f"{image_file.stem}{ILLUMINATION_CORRECTION_SUFFIX}.tiff"
+    )
+
+
+def get_plate_position(image_file: str | pathlib.Path) -> tuple[str, str]:
+    """
+    Get the plate row and well of an image from its well_fov directory.
+
+    e.g. ``0a.zmax_proj/C4-2/C4-2_405.tif`` -> ``("C", "C4")``.
+
+    Parameters
+    ----------
+    image_file : str | pathlib.Path
+        Path to the image.
+
+    Returns
+    -------
+    tuple[str, str]
+        The row and well.
+    """
+    well = pathlib.Path(image_file).parent.name.split("-")[0]
+    row_match = re.match(r"[A-Za-z]+", well)
+    return (row_match.group() if row_match else well), well
+
+
+def select_stratified_subset(
+    image_files: list[str], subsample_size: int, seed: int = 0
+) -> list[str]:
+    """
+    Draw a random subset of images spread evenly across plate rows and wells.
+
+    Rows are visited in turn and each takes the next image of its next
+    well, so every row, and every well within a row, contributes as equally
+    as its number of images allows.
+    Wells and fovs are shuffled with the seed, so the subset is reproducible.
+
+    Parameters
+    ----------
+    image_files : list[str]
+        Paths to the images of one channel across the well_fovs of a patient.
+    subsample_size : int
+        Number of images to select.
+    seed : int, optional
+        Random seed, by default 0.
+
+    Returns
+    -------
+    list[str]
+        Sorted paths of the selected images, all images if there are no
+        more than ``subsample_size``.
+    """
+    if len(image_files) <= subsample_size:
+        return sorted(image_files)
+    rng = np.random.default_rng(seed)
+    rows: dict[str, dict[str, list[str]]] = collections.defaultdict(
+        lambda: collections.defaultdict(list)
+    )
+    for image_file in sorted(image_files):
+        row, well = get_plate_position(image_file)
+        rows[row][well].append(image_file)
+    # per row, a queue of wells each holding a queue of shuffled images
+    row_queues = {}
+    for row, wells in sorted(rows.items()):
+        well_names = sorted(wells)
+        rng.shuffle(well_names)
+        row_queues[row] = collections.deque(
+            collections.deque(rng.permutation(wells[well]).tolist())
+            for well in well_names
+        )
+    selected = []
+    while len(selected) < subsample_size:
+        for row in list(row_queues):
+            well_queue = row_queues[row]
+            well_images = well_queue.popleft()
+            selected.append(well_images.popleft())
+            if well_images:
+                well_queue.append(well_images)
+            if not well_queue:
+                del row_queues[row]
+            if len(selected) == subsample_size:
+                break
+    return sorted(selected)
+
+
+def compare_illumination_functions(
+    illumination_functions: dict[str, np.ndarray | str],
+    reference_functions: dict[str, np.ndarray | str],
+) -> dict[str, float]:
+    """
+    Measure how far illumination functions are from a reference fit.
+
+    Used to check that a fit on a subset of images converged to the fit on
+    all images.
+
+    Parameters
+    ----------
+    illumination_functions : dict[str, np.ndarray | str]
+        Output of estimate_illumination_functions, e.g. on a subset.
+    reference_functions : dict[str, np.ndarray | str]
+        Output of estimate_illumination_functions on all images.
+
+    Returns
+    -------
+    dict[str, float]
+        ``flatfield_rmse`` and ``flatfield_max_abs_error`` (the flat fields
+        have a mean of 1, so these are relative to the mean illumination)
+        and ``darkfield_rmse`` in intensity units.
+    """
+    flatfield_error = (
+        illumination_functions["flatfield"] - reference_functions["flatfield"]
+    )
+    darkfield_error = (
+        illumination_functions["darkfield"] - reference_functions["darkfield"]
+    )
+    return {
+        "flatfield_rmse": float(np.sqrt(np.mean(np.square(flatfield_error)))),
+        "flatfield_max_abs_error": float(np.abs(flatfield_error).max()),
+        "darkfield_rmse": float(np.sqrt(np.mean(np.square(darkfield_error)))),
+    }
+
+
+def read_downsampled_images(
+    image_files: list[str],
+    working_size: int = ILLUMINATION_WORKING_SIZE,
+    prefetch: int = 4,
+) -> tuple[np.ndarray, tuple[int, ...]]:
+    """
+    Read images downsampled to the working size of the estimation.
+
+    Parameters
+    ----------
+    image_files : list[str]
+        Paths to the images of one channel.
+    working_size : int, optional
+        Side of the downsampled images, by default ILLUMINATION_WORKING_SIZE.
+    prefetch : int, optional
+        Number of images read ahead on a reader thread, by default 4.
+
+    Returns
+    -------
+    tuple[np.ndarray, tuple[int, ...]]
+        The (N, working_size, working_size) float32 images and the full
+        resolution image shape.
+
+    Raises
+    ------
+    ValueError
+        If an image cannot be read or the images differ in shape.
+    """
+    images = np.empty((len(image_files), working_size, working_size), np.float32)
+    image_shape = None
+    for i, (image_file, image, error) in enumerate(
+        iter_prefetched(image_files, read_image, num_readers=1, prefetch=prefetch)
+    ):
+        if error is not None:
+            raise ValueError(f"Could not read {image_file}: {error}") from error
+        if image_shape is None:
+            image_shape = image.shape
+        elif image.shape != image_shape:
+            raise ValueError(
+                f"{image_file} has shape {image.shape}, expected {image_shape}"
+            )
+        images[i] = skimage.transform.resize(
+            image.astype(np.float32),
+            (working_size, working_size),
+            anti_aliasing=True,
+            preserve_range=True,
+        )
+    return images, image_shape
+
+
+def fit_illumination_basicpy(
+    images: np.ndarray, get_darkfield: bool = False
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Estimate the flat and dark field with BaSiCPy.
+
+    Parameters
+    ----------
+    images : np.ndarray
+        The (N, Y, X) downsampled images of one channel.
+    get_darkfield : bool, optional
+        Estimate the dark field, by default False (a zero dark field).
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        The (Y, X) flat field and dark field.
+    """
+    from basicpy import BaSiC
+
+    basic = BaSiC(get_darkfield=get_darkfield, working_size=images.shape[-1])
+    basic.fit(images)
+    return np.asarray(basic.flatfield), np.asarray(basic.darkfield)
+
+
+def fit_illumination_numpy(
+    images: np.ndarray,
+    get_darkfield: bool = False,
+    smoothness: float = 8.0,
+    darkfield_percentile: float = 1.0,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Estimate the flat and dark field with the robust BaSiC image model in NumPy.
+
+    Images are modelled as ``image = baseline * flatfield + darkfield``.
+    Each image is divided by its mean so every well_fov weighs the same, the
+    per-pixel median across images (robust to the sparse organoids) is
+    smoothed and normalized to a mean of 1 as the flat field.
+    The dark field is the part of the smoothed per-pixel low percentile
+    that the flat field does not explain.
+
+    Parameters
+    ----------
+    images : np.ndarray
+        The (N, Y, X) downsampled images of one channel.
+    get_darkfield : bool, optional
+        Estimate the dark field, by default False (a zero dark field).
+    smoothness : float, optional
+        Sigma of the Gaussian smoothing in working size pixels, by default 8.0.
+    darkfield_percentile : float, optional
+        Per-pixel percentile used for the dark field, by default 1.0.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        The (Y, X) flat field and dark field.
+    """
+    image_means = images.mean(axis=(1, 2), keepdims=True)
+    normalized = images / np.maximum(image_means, np.finfo(np.float32).tiny)
+    flatfield = scipy.ndimage.gaussian_filter(
+        np.median(normalized, axis=0), sigma=smoothness, mode="reflect"
+    )
+    flatfield /= flatfield.mean()
+    darkfield = np.zeros_like(flatfield)
+    if get_darkfield:
+        low = scipy.ndimage.gaussian_filter(
+            np.percentile(images, darkfield_percentile, axis=0),
+            sigma=smoothness,
+            mode="reflect",
+        )
+        darkfield = np.maximum(low - (low / flatfield).min() * flatfield, 0)
+    return flatfield, darkfield
+
+
+def get_illumination_cache_key(
+    image_files: list[str],
+    backend: str,
+    get_darkfield: bool = False,
+    working_size: int = ILLUMINATION_WORKING_SIZE,
+    subsample_size: int | None = None,
+    subsample_seed: int = 0,
+) -> str:
+    """
+    Hash the input set and parameters of the illumination functions of a channel.
+
+    The input set is the ``{well_fov}/{file name}``, size and modification
+    time of every image, so adding, removing or re-projecting a well_fov
+    changes the key without reading the images.
+
+    Parameters
+    ----------
+    image_files : list[str]
+        Paths to the images of one channel across the well_fovs of a patient.
+    backend : str
+        ``"basicpy"`` or ``"numpy"``.
+    get_darkfield : bool, optional
+        Estimate the dark field, by default False.
+    working_size : int, optional
+        Side of the downsampled images, by default ILLUMINATION_WORKING_SIZE.
+    subsample_size : int | None, optional
+        Number of images fit on, by default None (all images).
+    subsample_seed : int, optional
+        Random seed of the subset, by default 0.
+
+    Returns
+    -------
+    str
+        Hex digest of the input set and parameters.
+    """
+    input_set = []
+    for image_file in sorted(image_files):
+        image_file = pathlib.Path(image_file)
+        # images without a file (e.g. the zarr backend) are keyed by name only
+        stat = image_file.stat() if image_file.is_file() else None
+        input_set.append(
+            (
+                f"{image_file.parent.name}/{image_file.name}",
+                None if stat is None else stat.st_size,
+                None if stat is None else stat.st_mtime_ns,
+            )
+        )
+    parameters = {
+        "cache_version": ILLUMINATION_CACHE_VERSION,
+        "backend": backend,
+        "fit": (
+            fit_illumination_basicpy if backend == "basicpy" else fit_illumination_numpy
+        ),
+        "get_darkfield": get_darkfield,
+        "working_size": working_size,
+        "inputs": input_set,
+    }
+    if subsample_size is not None:
+        # fits on all images keep their keys
+        parameters["subsample"] = (subsample_size, subsample_seed)
+    return get_parameter_version(parameters)
+
+
+def get_illumination_cache_paths(
+    cache_dir: pathlib.Path, channel: str, cache_key: str
+) -> dict[str, pathlib.Path]:
+    """
+    Build the paths of the cached illumination functions of a channel.
+
+    Parameters
+    ----------
+    cache_dir : pathlib.Path
+        Cache directory of a projection stage, e.g.
+        ``2D_analysis/illumination_functions/0a.zmax_proj``.
+    channel : str
+        The channel.
+    cache_key : str
+        Output of get_illumination_cache_key.
+
+    Returns
+    -------
+    dict[str, pathlib.Path]
+        ``{channel}_{cache_key}_{field}.npy`` path of each field.
+    """
+    return {
+        field_name: cache_dir / f"{channel}_{cache_key}_{field_name}.npy"
+        for field_name in ILLUMINATION_FIELDS
+    }
+
+
+def find_stale_illumination_functions(
+    cache_dir: pathlib.Path, channel: str, cache_key: str
+) -> list[pathlib.Path]:
+    """
+    Find the cached illumination functions of a channel with another key.
+
+    Parameters
+    ----------
+    cache_dir : pathlib.Path
+        Cache directory of a projection stage.
+    channel : str
+        The channel.
+    cache_key : str
+        Current key of the channel.
+
+    Returns
+    -------
+    list[pathlib.Path]
+        Cached files of the channel that were estimated from another input
+        set or with other parameters.
+    """
+    current_paths = set(
+        get_illumination_cache_paths(cache_dir, channel, cache_key).values()
+    )
+    return sorted(
+        cache_path
+        for cache_path in cache_dir.glob(f"{channel}_*.npy")
+        if cache_path not in current_paths
+    )
+
+
+def load_illumination_functions(
+    cache_dir: pathlib.Path, channel: str, cache_key: str
+) -> dict[str, np.ndarray] | None:
+    """
+    Load the cached illumination functions of a channel.
+
+    Parameters
+    ----------
+    cache_dir : pathlib.Path
+        Cache directory of a projection stage.
+    channel : str
+        The channel.
+    cache_key : str
+        Output of get_illumination_cache_key.
+
+    Returns
+    -------
+    dict[str, np.ndarray] | None
+        The ``flatfield`` and ``darkfield``, None if they are not cached or
+        cannot be read.
+    """
+    cache_paths = get_illumination_cache_paths(cache_dir, channel, cache_key)
+    if not all(cache_path.exists() for cache_path in cache_paths.values()):
+        return None
+    try:
+        return {
+            field_name: np.load(cache_path)
+            for field_name, cache_path in cache_paths.items()
+        }
+    except (OSError, ValueError) as e:
+        print(f"Could not read the cached {channel} illumination functions: {e}")
+        return None
+
+
+def save_illumination_functions(
+    cache_dir: pathlib.Path,
+    channel: str,
+    cache_key: str,
+    illumination_functions: dict[str, np.ndarray | str],
+) -> None:
+    """
+    Cache the illumination functions of a channel.
+
+    The stale functions of the channel are kept until the images corrected
+    with them have been rewritten (see remove_stale_illumination_functions).
+
+    Parameters
+    ----------
+    cache_dir : pathlib.Path
+        Cache directory of a projection stage.
+    channel : str
+        The channel.
+    cache_key : str
+        Output of get_illumination_cache_key.
+    illumination_functions : dict[str, np.ndarray | str]
+        Output of estimate_illumination_functions.
+    """
+    for field_name, cache_path in get_illumination_cache_paths(
+        cache_dir, channel, cache_key
+    ).items():
+        write_npy_atomic(illumination_functions[field_name], cache_path)
+
+
+def remove_stale_illumination_functions(
+    cache_dir: pathlib.Path, channel: str, cache_key: str
+) -> None:
+    """
+    Remove the cached illumination functions of a channel with another key.
+
+    Only call this once every image of the channel has been corrected with
+    the current functions, as the stale files mark the corrected images that
+    still have to be rewritten.
+
+    Parameters
+    ----------
+    cache_dir : pathlib.Path
+        Cache directory of a projection stage.
+    channel : str
+        The channel.
+    cache_key : str
+        Current key of the channel.
+    """
+    for stale_path in find_stale_illumination_functions(cache_dir, channel, cache_key):
+        stale_path.unlink(missing_ok=True)
+
+
+def estimate_illumination_functions(
+    image_files: list[str],
+    backend: str | None = None,
+    get_darkfield: bool = False,
+    working_size: int = ILLUMINATION_WORKING_SIZE,
+    subsample_size: int | None = None,
+    subsample_seed: int = 0,
+) -> dict[str, np.ndarray | str]:
+    """
+    Estimate the illumination functions of one channel from its images.
+
+    With ``subsample_size`` the functions are fit on a stratified random
+    subset of the images (see select_stratified_subset), so the cost of the
+    estimation stops growing with the number of well_fovs.
+
+    Parameters
+    ----------
+    image_files : list[str]
+        Paths to the images of one channel across the well_fovs of a patient.
+    backend : str | None, optional
+        ``"basicpy"`` or ``"numpy"``, by default None (see get_illumination_backend).
+    get_darkfield : bool, optional
+        Estimate the dark field, by default False (a zero dark field).
+    working_size : int, optional
+        Side of the downsampled images, by default ILLUMINATION_WORKING_SIZE.
+    subsample_size : int | None, optional
+        Number of images to fit on, by default None (all images).
+    subsample_seed : int, optional
+        Random seed of the subset, by default 0.
+
+    Returns
+    -------
+    dict[str, np.ndarray | str]
+        The full resolution float32 ``flatfield`` and ``darkfield`` and the
+        ``backend`` used.
+    """
+    backend = get_illumination_backend(backend)
+    if subsample_size is not None:
+        image_files = select_stratified_subset(
+            image_files, subsample_size, seed=subsample_seed
+        )
+    images, image_shape = read_downsampled_images(image_files, working_size)
+    if backend == "basicpy":
+        flatfield, darkfield = fit_illumination_basicpy(images, get_darkfield)
+    else:
+        flatfield, darkfield = fit_illumination_numpy(images, get_darkfield)
+    return {
+        field_name: skimage.transform.resize(
+            field, image_shape, order=1, preserve_range=True, anti_aliasing=False
+        ).astype(np.float32)
+        for field_name, field in {
+            "flatfield": flatfield,
+            "darkfield": darkfield,
+        }.items()
+    } | {"backend": backend}
+
+
+def apply_illumination_correction(
+    image: np.ndarray,
+    flatfield: np.ndarray,
+    darkfield: np.ndarray | None = None,
+) -> np.ndarray:
+    """
+    Correct an image (or a stack of images) in float32.
+
+    ``corrected = (image - darkfield) / flatfield``, clipped to the range of
+    integer images and rounded back to their dtype.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        The (Y, X) image or (N, Y, X) images.
+    flatfield : np.ndarray
+        The (Y, X) flat field.
+    darkfield : np.ndarray | None, optional
+        The (Y, X) dark field, by default None.
+
+    Returns
+    -------
+    np.ndarray
+        The corrected image(s) in the dtype of the input.
+    """
+    corrected = image.astype(np.float32)
+    if darkfield is not None:
+        np.subtract(corrected, darkfield, out=corrected)
+    np.divide(corrected, flatfield, out=corrected)
+    if np.issubdtype(image.dtype, np.integer):
+        dtype_info = np.iinfo(image.dtype)
+        np.clip(corrected, dtype_info.min, dtype_info.max, out=corrected)
+        np.rint(corrected, out=corrected)
+    return corrected.astype(image.dtype)
+
+
+def correct_channel_images(
+    image_files: list[str],
+    output_dir: pathlib.Path,
+    illumination_functions: dict[str, np.ndarray | str],
+    prefetch: int = 4,
+) -> list[dict[str, str | None]]:
+    """
+    Correct and write images while the next ones are read and the last ones written.
+
+    Parameters
+    ----------
+    image_files : list[str]
+        Paths to the images to correct.
+    output_dir : pathlib.Path
+        Illumination corrected stage directory.
+    illumination_functions : dict[str, np.ndarray | str]
+        Output of estimate_illumination_functions.
+    prefetch : int, optional
+        Number of images read ahead, by default 4.
+
+    Returns
+    -------
+    list[dict[str, str | None]]
+        The ``image_file`` and ``error`` (None on success) of every image.
+    """
+    pipeline_records = run_io_pipeline(
+        image_files,
+        read_function=read_image,
+        compute_function=lambda image_file, image: apply_illumination_correction(
+            image,
+            illumination_functions["flatfield"],
+            illumination_functions["darkfield"],
+        ),
+        write_function=lambda image_file, corrected: write_image(
+            get_illumination_output_path(image_file, output_dir), corrected
+        ),
+        num_readers=1,
+        prefetch=prefetch,
+    )
+    return [
+        {
+            "image_file": record["item"],
+            "error": None
+            if record["error"] is None
+            else f"{type(record['error']).__name__}: {record['error']}",
+        }
+        for record in pipeline_records
+    ]
+
+
+def run_illumination_correction(
+    analysis_dir: pathlib.Path,
+    stages: dict[str, str] = ILLUMINATION_CORRECTION_STAGES,
+    channels: list[str] = ILLUMINATION_CHANNELS,
+    backend: str | None = None,
+    get_darkfield: bool = False,
+    overwrite: bool = False,
+    prefetch: int = 4,
+    cache_dir: pathlib.Path | None = None,
+    subsample_size: int | None = None,
+    subsample_seed: int = 0,
+    check_convergence: bool = False,
+) -> pd.DataFrame:
+    """
+    Illumination correct the projected images of a patient.
+
+    One flat field (and optionally dark field) is estimated per projection
+    stage and channel from the images of every well_fov of the patient and
+    applied to each image, replacing one CellProfiler run per well_fov.
+    The functions are cached as ``.npy`` files keyed by the input set and
+    parameters (see get_illumination_cache_key) and reused by reruns.
+    Only the missing corrected images (or all of them if ``overwrite``) are
+    written, unless the input set or parameters changed since the cached
+    functions were estimated (e.g. a well_fov was added), in which case the
+    functions are estimated again and every image of the channel is rewritten.
+    A channel without any cached functions (e.g. corrected by CellProfiler
+    before) is rewritten entirely too, so its images are never corrected by
+    two different methods.
+    With ``subsample_size`` the functions are fit on a stratified subset of
+    the images of each channel, and ``check_convergence`` additionally fits
+    all images to report how far the subset fit is from the full fit.
+
+    Parameters
+    ----------
+    analysis_dir : pathlib.Path
+        The ``2D_analysis`` directory of the patient.
+    stages : dict[str, str], optional
+        Projection stage to corrected stage directories, by default
+        ILLUMINATION_CORRECTION_STAGES.
+    channels : list[str], optional
+        Channels to correct, by default ILLUMINATION_CHANNELS.
+    backend : str | None, optional
+        ``"basicpy"`` or ``"numpy"``, by default None (see get_illumination_backend).
+    get_darkfield : bool, optional
+        Estimate and subtract a dark field, by default False.
+    overwrite : bool, optional
+        Rewrite corrected images that already exist, by default False.
+    prefetch : int, optional
+        Number of images read ahead, by default 4.
+    cache_dir : pathlib.Path | None, optional
+        Directory of the cached illumination functions, by default None
+        which uses ``{analysis_dir}/illumination_functions``.
+    subsample_size : int | None, optional
+        Number of images to fit on per channel, by default None (all images).
+        ILLUMINATION_SUBSAMPLE_SIZE is a good start for a plate.
+    subsample_seed : int, optional
+        Random seed of the subsets, by default 0.
+    check_convergence : bool, optional
+        Also fit all images and compare them to the subset fit (see
+        compare_illumination_functions), by default False.
+        Only done when the functions are estimated, not loaded from the cache.
+
+    Returns
+    -------
+    pd.DataFrame
+        One summary record per stage and channel with the number of images,
+        the number fit on, the number corrected and failed, the backend,
+        whether the cached functions were used, the convergence metrics,
+        the errors and the time taken.
+    """
+    backend = get_illumination_backend(backend)
+    if cache_dir is None:
+        cache_dir = analysis_dir / ILLUMINATION_CACHE_DIR_NAME
+    records = []
+    for input_stage, output_stage in stages.items():
+        input_dir = analysis_dir / input_stage
+        output_dir = analysis_dir / output_stage
+        stage_cache_dir = cache_dir / input_stage
+        if not input_dir.exists():
+            print(f"No projected images in {input_dir}, skipping")
+            continue
+        for channel, image_files in get_channel_image_files(
+            input_dir, channels
+        ).items():
+            if len(image_files) == 0:
+                continue
+            start_time = time.time()
+            record = {
+                "stage": output_stage,
+                "channel": channel,
+                "number_of_images": len(image_files),
+                "number_of_images_fit": (
+                    len(image_files)
+                    if subsample_size is None
+                    else min(subsample_size, len(image_files))
+                ),
+                "number_corrected": 0,
+                "number_failed": 0,
+                "backend": backend,
+                "cache_hit": False,
+                **dict.fromkeys(ILLUMINATION_CONVERGENCE_METRICS),
+                "errors": None,
+                "time_taken_seconds": 0.0,
+            }
+            records.append(record)
+            cache_key = get_illumination_cache_key(
+                image_files,
+                backend=backend,
+                get_darkfield=get_darkfield,
+                subsample_size=subsample_size,
+                subsample_seed=subsample_seed,
+            )
+            # corrected images without cached functions were not written by this
+            # function (e.g. by the CellProfiler illumination correction)
+            channel_cached = any(stage_cache_dir.glob(f"{channel}_*.npy"))
+            illumination_functions = load_illumination_functions(
+                stage_cache_dir, channel, cache_key
+            )
+            record["cache_hit"] = illumination_functions is not None
+            # corrected images written with the functions of another input set
+            # or other parameters are rewritten, the stale functions are only
+            # removed once all of them were, so an interrupted or partly failed
+            # run rewrites them again on the next run
+            functions_changed = bool(
+                find_stale_illumination_functions(stage_cache_dir, channel, cache_key)
+            )
+            files_to_correct = [
+                image_file
+                for image_file in image_files
+                if overwrite
+                or functions_changed
+                or not channel_cached
+                or not image_exists(
+                    get_illumination_output_path(image_file, output_dir)
+                )
+            ]
+            if len(files_to_correct) == 0:
+                continue
+            try:
+                if illumination_functions is None:
+                    illumination_functions = estimate_illumination_functions(
+                        image_files,
+                        backend=backend,
+                        get_darkfield=get_darkfield,
+                        subsample_size=subsample_size,
+                        subsample_seed=subsample_seed,
+                    )
+                    if check_convergence and subsample_size is not None:
+                        record |= compare_illumination_functions(
+                            illumination_functions,
+                            estimate_illumination_functions(
+                                image_files,
+                                backend=backend,
+                                get_darkfield=get_darkfield,
+                            ),
+                        )
+                    save_illumination_functions(
+                        stage_cache_dir, channel, cache_key, illumination_functions
+                    )
+                image_records = correct_channel_images(
+                    files_to_correct, output_dir, illumination_functions, prefetch
+                )
+            except Exception as e:
+                image_records = [
+                    {"image_file": image_file, "error": f"{type(e).__name__}: {e}"}
+                    for image_file in files_to_correct
+                ]
+            errors = [
+                f"{image_record['image_file']}: {image_record['error']}"
+                for image_record in image_records
+                if image_record["error"] is not None
+            ]
+            if functions_changed and len(errors) == 0:
+                remove_stale_illumination_functions(stage_cache_dir, channel, cache_key)
+            if not channel_cached and len(errors) > 0:
+                # without cached functions the next run rewrites the whole
+                # channel again, including the images that failed here
+                for cache_path in get_illumination_cache_paths(
+                    stage_cache_dir, channel, cache_key
+                ).values():
+                    cache_path.unlink(missing_ok=True)
+            record["number_failed"] = len(errors)
+            record["number_corrected"] = len(image_records) - len(errors)
+            record["errors"] = "\n".join(errors) if errors else None
+            record["time_taken_seconds"] = time.time() - start_time
+    run_summary = pd.DataFrame.from_records(records)
+    if len(run_summary) > 0:
+        print(
+            f"Corrected: {run_summary['number_corrected'].sum()}, "
+            f"failed: {run_summary['number_failed'].sum()} images"
+        )
+        for errors in run_summary["errors"].dropna():
+            print(f"Failed to correct {errors}")
+    return run_summary
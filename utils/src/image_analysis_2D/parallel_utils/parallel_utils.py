@@ -0,0 +1,142 @@
+"""
+This collection of functions sizes process and thread pools from the CPUs and memory
+available to this process, for every stage that runs work in parallel.
+"""
+
+from __future__ import annotations
+
+import multiprocessing
+import os
+
+import psutil
+from image_analysis_2D.errors.exceptions import MaxWorkerError
+
+
+def get_available_cpus() -> int:
+    """
+    Get the number of CPUs this process is allowed to run on.
+
+    On SLURM nodes this is the CPU set of the allocation rather than every
+    core on the node.
+
+    Returns
+    -------
+    int
+        Number of usable CPUs.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return multiprocessing.cpu_count()
+
+
+def get_max_workers(max_workers: int | None = None, name: str = "max_workers") -> int:
+    """
+    Get the upper bound on the number of workers from the available CPUs.
+
+    Parameters
+    ----------
+    max_workers : int | None, optional
+        Requested upper bound, by default None (number of CPUs).
+    name : str, optional
+        Name of the argument in the error message, by default "max_workers".
+
+    Returns
+    -------
+    int
+        The upper bound.
+
+    Raises
+    ------
+    MaxWorkerError
+        If max_workers exceeds the number of available CPUs.
+    """
+    available_cpus = get_available_cpus()
+    if max_workers is None:
+        return available_cpus
+    if max_workers > available_cpus:
+        raise MaxWorkerError(
+            f"{name} ({max_workers}) exceeds the {available_cpus} available CPUs"
+        )
+    return max_workers
+
+
+def get_available_memory(memory_fraction: float = 0.8) -> float:
+    """
+    Get the memory workers may use.
+
+    Parameters
+    ----------
+    memory_fraction : float, optional
+        Fraction of the currently available memory the workers may use, by default 0.8.
+
+    Returns
+    -------
+    float
+        Memory in bytes.
+    """
+    return psutil.virtual_memory().available * memory_fraction
+
+
+def get_memory_bound_worker_count(
+    per_worker_memory: int,
+    number_of_tasks: int,
+    max_workers: int | None = None,
+    memory_fraction: float = 0.8,
+) -> int:
+    """
+    Size a pool from the available CPUs and memory.
+
+    Parameters
+    ----------
+    per_worker_memory : int
+        Estimated peak memory of one worker in bytes.
+    number_of_tasks : int
+        Number of tasks the pool runs.
+    max_workers : int | None, optional
+        Upper bound on the number of workers, by default None (number of CPUs).
+    memory_fraction : float, optional
+        Fraction of the currently available memory the pool may use, by default 0.8.
+
+    Returns
+    -------
+    int
+        Number of workers (at least 1).
+
+    Raises
+    ------
+    MaxWorkerError
+        If max_workers exceeds the number of available CPUs.
+    """
+    max_workers = get_max_workers(max_workers)
+    memory_bound_workers = int(
+        get_available_memory(memory_fraction) // max(per_worker_memory, 1)
+    )
+    return max(1, min(max_workers, memory_bound_workers, number_of_tasks))
+
+
+def get_process_tree_rss(process: psutil.Process) -> int:
+    """
+    Get the resident memory of a process and all of its children.
+
+    Parameters
+    ----------
+    process : psutil.Process
+        The process, e.g. ``apptainer exec`` whose child is CellProfiler.
+
+    Returns
+    -------
+    int
+        Resident memory in bytes, 0 if the process has exited.
+    """
+    rss = 0
+    try:
+        processes = [process] + process.children(recursive=True)
+    except psutil.Error:
+        return 0
+    for tree_process in processes:
+        try:
+            rss += tree_process.memory_info().rss
+        except psutil.Error:
+            # the process exited between listing and reading it
+            continue
+    return rss
@@ -0,0 +1,263 @@
+"""Per z-slice statistics of raw z-stacks, computed while projecting."""
+
+from __future__ import annotations
+
+import pathlib
+
+import numpy as np
+import pandas as pd
+import scipy.ndimage
+from image_analysis_2D.file_utils.file_writing import write_parquet_atomic
+
+# percentiles of the z-slice intensities stored in the plane statistics index
+PLANE_STATISTICS_PERCENTILES: list[int] = [1, 5, 50, 95, 99]
+
+
+def get_channel_from_filename(tiff_file: pathlib.Path) -> str:
+    """
+    Get the channel token of a z-stack from its file name.
+
+    Parameters
+    ----------
+    tiff_file : pathlib.Path
+        Path to a ``{well_fov}_{channel}.tif`` z-stack image.
+
+    Returns
+    -------
+    str
+        The channel token, e.g. ``"405"`` or ``"TRANS"``.
+    """
+    return pathlib.Path(tiff_file).stem.split("_")[-1]
+
+
+def compute_plane_statistics(
+    plane: np.ndarray,
+    percentiles: list[int] = PLANE_STATISTICS_PERCENTILES,
+) -> dict[str, float]:
+    """
+    Compute the intensity and focus statistics of one z-slice.
+
+    The focus score is the variance of the Laplacian: in focus z-slices have
+    sharp edges and therefore a high variance of the second derivative.
+
+    Parameters
+    ----------
+    plane : np.ndarray
+        The (Y, X) z-slice.
+    percentiles : list[int], optional
+        Intensity percentiles to compute, by default PLANE_STATISTICS_PERCENTILES.
+
+    Returns
+    -------
+    dict[str, float]
+        Mapping of statistic name to value.
+    """
+    plane = plane.astype(np.float32, copy=False)
+    plane_statistics = {
+        "min": float(plane.min()),
+        "max": float(plane.max()),
+        "mean": float(plane.mean()),
+        "std": float(plane.std()),
+    }
+    for percentile, value in zip(percentiles, np.percentile(plane, percentiles)):
+        plane_statistics[f"percentile_{percentile}"] = float(value)
+    plane_statistics["focus_variance_of_laplacian"] = float(
+        scipy.ndimage.laplace(plane).var()
+    )
+    return plane_statistics
+
+
+def get_plane_statistics_record(
+    tiff_file: pathlib.Path, z_index: int, plane: np.ndarray
+) -> dict[str, str | int | float]:
+    """
+    Build one row of the plane statistics index.
+
+    Parameters
+    ----------
+    tiff_file : pathlib.Path
+        Path to the z-stack image.
+    z_index : int
+        Index of the z-slice within the z-stack.
+    plane : np.ndarray
+        The (Y, X) z-slice.
+
+    Returns
+    -------
+    dict[str, str | int | float]
+        The z-stack file, well_fov, channel, z-slice index and statistics.
+    """
+    return {
+        "zstack_file": str(tiff_file),
+        "well_fov": tiff_file.parent.name,
+        "channel": get_channel_from_filename(tiff_file),
+        "z_index": z_index,
+        **compute_plane_statistics(plane),
+    }
+
+
+def load_plane_statistics_index(plane_statistics_path: pathlib.Path) -> pd.DataFrame:
+    """
+    Load the plane statistics index of a patient.
+
+    Parameters
+    ----------
+    plane_statistics_path : pathlib.Path
+        Path to the plane statistics parquet file.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per z-slice, or an empty DataFrame if the index does not exist.
+    """
+    plane_statistics_path = pathlib.Path(plane_statistics_path)
+    if not plane_statistics_path.exists():
+        return pd.DataFrame()
+    return pd.read_parquet(plane_statistics_path)
+
+
+def update_plane_statistics_index(
+    plane_statistics_path: pathlib.Path,
+    plane_statistics_df: pd.DataFrame,
+) -> pd.DataFrame:
+    """
+    Add newly computed rows to the plane statistics index of a patient.
+
+    Rows of z-stacks that were recomputed replace their previous rows.
+    The index is written to a temporary file and renamed over the output so
+    that an interrupted run never leaves a truncated index.
+
+    Parameters
+    ----------
+    plane_statistics_path : pathlib.Path
+        Path to the plane statistics parquet file.
+    plane_statistics_df : pd.DataFrame
+        Newly computed rows.
+
+    Returns
+    -------
+    pd.DataFrame
+        The updated index.
+    """
+    plane_statistics_path = pathlib.Path(plane_statistics_path)
+    existing_df = load_plane_statistics_index(plane_statistics_path)
+    if len(existing_df) > 0 and len(plane_statistics_df) > 0:
+        existing_df = existing_df.loc[
+            ~existing_df["zstack_file"].isin(plane_statistics_df["zstack_file"])
+        ]
+    index_df = pd.concat([existing_df, plane_statistics_df], ignore_index=True)
+    if len(index_df) > 0:
+        index_df = index_df.sort_values(["zstack_file", "z_index"], ignore_index=True)
+    write_parquet_atomic(index_df, plane_statistics_path)
+    return index_df
+
+
+def get_zstacks_to_index(
+    tiff_files: list[pathlib.Path],
+    plane_statistics_path: pathlib.Path | None,
+    overwrite: bool = False,
+) -> set[pathlib.Path]:
+    """
+    Get the z-stacks whose plane statistics still need to be computed.
+
+    Parameters
+    ----------
+    tiff_files : list[pathlib.Path]
+        Paths to the z-stack images.
+    plane_statistics_path : pathlib.Path | None
+        Path to the plane statistics parquet file, None if no index is built.
+    overwrite : bool, optional
+        Recompute the statistics of every z-stack, by default False.
+
+    Returns
+    -------
+    set[pathlib.Path]
+        The z-stacks that are missing from the index.
+    """
+    if plane_statistics_path is None:
+        return set()
+    index_df = load_plane_statistics_index(plane_statistics_path)
+    if overwrite or len(index_df) == 0:
+        return set(tiff_files)
+    indexed_zstack_files = set(index_df["zstack_file"])
+    return {
+        tiff_file
+        for tiff_file in tiff_files
+        if str(tiff_file) not in indexed_zstack_files
+    }
+
+
+def pop_plane_statistics(records: list[dict]) -> pd.DataFrame:
+    """
+    Move the per z-slice statistics out of the projection summary records.
+
+    Parameters
+    ----------
+    records : list[dict]
+        Summary records from project_single_zstack, modified in place.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per z-slice of the z-stacks that were indexed.
+    """
+    plane_statistics = []
+    for record in records:
+        plane_statistics.extend(record.pop("plane_statistics", []))
+    return pd.DataFrame.from_records(plane_statistics)
+
+
+def get_best_focus_slices(plane_statistics_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Select the best focused z-slice of every z-stack from the index.
+
+    Parameters
+    ----------
+    plane_statistics_df : pd.DataFrame
+        The plane statistics index.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per z-stack: the z-slice with the highest variance of the Laplacian.
+    """
+    best_focus_index = plane_statistics_df.groupby("zstack_file")[
+        "focus_variance_of_laplacian"
+    ].idxmax()
+    return plane_statistics_df.loc[best_focus_index].reset_index(drop=True)
+
+
+def flag_empty_zstacks(
+    plane_statistics_df: pd.DataFrame, min_dynamic_range: float = 0.0
+) -> pd.DataFrame:
+    """
+    Flag z-stacks without signal from the index.
+
+    A z-stack is empty when no z-slice has a max - min intensity range above
+    ``min_dynamic_range`` (e.g. all black or saturated stacks).
+
+    Parameters
+    ----------
+    plane_statistics_df : pd.DataFrame
+        The plane statistics index.
+    min_dynamic_range : float, optional
+        Dynamic range a z-slice needs to count as signal bearing, by default 0.0.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per z-stack with the well_fov, channel and an ``is_empty`` column.
+    """
+    dynamic_range = plane_statistics_df["max"] - plane_statistics_df["min"]
+    zstack_df = (
+        plane_statistics_df.assign(
+            signal_bearing=dynamic_range > min_dynamic_range,
+        )
+        .groupby(["zstack_file", "well_fov", "channel"], as_index=False)[
+            "signal_bearing"
+        ]
+        .sum()
+        .rename(columns={"signal_bearing": "number_of_signal_bearing_slices"})
+    )
+    zstack_df["is_empty"] = zstack_df["number_of_signal_bearing_slices"] == 0
+    return zstack_df
@@ -0,0 +1,307 @@
+"""
+This collection of functions runs the z-projection engine over a process pool,
+sizing the number of workers from the available CPUs and memory.
+"""
+
+from __future__ import annotations
+
+import functools
+import pathlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import tifffile
+import tqdm
+from image_analysis_2D.file_utils.manifest import (
+    get_manifest_entries,
+    load_manifest,
+    pop_manifest_entries,
+    update_manifest,
+)
+from image_analysis_2D.parallel_utils.parallel_utils import (
+    get_available_cpus,
+    get_memory_bound_worker_count,
+)
+from image_analysis_2D.projection_utils.plane_statistics import (
+    get_zstacks_to_index,
+    pop_plane_statistics,
+    update_plane_statistics_index,
+)
+from image_analysis_2D.projection_utils.reduction_kernels import (
+    set_reduction_threads,
+)
+from image_analysis_2D.projection_utils.zstack_projection import (
+    PROJECTION_METHODS,
+    project_single_zstack,
+    project_zstacks_prefetched,
+    summarize_projection_run,
+)
+
+
+def estimate_zstack_projection_memory(
+    tiff_file: pathlib.Path,
+    number_of_projection_methods: int = len(PROJECTION_METHODS),
+    streaming: bool = False,
+) -> int:
+    """
+    Estimate the peak memory of projecting one z-stack from its TIFF header.
+
+    Parameters
+    ----------
+    tiff_file : pathlib.Path
+        Path to the z-stack image.
+    number_of_projection_methods : int, optional
+        Number of projections held in memory, by default len(PROJECTION_METHODS).
+    streaming : bool, optional
+        Whether the z-stack is streamed page by page, by default False.
+
+    Returns
+    -------
+    int
+        Estimated peak memory in bytes.
+    """
+    with tifffile.TiffFile(tiff_file) as tif:
+        series = tif.series[0]
+        shape = series.shape
+        itemsize = np.dtype(series.dtype).itemsize
+    plane_bytes = int(np.prod(shape[-2:])) * itemsize
+    # streaming holds the current and read-ahead planes, otherwise the whole stack
+    planes_read = 2 if streaming else int(np.prod(shape[:-2]))
+    return (planes_read + number_of_projection_methods) * plane_bytes
+
+
+def get_projection_worker_count(
+    per_worker_memory: int,
+    number_of_files: int,
+    max_workers: int | None = None,
+    memory_fraction: float = 0.8,
+) -> int:
+    """
+    Size the process pool from the available CPUs and memory.
+
+    Parameters
+    ----------
+    per_worker_memory : int
+        Estimated peak memory of one worker in bytes.
+    number_of_files : int
+        Number of z-stacks to project.
+    max_workers : int | None, optional
+        Upper bound on the number of workers, by default None (number of CPUs).
+    memory_fraction : float, optional
+        Fraction of the currently available memory the pool may use, by default 0.8.
+
+    Returns
+    -------
+    int
+        Number of workers (at least 1).
+
+    Raises
+    ------
+    MaxWorkerError
+        If max_workers exceeds the number of available CPUs.
+    """
+    return get_memory_bound_worker_count(
+        per_worker_memory=per_worker_memory,
+        number_of_tasks=number_of_files,
+        max_workers=max_workers,
+        memory_fraction=memory_fraction,
+    )
+
+
+def run_zstack_projections_parallel(
+    images_dir: pathlib.Path,
+    output_base_dir: pathlib.Path,
+    projection_methods: dict[str, dict] = PROJECTION_METHODS,
+    overwrite: bool = False,
+    streaming: bool = False,
+    read_ahead: bool = True,
+    max_workers: int | None = None,
+    memory_fraction: float = 0.8,
+    plane_statistics_path: pathlib.Path | None = None,
+    prefetch: int = 0,
+    chunk_size: int = 8,
+    manifest_path: pathlib.Path | None = None,
+) -> pd.DataFrame:
+    """
+    Project every z-stack in a directory across a process pool.
+
+    The number of workers is bounded by the available CPUs and by the
+    available memory divided by the per-worker memory estimate taken from the
+    largest z-stack header.
+    CPUs left over by a memory bound pool are split between the workers'
+    z-reductions (see reduction_kernels.reduce_zstack).
+    Each worker writes its outputs atomically, results are returned in the
+    sorted order of the z-stacks and failures are collected into the summary.
+    With ``prefetch`` each worker projects chunks of ``chunk_size`` z-stacks,
+    reading the next z-stacks and writing the last projections on background
+    threads while it projects (see project_zstacks_prefetched).
+
+    Parameters
+    ----------
+    images_dir : pathlib.Path
+        Directory containing the ``{well_fov}/*.tif`` z-stack images.
+    output_base_dir : pathlib.Path
+        The ``2D_analysis`` directory that holds the projection output directories.
+    projection_methods : dict[str, dict], optional
+        Projection methods to apply, by default PROJECTION_METHODS.
+        The functions must be picklable (module level functions or functools.partial).
+    overwrite : bool, optional
+        Recompute outputs that already exist, by default False.
+    streaming : bool, optional
+        Stream each z-stack page by page into running projections, by default False.
+    read_ahead : bool, optional
+        When streaming, double buffer the page reads, by default True.
+    max_workers : int | None, optional
+        Upper bound on the number of workers, by default None (number of CPUs).
+    memory_fraction : float, optional
+        Fraction of the currently available memory the pool may use, by default 0.8.
+    plane_statistics_path : pathlib.Path | None, optional
+        Parquet file of the per z-slice statistics index, by default None (no index).
+        Statistics of z-stacks missing from the index are computed by the
+        workers in the same pass as the projections and added to the index.
+    prefetch : int, optional
+        Number of z-stacks each worker reads ahead, by default 0 (no prefetching).
+        Cannot be combined with ``streaming``.
+    chunk_size : int, optional
+        Number of z-stacks per worker task when prefetching, by default 8.
+    manifest_path : pathlib.Path | None, optional
+        Parquet manifest of the projections, by default None (no manifest).
+        The workers decide which outputs are stale from their z-stack's
+        entries and the new entries are merged into the manifest here
+        (see zstack_projection.run_zstack_projections).
+
+    Returns
+    -------
+    pd.DataFrame
+        One summary record per z-stack (see project_single_zstack).
+
+    Raises
+    ------
+    ValueError
+        If both ``streaming`` and ``prefetch`` are set.
+    """
+    if streaming and prefetch > 0:
+        raise ValueError("streaming and prefetch cannot be combined")
+    tiff_files = sorted(images_dir.rglob("*.tif"))
+    if len(tiff_files) == 0:
+        print(f"No z-stacks found in {images_dir}")
+        return pd.DataFrame()
+
+    # z-stacks within a patient share a shape, so the largest header is read
+    # from the first few files rather than opening every file on GPFS
+    memory_estimates = []
+    for tiff_file in tiff_files[:8]:
+        try:
+            memory_estimates.append(
+                estimate_zstack_projection_memory(
+                    tiff_file,
+                    number_of_projection_methods=len(projection_methods),
+                    streaming=streaming,
+                )
+            )
+        except Exception as e:
+            # unreadable headers are reported as failures by the workers
+            print(f"Could not read the header of {tiff_file}: {e}")
+    per_worker_memory = max(memory_estimates, default=0)
+    if prefetch > 0:
+        # the z-stacks read ahead are held next to the one being projected
+        per_worker_memory *= prefetch + 1
+    num_workers = get_projection_worker_count(
+        per_worker_memory=per_worker_memory,
+        number_of_files=len(tiff_files),
+        max_workers=max_workers,
+        memory_fraction=memory_fraction,
+    )
+    # when memory bounds the pool, the idle CPUs thread each worker's reductions
+    reduction_threads = max(1, get_available_cpus() // num_workers)
+    print(
+        f"Projecting {len(tiff_files)} z-stacks with {num_workers} workers "
+        f"(~{per_worker_memory / 1024**2:.0f} MB and {reduction_threads} "
+        "reduction threads per worker)"
+    )
+
+    zstacks_to_index = get_zstacks_to_index(
+        tiff_files, plane_statistics_path, overwrite=overwrite
+    )
+    manifest_entries = (
+        None
+        if manifest_path is None
+        else get_manifest_entries(load_manifest(manifest_path))
+    )
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        initializer=set_reduction_threads,
+        initargs=(reduction_threads,),
+    ) as executor:
+        if prefetch > 0:
+            project_function = functools.partial(
+                project_zstacks_prefetched,
+                output_base_dir=output_base_dir,
+                projection_methods=projection_methods,
+                overwrite=overwrite,
+                prefetch=prefetch,
+                max_memory_bytes=per_worker_memory,
+            )
+            chunks = [
+                tiff_files[start : start + chunk_size]
+                for start in range(0, len(tiff_files), chunk_size)
+            ]
+            futures = [
+                executor.submit(
+                    project_function,
+                    chunk,
+                    zstacks_to_index={
+                        tiff_file
+                        for tiff_file in chunk
+                        if tiff_file in zstacks_to_index
+                    },
+                    # only the entries of the chunk are sent to the worker
+                    manifest_entries=None
+                    if manifest_entries is None
+                    else {
+                        str(tiff_file): manifest_entries.get(str(tiff_file), {})
+                        for tiff_file in chunk
+                    },
+                )
+                for chunk in chunks
+            ]
+            records = []
+            with tqdm.tqdm(total=len(tiff_files)) as progress_bar:
+                for future in futures:
+                    chunk_records = future.result()
+                    records.extend(chunk_records)
+                    progress_bar.update(len(chunk_records))
+        else:
+            project_function = functools.partial(
+                project_single_zstack,
+                output_base_dir=output_base_dir,
+                projection_methods=projection_methods,
+                overwrite=overwrite,
+                streaming=streaming,
+                read_ahead=read_ahead,
+            )
+            futures = [
+                executor.submit(
+                    project_function,
+                    tiff_file,
+                    compute_plane_statistics=tiff_file in zstacks_to_index,
+                    manifest_entries=None
+                    if manifest_entries is None
+                    else manifest_entries.get(str(tiff_file), {}),
+                )
+                for tiff_file in tiff_files
+            ]
+            # collecting the futures in submission order keeps the records in
+            # the order of tiff_files
+            records = [future.result() for future in tqdm.tqdm(futures)]
+
+    plane_statistics_df = pop_plane_statistics(records)
+    if len(plane_statistics_df) > 0:
+        update_plane_statistics_index(plane_statistics_path, plane_statistics_df)
+    manifest_df = pop_manifest_entries(records)
+    if len(manifest_df) > 0:
+        update_manifest(manifest_path, manifest_df)
+    run_summary = pd.DataFrame.from_records(records)
+    summarize_projection_run(run_summary)
+    return run_summary
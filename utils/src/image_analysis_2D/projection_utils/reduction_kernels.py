@@ -0,0 +1,239 @@
+"""Tile-parallel max, mean and sum z-reductions with an optional numba backend."""
+
+from __future__ import annotations
+
+import functools
+import os
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# environment variable with the number of threads each z-reduction may use
+REDUCTION_THREADS_ENV_VAR = "IMAGE_ANALYSIS_2D_REDUCTION_THREADS"
+REDUCTIONS: dict[str, Callable] = {
+    "max": np.max,
+    "mean": np.mean,
+    "sum": np.sum,
+}
+# rows of the (Y, X) output reduced per task, 128 rows of a 2k uint16 stack
+# with 40 z-slices is ~20 MB of input per task
+REDUCTION_TILE_ROWS = 128
+# stacks smaller than this are reduced on the calling thread
+MIN_THREADED_REDUCTION_BYTES = 16 * 1024**2
+
+
+def get_reduction_threads(num_threads: int | None = None) -> int:
+    """
+    Get the number of threads a z-reduction may use.
+
+    Parameters
+    ----------
+    num_threads : int | None, optional
+        Number of threads, by default None which reads the
+        IMAGE_ANALYSIS_2D_REDUCTION_THREADS environment variable (default 1).
+
+    Returns
+    -------
+    int
+        The number of threads, at least 1.
+    """
+    if num_threads is None:
+        num_threads = int(os.environ.get(REDUCTION_THREADS_ENV_VAR, 1))
+    return max(1, num_threads)
+
+
+def set_reduction_threads(num_threads: int) -> None:
+    """
+    Set the number of threads the z-reductions of this process may use.
+
+    Used as a process pool initializer so that workers split the CPUs left
+    over by a memory bound worker count (see projection_parallel).
+
+    Parameters
+    ----------
+    num_threads : int
+        Number of threads.
+    """
+    os.environ[REDUCTION_THREADS_ENV_VAR] = str(max(1, num_threads))
+
+
+def get_reduction_output(zstack: np.ndarray, reduction: str) -> np.ndarray:
+    """
+    Preallocate the (Y, X) output of a z-reduction.
+
+    The dtype is the one NumPy gives the reduction of the z-stack (e.g.
+    uint16 for max, uint64 for sum and float64 for mean of uint16 stacks).
+
+    Parameters
+    ----------
+    zstack : np.ndarray
+        The (Z, Y, X) z-stack.
+    reduction : str
+        ``"max"``, ``"mean"`` or ``"sum"``.
+
+    Returns
+    -------
+    np.ndarray
+        Uninitialized (Y, X) output buffer.
+    """
+    dtype = REDUCTIONS[reduction](zstack[:, :1, :1], axis=0).dtype
+    return np.empty(zstack.shape[1:], dtype=dtype)
+
+
+@functools.cache
+def _get_numba_kernels() -> dict[str, object] | None:
+    """Compile the numba z-reduction kernels, None if numba is not installed."""
+    try:
+        import numba
+    except ImportError:
+        return None
+
+    @numba.njit(parallel=True, cache=True)
+    def max_kernel(zstack, out):
+        for y in numba.prange(zstack.shape[1]):
+            for x in range(zstack.shape[2]):
+                out[y, x] = zstack[0, y, x]
+            for z in range(1, zstack.shape[0]):
+                for x in range(zstack.shape[2]):
+                    if zstack[z, y, x] > out[y, x]:
+                        out[y, x] = zstack[z, y, x]
+
+    @numba.njit(parallel=True, cache=True)
+    def sum_kernel(zstack, out):
+        for y in numba.prange(zstack.shape[1]):
+            for x in range(zstack.shape[2]):
+                out[y, x] = zstack[0, y, x]
+            for z in range(1, zstack.shape[0]):
+                for x in range(zstack.shape[2]):
+                    out[y, x] += zstack[z, y, x]
+
+    @numba.njit(parallel=True, cache=True)
+    def mean_kernel(zstack, out):
+        # same z order and float64 accumulation as np.mean(axis=0)
+        for y in numba.prange(zstack.shape[1]):
+            for x in range(zstack.shape[2]):
+                out[y, x] = zstack[0, y, x]
+            for z in range(1, zstack.shape[0]):
+                for x in range(zstack.shape[2]):
+                    out[y, x] += zstack[z, y, x]
+            for x in range(zstack.shape[2]):
+                out[y, x] /= zstack.shape[0]
+
+    return {
+        "numba": numba,
+        "max": max_kernel,
+        "sum": sum_kernel,
+        "mean": mean_kernel,
+    }
+
+
+def numba_available() -> bool:
+    """
+    Check if the numba kernels can be used.
+
+    Returns
+    -------
+    bool
+        True if numba is installed.
+    """
+    return _get_numba_kernels() is not None
+
+
+def _reduce_tile(
+    zstack: np.ndarray, reduction: str, out: np.ndarray, start: int, stop: int
+) -> None:
+    """Reduce the rows start:stop of the z-stack into the output."""
+    REDUCTIONS[reduction](zstack[:, start:stop], axis=0, out=out[start:stop])
+
+
+def reduce_zstack(
+    zstack: np.ndarray,
+    reduction: str = "max",
+    out: np.ndarray | None = None,
+    num_threads: int | None = None,
+    use_numba: bool = False,
+    tile_rows: int = REDUCTION_TILE_ROWS,
+) -> np.ndarray:
+    """
+    Reduce a z-stack along z with max, mean or sum, split over threads.
+
+    The (Y, X) output is split into bands of ``tile_rows`` rows that are
+    reduced on separate threads; NumPy releases the GIL in reductions, so
+    the bands run in parallel and each reads a contiguous block of every
+    z-slice.
+    With numba installed, integer stacks can instead use compiled kernels
+    that parallelize over rows.
+    They are opt-in because numba's default threading layer is not fork
+    safe: a process that ran them cannot start a fork based process pool.
+    Both backends reduce every pixel in z order with NumPy's accumulation
+    dtype, so results are bit-identical to ``np.max/np.mean/np.sum(axis=0)``.
+
+    Parameters
+    ----------
+    zstack : np.ndarray
+        The (Z, Y, X) z-stack.
+    reduction : str, optional
+        ``"max"``, ``"mean"`` or ``"sum"``, by default ``"max"``.
+    out : np.ndarray | None, optional
+        Preallocated (Y, X) output (see get_reduction_output), by default None.
+    num_threads : int | None, optional
+        Number of threads, by default None (see get_reduction_threads).
+    use_numba : bool, optional
+        Use the numba kernels for integer stacks when numba is installed, by
+        default False.
+        Float stacks always use NumPy so NaNs propagate as in NumPy.
+    tile_rows : int, optional
+        Rows per band of the threaded NumPy backend, by default REDUCTION_TILE_ROWS.
+
+    Returns
+    -------
+    np.ndarray
+        The (Y, X) reduced image.
+
+    Raises
+    ------
+    ValueError
+        If the reduction is unknown or the output has the wrong shape or dtype.
+    """
+    if reduction not in REDUCTIONS:
+        raise ValueError(
+            f"Unknown reduction: {reduction}, expected one of {sorted(REDUCTIONS)}"
+        )
+    zstack = np.asarray(zstack)
+    if out is None:
+        out = get_reduction_output(zstack, reduction)
+    elif (
+        out.shape != zstack.shape[1:]
+        or out.dtype != get_reduction_output(zstack[:1, :1, :1], reduction).dtype
+    ):
+        raise ValueError(
+            f"Output of shape {out.shape} and dtype {out.dtype} does not match "
+            f"the {reduction} of a {zstack.shape} {zstack.dtype} z-stack"
+        )
+    num_threads = get_reduction_threads(num_threads)
+
+    if use_numba and np.issubdtype(zstack.dtype, np.integer) and zstack.shape[0] > 0:
+        kernels = _get_numba_kernels()
+        if kernels is not None:
+            kernels["numba"].set_num_threads(
+                min(num_threads, kernels["numba"].config.NUMBA_NUM_THREADS)
+            )
+            kernels[reduction](np.ascontiguousarray(zstack), out)
+            return out
+
+    if num_threads == 1 or zstack.nbytes < MIN_THREADED_REDUCTION_BYTES:
+        REDUCTIONS[reduction](zstack, axis=0, out=out)
+        return out
+    bands = range(0, zstack.shape[1], max(1, tile_rows))
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        # list() re-raises the errors of the bands
+        list(
+            executor.map(
+                lambda start: _reduce_tile(
+                    zstack, reduction, out, start, start + tile_rows
+                ),
+                bands,
+            )
+        )
+    return out
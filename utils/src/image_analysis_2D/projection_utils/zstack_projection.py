@@ -0,0 +1,910 @@
+"""Single-pass z-projection engine for raw z-stack images."""
+
+from __future__ import annotations
+
+import pathlib
+import time
+from collections.abc import Callable
+
+import numpy as np
+import pandas as pd
+import tqdm
+from image_analysis_2D.file_utils.file_reading import (
+    get_zstack_shape,
+    image_exists,
+    iter_zstack_pages,
+    read_zstack_pages,
+)
+from image_analysis_2D.file_utils.file_writing import write_image
+from image_analysis_2D.file_utils.io_pipeline import run_io_pipeline
+from image_analysis_2D.file_utils.manifest import (
+    get_file_signature,
+    get_manifest_entries,
+    get_parameter_version,
+    is_input_unchanged,
+    is_output_valid,
+    load_manifest,
+    pop_manifest_entries,
+    update_manifest,
+)
+from image_analysis_2D.projection_utils.plane_statistics import (
+    get_plane_statistics_record,
+    get_zstacks_to_index,
+    pop_plane_statistics,
+    update_plane_statistics_index,
+)
+from image_analysis_2D.projection_utils.reduction_kernels import reduce_zstack
+
+
+# ----------------------------------------------------------------------
+# projection methods
+# ----------------------------------------------------------------------
+def all_slice_indices(number_of_slices: int) -> list[int]:
+    """
+    Select every z-slice of the z-stack.
+
+    Parameters
+    ----------
+    number_of_slices : int
+        Number of z-slices in the z-stack.
+
+    Returns
+    -------
+    list[int]
+        The z-slice indices to project.
+    """
+    return list(range(number_of_slices))
+
+
+def middle_slice_indices(number_of_slices: int) -> list[int]:
+    """
+    Select the middle most z-slice of the z-stack.
+
+    Parameters
+    ----------
+    number_of_slices : int
+        Number of z-slices in the z-stack.
+
+    Returns
+    -------
+    list[int]
+        The z-slice indices to project.
+    """
+    return [number_of_slices // 2]
+
+
+def middle_n_slice_indices(number_of_slices: int, n: int = 3) -> list[int]:
+    """
+    Select the middle n z-slices of the z-stack.
+
+    Parameters
+    ----------
+    number_of_slices : int
+        Number of z-slices in the z-stack.
+    n : int, optional
+        Number of z-slices total including the middle slice, by default 3.
+
+    Returns
+    -------
+    list[int]
+        The z-slice indices to project.
+    """
+    middle_slice_index = number_of_slices // 2
+    start_index = max(0, middle_slice_index - n // 2)
+    end_index = min(number_of_slices, middle_slice_index + n // 2 + 1)
+    return list(range(start_index, end_index))
+
+
+def max_projection(zstack: np.ndarray) -> np.ndarray:
+    """
+    Maximum intensity projection across the z-slices of a (sub) z-stack.
+
+    The reduction is split over row bands on threads (see
+    reduction_kernels.reduce_zstack) and is bit-identical to ``zstack.max(axis=0)``.
+
+    Parameters
+    ----------
+    zstack : np.ndarray
+        The (Z, Y, X) z-slices to project.
+
+    Returns
+    -------
+    np.ndarray
+        The (Y, X) maximum projected image.
+    """
+    return reduce_zstack(zstack, "max")
+
+
+# each projection method maps a twoD_method name to:
+# - output_subdir: the output directory under 2D_analysis
+# - z_indices: the z-slices the method needs given the number of z-slices
+# - function: reduces the selected (Z, Y, X) z-slices to (Y, X)
+# - running_function (optional): binary ufunc that folds one z-slice at a time
+#   into an accumulator, used when streaming the z-stack page by page
+# only the union of the z-slices needed by the methods is read from disk
+PROJECTION_METHODS: dict[str, dict] = {
+    "zmax": {
+        "output_subdir": "0a.zmax_proj",
+        "z_indices": all_slice_indices,
+        "function": max_projection,
+        "running_function": np.maximum,
+    },
+    "middle": {
+        "output_subdir": "0b.middle_slice",
+        "z_indices": middle_slice_indices,
+        "function": max_projection,
+        "running_function": np.maximum,
+    },
+    "middle_n": {
+        "output_subdir": "0c.middle_n_slice_max_proj",
+        "z_indices": middle_n_slice_indices,
+        "function": max_projection,
+        "running_function": np.maximum,
+    },
+}
+# bump when a change to the engine changes its outputs so that runs with a
+# manifest (see file_utils.manifest) recompute every projection
+PROJECTION_ENGINE_VERSION = 1
+
+
+# ----------------------------------------------------------------------
+# engine
+# ----------------------------------------------------------------------
+def get_projection_output_path(
+    tiff_file: pathlib.Path, output_dir: pathlib.Path
+) -> pathlib.Path:
+    """
+    Build the output path of a projected image.
+
+    The well_fov directory and file name of the z-stack are kept, e.g.
+    ``zstack_images/C4-2/C4-2_405.tif`` -> ``{output_dir}/C4-2/C4-2_405.tif``.
+
+    Parameters
+    ----------
+    tiff_file : pathlib.Path
+        Path to the z-stack image.
+    output_dir : pathlib.Path
+        Output directory of the projection method.
+
+    Returns
+    -------
+    pathlib.Path
+        Path to write the projected image to.
+    """
+    return output_dir / tiff_file.parent.name / tiff_file.name
+
+
+def project_zstack(
+    zstack: np.ndarray,
+    projection_methods: dict[str, dict] = PROJECTION_METHODS,
+) -> dict[str, np.ndarray]:
+    """
+    Apply every projection method to an already loaded z-stack.
+
+    Parameters
+    ----------
+    zstack : np.ndarray
+        The full (Z, Y, X) z-stack image.
+    projection_methods : dict[str, dict], optional
+        Projection methods to apply, by default PROJECTION_METHODS.
+
+    Returns
+    -------
+    dict[str, np.ndarray]
+        Mapping of projection method name to the projected image.
+    """
+    number_of_slices = zstack.shape[0]
+    return {
+        method: method_info["function"](
+            zstack[method_info["z_indices"](number_of_slices)]
+        )
+        for method, method_info in projection_methods.items()
+    }
+
+
+def project_zstack_file(
+    tiff_file: pathlib.Path,
+    projection_methods: dict[str, dict] = PROJECTION_METHODS,
+    streaming: bool = False,
+    read_ahead: bool = True,
+    on_plane: Callable[[int, np.ndarray], None] | None = None,
+) -> dict[str, np.ndarray]:
+    """
+    Read a z-stack once and apply every projection method to it.
+
+    Only the union of the z-slices needed by the projection methods is
+    read (e.g. one to three pages for the middle slice methods).
+
+    With ``streaming`` the z-slices are read one page at a time and folded
+    into a running accumulator per projection method (e.g. a running
+    ``np.maximum``), so peak memory is about two z-slices plus one
+    accumulator per method instead of the whole (Z, Y, X) stack.
+    Methods without a ``running_function`` keep only their own z-slices.
+
+    Parameters
+    ----------
+    tiff_file : pathlib.Path
+        Path to the z-stack image.
+    projection_methods : dict[str, dict], optional
+        Projection methods to apply, by default PROJECTION_METHODS.
+    streaming : bool, optional
+        Stream the z-slices page by page, by default False.
+    read_ahead : bool, optional
+        When streaming, read the next z-slice on a background thread while
+        the current one is folded in, by default True.
+    on_plane : Callable[[int, np.ndarray], None] | None, optional
+        Called with the index and image of every z-slice as it is read
+        (e.g. to compute per z-slice statistics), by default None.
+        When given, every z-slice of the z-stack is read.
+
+    Returns
+    -------
+    dict[str, np.ndarray]
+        Mapping of projection method name to the projected image.
+    """
+    if streaming:
+        method_z_indices, z_indices_to_read = get_projection_z_indices(
+            tiff_file, projection_methods, read_all_slices=on_plane is not None
+        )
+        return _stream_project_zstack_file(
+            tiff_file=tiff_file,
+            projection_methods=projection_methods,
+            method_z_indices=method_z_indices,
+            z_indices_to_read=z_indices_to_read,
+            read_ahead=read_ahead,
+            on_plane=on_plane,
+        )
+
+    zslices = read_zslices_for_projection(
+        tiff_file, projection_methods, read_all_slices=on_plane is not None
+    )
+    if on_plane is not None:
+        for z, plane in zip(zslices["z_indices_read"], zslices["zstack"]):
+            on_plane(z, plane)
+    return project_read_zslices(zslices, projection_methods)
+
+
+def get_projection_z_indices(
+    tiff_file: pathlib.Path,
+    projection_methods: dict[str, dict] = PROJECTION_METHODS,
+    read_all_slices: bool = False,
+) -> tuple[dict[str, list[int]], list[int]]:
+    """
+    Get the z-slices each projection method needs from the z-stack header.
+
+    Parameters
+    ----------
+    tiff_file : pathlib.Path
+        Path to the z-stack image.
+    projection_methods : dict[str, dict], optional
+        Projection methods to apply, by default PROJECTION_METHODS.
+    read_all_slices : bool, optional
+        Read every z-slice rather than only the ones the methods need, by default False.
+
+    Returns
+    -------
+    tuple[dict[str, list[int]], list[int]]
+        The z-slices of each projection method and the sorted union to read.
+    """
+    number_of_slices = get_zstack_shape(tiff_file)[0]
+    method_z_indices = {
+        method: method_info["z_indices"](number_of_slices)
+        for method, method_info in projection_methods.items()
+    }
+    if read_all_slices:
+        z_indices_to_read = all_slice_indices(number_of_slices)
+    else:
+        z_indices_to_read = sorted(set().union(*method_z_indices.values()))
+    return method_z_indices, z_indices_to_read
+
+
+def read_zslices_for_projection(
+    tiff_file: pathlib.Path,
+    projection_methods: dict[str, dict] = PROJECTION_METHODS,
+    read_all_slices: bool = False,
+    load_into_memory: bool = False,
+) -> dict[str, np.ndarray | list[int] | dict[str, list[int]]]:
+    """
+    Read the union of the z-slices the projection methods need.
+
+    This is the read step of project_zstack_file, split out so that it can
+    run on a reader thread ahead of the projections (see io_pipeline).
+
+    Parameters
+    ----------
+    tiff_file : pathlib.Path
+        Path to the z-stack image.
+    projection_methods : dict[str, dict], optional
+        Projection methods to apply, by default PROJECTION_METHODS.
+    read_all_slices : bool, optional
+        Read every z-slice rather than only the ones the methods need, by default False.
+    load_into_memory : bool, optional
+        Copy memory-mapped z-stacks into memory so the disk read happens here
+        rather than in the projections, by default False.
+
+    Returns
+    -------
+    dict[str, np.ndarray | list[int] | dict[str, list[int]]]
+        The ``zstack`` of the z-slices read, the ``z_indices_read`` and the
+        ``method_z_indices`` of each projection method.
+    """
+    method_z_indices, z_indices_to_read = get_projection_z_indices(
+        tiff_file, projection_methods, read_all_slices=read_all_slices
+    )
+    if len(z_indices_to_read) == get_zstack_shape(tiff_file)[0]:
+        zstack = read_zstack_pages(tiff_file)
+        if load_into_memory:
+            zstack = np.array(zstack)
+    else:
+        zstack = read_zstack_pages(tiff_file, z_indices=z_indices_to_read)
+    return {
+        "zstack": zstack,
+        "z_indices_read": z_indices_to_read,
+        "method_z_indices": method_z_indices,
+    }
+
+
+def project_read_zslices(
+    zslices: dict[str, np.ndarray | list[int] | dict[str, list[int]]],
+    projection_methods: dict[str, dict] = PROJECTION_METHODS,
+) -> dict[str, np.ndarray]:
+    """
+    Apply every projection method to the z-slices from read_zslices_for_projection.
+
+    Parameters
+    ----------
+    zslices : dict[str, np.ndarray | list[int] | dict[str, list[int]]]
+        Output of read_zslices_for_projection.
+    projection_methods : dict[str, dict], optional
+        Projection methods to apply, by default PROJECTION_METHODS.
+
+    Returns
+    -------
+    dict[str, np.ndarray]
+        Mapping of projection method name to the projected image.
+    """
+    # position of each z-slice within the planes that were read
+    read_position = {
+        z: position for position, z in enumerate(zslices["z_indices_read"])
+    }
+    return {
+        method: projection_methods[method]["function"](
+            zslices["zstack"][[read_position[z] for z in z_indices]]
+        )
+        for method, z_indices in zslices["method_z_indices"].items()
+    }
+
+
+def _stream_project_zstack_file(
+    tiff_file: pathlib.Path,
+    projection_methods: dict[str, dict],
+    method_z_indices: dict[str, list[int]],
+    z_indices_to_read: list[int],
+    read_ahead: bool,
+    on_plane: Callable[[int, np.ndarray], None] | None = None,
+) -> dict[str, np.ndarray]:
+    """Fold the z-slices of a z-stack into each projection one page at a time."""
+    method_z_sets = {
+        method: set(z_indices) for method, z_indices in method_z_indices.items()
+    }
+    accumulators: dict[str, np.ndarray] = {}
+    buffered_planes: dict[str, list[np.ndarray]] = {
+        method: []
+        for method, method_info in projection_methods.items()
+        if "running_function" not in method_info
+    }
+    for z, plane in iter_zstack_pages(
+        tiff_file, z_indices=z_indices_to_read, read_ahead=read_ahead
+    ):
+        if on_plane is not None:
+            on_plane(z, plane)
+        for method, z_set in method_z_sets.items():
+            if z not in z_set:
+                continue
+            if method in buffered_planes:
+                buffered_planes[method].append(plane)
+            elif method not in accumulators:
+                accumulators[method] = plane.copy()
+            else:
+                projection_methods[method]["running_function"](
+                    accumulators[method], plane, out=accumulators[method]
+                )
+    for method, planes in buffered_planes.items():
+        accumulators[method] = projection_methods[method]["function"](np.stack(planes))
+    return {method: accumulators[method] for method in projection_methods}
+
+
+def get_projection_parameter_version(method_info: dict) -> str:
+    """
+    Get the version of the code and parameters of a projection method.
+
+    The version changes with the engine version, the projection function
+    and the z-slice selection including its parameters (e.g. ``n`` of
+    middle_n_slice_indices), so the manifest recomputes only the methods
+    whose configuration changed.
+
+    Parameters
+    ----------
+    method_info : dict
+        A PROJECTION_METHODS entry.
+
+    Returns
+    -------
+    str
+        The parameter version stored in the manifest.
+    """
+    return get_parameter_version(
+        {
+            "engine_version": PROJECTION_ENGINE_VERSION,
+            "z_indices": method_info["z_indices"],
+            "function": method_info["function"],
+        }
+    )
+
+
+def get_projection_manifest_entries(
+    tiff_file: pathlib.Path,
+    output_paths: dict[str, pathlib.Path],
+    projection_methods: dict[str, dict],
+    input_signature: dict[str, int | str | None],
+) -> list[dict[str, int | str | None]]:
+    """
+    Build the manifest entries of the projections written for a z-stack.
+
+    Parameters
+    ----------
+    tiff_file : pathlib.Path
+        Path to the z-stack image.
+    output_paths : dict[str, pathlib.Path]
+        Output path of each projection method.
+    projection_methods : dict[str, dict]
+        Projection methods that were written.
+    input_signature : dict[str, int | str | None]
+        Signature of the z-stack taken before it was read (see manifest.get_file_signature).
+
+    Returns
+    -------
+    list[dict[str, int | str | None]]
+        One manifest entry per projection with the input signature, the
+        output size, modification time and checksum and the parameter version.
+    """
+    return [
+        {
+            "input_file": str(tiff_file),
+            "output_file": str(output_paths[method]),
+            "projection_method": method,
+            "parameter_version": get_projection_parameter_version(method_info),
+            **input_signature,
+            **get_file_signature(output_paths[method], "output", full_checksum=True),
+        }
+        for method, method_info in projection_methods.items()
+    ]
+
+
+def _is_projection_up_to_date(
+    tiff_file: pathlib.Path,
+    output_path: pathlib.Path,
+    method_info: dict,
+    manifest_entries: dict[str, dict] | None,
+) -> bool:
+    """Check if a projection exists and, with a manifest, is still current."""
+    if not image_exists(output_path):
+        return False
+    if manifest_entries is None:
+        return True
+    entry = manifest_entries.get(str(output_path))
+    return (
+        entry is not None
+        and entry["parameter_version"] == get_projection_parameter_version(method_info)
+        and is_input_unchanged(entry, tiff_file)
+        and is_output_valid(entry, output_path)
+    )
+
+
+def _plan_zstack_projection(
+    tiff_file: pathlib.Path,
+    output_base_dir: pathlib.Path,
+    projection_methods: dict[str, dict],
+    overwrite: bool,
+    manifest_entries: dict[str, dict] | None = None,
+) -> tuple[dict[str, pathlib.Path], dict[str, dict], dict]:
+    """Get the output paths, the projection methods to run and the summary record."""
+    output_paths = {
+        method: get_projection_output_path(
+            tiff_file, output_base_dir / method_info["output_subdir"]
+        )
+        for method, method_info in projection_methods.items()
+    }
+    methods_to_run = {
+        method: method_info
+        for method, method_info in projection_methods.items()
+        if overwrite
+        or not _is_projection_up_to_date(
+            tiff_file, output_paths[method], method_info, manifest_entries
+        )
+    }
+    record = {
+        "zstack_file": str(tiff_file),
+        "well_fov": tiff_file.parent.name,
+        "status": "skipped",
+        "projection_methods": ",".join(methods_to_run),
+        "error": None,
+        "time_taken_seconds": 0.0,
+    }
+    return output_paths, methods_to_run, record
+
+
+def project_single_zstack(
+    tiff_file: pathlib.Path,
+    output_base_dir: pathlib.Path,
+    projection_methods: dict[str, dict] = PROJECTION_METHODS,
+    overwrite: bool = False,
+    streaming: bool = False,
+    read_ahead: bool = True,
+    compute_plane_statistics: bool = False,
+    manifest_entries: dict[str, dict] | None = None,
+) -> dict[str, str | float | list | None]:
+    """
+    Project one z-stack with every projection method whose output is missing.
+
+    Outputs are written atomically in the order of ``projection_methods``
+    with the storage backend selected by file_writing.write_image.
+    Errors are caught and returned in the record rather than raised so that
+    one bad z-stack does not stop a patient.
+    With ``compute_plane_statistics`` every z-slice is read and its statistics
+    (see plane_statistics.compute_plane_statistics) are computed in the same
+    pass, even if all projections already exist.
+    With ``manifest_entries`` outputs are also recomputed when the z-stack,
+    the output or the projection parameters changed since they were written
+    (see file_utils.manifest).
+
+    Parameters
+    ----------
+    tiff_file : pathlib.Path
+        Path to the z-stack image.
+    output_base_dir : pathlib.Path
+        The ``2D_analysis`` directory that holds the projection output directories.
+    projection_methods : dict[str, dict], optional
+        Projection methods to apply, by default PROJECTION_METHODS.
+    overwrite : bool, optional
+        Recompute outputs that already exist, by default False.
+    streaming : bool, optional
+        Stream the z-stack page by page into running projections, by default False.
+    read_ahead : bool, optional
+        When streaming, double buffer the page reads, by default True.
+    compute_plane_statistics : bool, optional
+        Compute the per z-slice statistics, by default False.
+    manifest_entries : dict[str, dict] | None, optional
+        Manifest entries of the z-stack keyed by output file (see
+        manifest.get_manifest_entries), by default None (no manifest).
+
+    Returns
+    -------
+    dict[str, str | float | list | None]
+        Summary record with the z-stack file, well_fov, status
+        (``"projected"``, ``"skipped"`` or ``"failed"``), the projection
+        methods run, the error message and the time taken.
+        With ``compute_plane_statistics`` the record also holds a
+        ``plane_statistics`` list with one record per z-slice.
+        With ``manifest_entries`` the record also holds a
+        ``manifest_entries`` list with one entry per projection written.
+    """
+    start_time = time.time()
+    output_paths, methods_to_run, record = _plan_zstack_projection(
+        tiff_file, output_base_dir, projection_methods, overwrite, manifest_entries
+    )
+    if len(methods_to_run) == 0 and not compute_plane_statistics:
+        return record
+    plane_statistics = []
+    if compute_plane_statistics:
+        record["plane_statistics"] = plane_statistics
+    try:
+        if manifest_entries is not None:
+            input_signature = get_file_signature(tiff_file, "input")
+        projections = project_zstack_file(
+            tiff_file,
+            methods_to_run,
+            streaming=streaming,
+            read_ahead=read_ahead,
+            on_plane=(
+                lambda z, plane: plane_statistics.append(
+                    get_plane_statistics_record(tiff_file, z, plane)
+                )
+            )
+            if compute_plane_statistics
+            else None,
+        )
+        for method, projection in projections.items():
+            write_image(output_paths[method], projection)
+        if len(methods_to_run) > 0:
+            record["status"] = "projected"
+        if manifest_entries is not None:
+            record["manifest_entries"] = get_projection_manifest_entries(
+                tiff_file, output_paths, methods_to_run, input_signature
+            )
+    except Exception as e:
+        record["status"] = "failed"
+        record["error"] = f"{type(e).__name__}: {e}"
+        plane_statistics.clear()
+    record["time_taken_seconds"] = time.time() - start_time
+    return record
+
+
+def project_zstacks_prefetched(
+    tiff_files: list[pathlib.Path],
+    output_base_dir: pathlib.Path,
+    projection_methods: dict[str, dict] = PROJECTION_METHODS,
+    overwrite: bool = False,
+    zstacks_to_index: set[pathlib.Path] = set(),
+    prefetch: int = 2,
+    num_readers: int = 1,
+    num_writers: int = 1,
+    max_memory_bytes: int | None = None,
+    manifest_entries: dict[str, dict[str, dict]] | None = None,
+) -> list[dict[str, str | float | list | None]]:
+    """
+    Project z-stacks while the next z-stacks are read and the last ones written.
+
+    The z-slices of the next ``prefetch`` z-stacks are read on reader threads
+    and the projections are written on writer threads (see
+    io_pipeline.run_io_pipeline), so the disk and the CPU are busy at the
+    same time.
+    Records are the same as the ones of project_single_zstack.
+
+    Parameters
+    ----------
+    tiff_files : list[pathlib.Path]
+        Paths to the z-stack images.
+    output_base_dir : pathlib.Path
+        The ``2D_analysis`` directory that holds the projection output directories.
+    projection_methods : dict[str, dict], optional
+        Projection methods to apply, by default PROJECTION_METHODS.
+    overwrite : bool, optional
+        Recompute outputs that already exist, by default False.
+    zstacks_to_index : set[pathlib.Path], optional
+        z-stacks to compute the per z-slice statistics of, by default none.
+    prefetch : int, optional
+        Number of z-stacks read ahead of the projections, by default 2.
+    num_readers : int, optional
+        Number of reader threads, by default 1.
+    num_writers : int, optional
+        Number of writer threads, by default 1.
+    max_memory_bytes : int | None, optional
+        Memory budget of the z-stacks read ahead and of the projections
+        waiting to be written, by default None (no budget).
+    manifest_entries : dict[str, dict[str, dict]] | None, optional
+        Manifest entries keyed by z-stack and output file (see
+        manifest.get_manifest_entries), by default None (no manifest).
+
+    Returns
+    -------
+    list[dict[str, str | float | list | None]]
+        One summary record per z-stack in the order of tiff_files.
+    """
+    records = []
+    plans = []
+    for tiff_file in tiff_files:
+        output_paths, methods_to_run, record = _plan_zstack_projection(
+            tiff_file,
+            output_base_dir,
+            projection_methods,
+            overwrite,
+            None
+            if manifest_entries is None
+            else manifest_entries.get(str(tiff_file), {}),
+        )
+        records.append(record)
+        compute_plane_statistics = tiff_file in zstacks_to_index
+        if compute_plane_statistics:
+            record["plane_statistics"] = []
+        if len(methods_to_run) > 0 or compute_plane_statistics:
+            plans.append(
+                {
+                    "tiff_file": tiff_file,
+                    "output_paths": output_paths,
+                    "methods_to_run": methods_to_run,
+                    "record": record,
+                }
+            )
+
+    def read_zstack(plan: dict) -> dict:
+        start_time = time.time()
+        try:
+            if manifest_entries is not None:
+                plan["input_signature"] = get_file_signature(plan["tiff_file"], "input")
+            return read_zslices_for_projection(
+                plan["tiff_file"],
+                plan["methods_to_run"],
+                read_all_slices="plane_statistics" in plan["record"],
+                load_into_memory=True,
+            )
+        finally:
+            plan["record"]["time_taken_seconds"] += time.time() - start_time
+
+    def project_prefetched_plan(
+        plan: dict, zslices: dict
+    ) -> dict[pathlib.Path, np.ndarray]:
+        start_time = time.time()
+        if "plane_statistics" in plan["record"]:
+            plan["record"]["plane_statistics"].extend(
+                get_plane_statistics_record(plan["tiff_file"], z, plane)
+                for z, plane in zip(zslices["z_indices_read"], zslices["zstack"])
+            )
+        projections = project_read_zslices(zslices, plan["methods_to_run"])
+        plan["record"]["time_taken_seconds"] += time.time() - start_time
+        return {
+            plan["output_paths"][method]: projection
+            for method, projection in projections.items()
+        }
+
+    def write_projections(
+        plan: dict, projections: dict[pathlib.Path, np.ndarray]
+    ) -> None:
+        start_time = time.time()
+        for output_path, projection in projections.items():
+            write_image(output_path, projection)
+        if manifest_entries is not None:
+            plan["record"]["manifest_entries"] = get_projection_manifest_entries(
+                plan["tiff_file"],
+                plan["output_paths"],
+                plan["methods_to_run"],
+                plan["input_signature"],
+            )
+        plan["record"]["time_taken_seconds"] += time.time() - start_time
+
+    for pipeline_record in run_io_pipeline(
+        plans,
+        read_function=read_zstack,
+        compute_function=project_prefetched_plan,
+        write_function=write_projections,
+        num_readers=num_readers,
+        num_writers=num_writers,
+        prefetch=prefetch,
+        max_memory_bytes=max_memory_bytes,
+    ):
+        plan = pipeline_record["item"]
+        record = plan["record"]
+        error = pipeline_record["error"]
+        if error is not None:
+            record["status"] = "failed"
+            record["error"] = f"{type(error).__name__}: {error}"
+            record.get("plane_statistics", []).clear()
+            record.pop("manifest_entries", None)
+        elif len(plan["methods_to_run"]) > 0:
+            record["status"] = "projected"
+    return records
+
+
+def summarize_projection_run(run_summary: pd.DataFrame) -> None:
+    """
+    Print the number of projected, skipped and failed z-stacks and the failures.
+
+    Parameters
+    ----------
+    run_summary : pd.DataFrame
+        One summary record per z-stack from project_single_zstack.
+    """
+    status_counts = run_summary["status"].value_counts()
+    print(
+        f"Projected: {status_counts.get('projected', 0)}, "
+        f"skipped: {status_counts.get('skipped', 0)}, "
+        f"failed: {status_counts.get('failed', 0)} z-stacks"
+    )
+    failed = run_summary.loc[run_summary["status"] == "failed"]
+    for _, row in failed.iterrows():
+        print(f"Failed to project {row['zstack_file']}: {row['error']}")
+
+
+def run_zstack_projections(
+    images_dir: pathlib.Path,
+    output_base_dir: pathlib.Path,
+    projection_methods: dict[str, dict] = PROJECTION_METHODS,
+    overwrite: bool = False,
+    streaming: bool = False,
+    read_ahead: bool = True,
+    plane_statistics_path: pathlib.Path | None = None,
+    prefetch: int = 0,
+    max_memory_bytes: int | None = None,
+    manifest_path: pathlib.Path | None = None,
+) -> pd.DataFrame:
+    """
+    Project every z-stack in a directory with all projection methods in one pass.
+
+    Each z-stack is read once and every projection method whose output does
+    not exist yet (or all of them if ``overwrite``) is computed from the
+    same in-memory z-slices.
+
+    Parameters
+    ----------
+    images_dir : pathlib.Path
+        Directory containing the ``{well_fov}/*.tif`` z-stack images.
+    output_base_dir : pathlib.Path
+        The ``2D_analysis`` directory that holds the projection output directories.
+    projection_methods : dict[str, dict], optional
+        Projection methods to apply, by default PROJECTION_METHODS.
+        Each entry needs an ``output_subdir``, ``z_indices`` and ``function`` key.
+    overwrite : bool, optional
+        Recompute outputs that already exist, by default False.
+    streaming : bool, optional
+        Stream each z-stack page by page into running projections, by default False.
+    read_ahead : bool, optional
+        When streaming, double buffer the page reads, by default True.
+    plane_statistics_path : pathlib.Path | None, optional
+        Parquet file of the per z-slice statistics index, by default None (no index).
+        Statistics of z-stacks missing from the index are computed in the
+        same pass as the projections and added to the index.
+    prefetch : int, optional
+        Number of z-stacks read ahead on a reader thread while projecting,
+        with the projections written on a writer thread, by default 0 (no prefetching).
+        Cannot be combined with ``streaming``.
+    max_memory_bytes : int | None, optional
+        When prefetching, memory budget of the z-stacks read ahead and of the
+        projections waiting to be written, by default None (no budget).
+    manifest_path : pathlib.Path | None, optional
+        Parquet manifest of the projections, by default None (no manifest),
+        in which case an output is only recomputed when it is missing.
+        With a manifest an output is also recomputed when its z-stack changed
+        (size, modification time and fast hash), the output was modified or
+        truncated, or the projection parameters (e.g. ``n``) changed.
+        Outputs written without a manifest have no entry and are recomputed
+        once.
+
+    Returns
+    -------
+    pd.DataFrame
+        One summary record per z-stack (see project_single_zstack).
+
+    Raises
+    ------
+    ValueError
+        If both ``streaming`` and ``prefetch`` are set.
+    """
+    if streaming and prefetch > 0:
+        raise ValueError("streaming and prefetch cannot be combined")
+    # get a list of all of the tiff files in the directory
+    tiff_files = sorted(images_dir.rglob("*.tif"))
+    zstacks_to_index = get_zstacks_to_index(
+        tiff_files, plane_statistics_path, overwrite=overwrite
+    )
+    manifest_entries = (
+        None
+        if manifest_path is None
+        else get_manifest_entries(load_manifest(manifest_path))
+    )
+    if prefetch > 0:
+        records = project_zstacks_prefetched(
+            tiff_files,
+            output_base_dir=output_base_dir,
+            projection_methods=projection_methods,
+            overwrite=overwrite,
+            zstacks_to_index=zstacks_to_index,
+            prefetch=prefetch,
+            max_memory_bytes=max_memory_bytes,
+            manifest_entries=manifest_entries,
+        )
+    else:
+        records = [
+            project_single_zstack(
+                tiff_file=tiff_file,
+                output_base_dir=output_base_dir,
+                projection_methods=projection_methods,
+                overwrite=overwrite,
+                streaming=streaming,
+                read_ahead=read_ahead,
+                compute_plane_statistics=tiff_file in zstacks_to_index,
+                manifest_entries=None
+                if manifest_entries is None
+                else manifest_entries.get(str(tiff_file), {}),
+            )
+            for tiff_file in tqdm.tqdm(tiff_files)
+        ]
+    plane_statistics_df = pop_plane_statistics(records)
+    if len(plane_statistics_df) > 0:
+        update_plane_statistics_index(plane_statistics_path, plane_statistics_df)
+    manifest_df = pop_manifest_entries(records)
+    if len(manifest_df) > 0:
+        update_manifest(manifest_path, manifest_df)
+    run_summary = pd.DataFrame.from_records(records)
+    if len(run_summary) > 0:
+        summarize_projection_run(run_summary)
+    return run_summary
@@ -0,0 +1,109 @@
+"""CuPy or NumPy/SciPy array backend of the segmentation post-processing."""
+
+from __future__ import annotations
+
+import functools
+import os
+import types
+
+import numpy as np
+
+ARRAY_BACKEND_ENV_VAR = "IMAGE_ANALYSIS_2D_ARRAY_BACKEND"
+ARRAY_BACKENDS = {"cupy", "numpy"}
+
+
+@functools.cache
+def _cupy_available() -> bool:
+    """Check once whether cupy can be imported and sees a GPU."""
+    try:
+        import cupy
+
+        n_devices = cupy.cuda.runtime.getDeviceCount()
+    except Exception as e:
+        print(f"Could not use cupy ({e}), using NumPy/SciPy")
+        return False
+    if n_devices == 0:
+        print("cupy found no GPU, using NumPy/SciPy")
+        return False
+    return True
+
+
+def get_array_backend(backend: str | None = None) -> str:
+    """
+    Get the array backend of the segmentation post-processing.
+
+    Parameters
+    ----------
+    backend : str | None, optional
+        ``"cupy"`` or ``"numpy"``, by default None which uses the
+        IMAGE_ANALYSIS_2D_ARRAY_BACKEND environment variable if it is set,
+        and otherwise cupy if it can be imported and sees a GPU and NumPy
+        otherwise.
+
+    Returns
+    -------
+    str
+        The backend.
+
+    Raises
+    ------
+    ValueError
+        If the backend is unknown.
+    """
+    if backend is None:
+        backend = os.environ.get(ARRAY_BACKEND_ENV_VAR)
+    if backend is None:
+        return "cupy" if _cupy_available() else "numpy"
+    backend = backend.lower()
+    if backend not in ARRAY_BACKENDS:
+        raise ValueError(
+            f"Unknown array backend: {backend}, expected one of {sorted(ARRAY_BACKENDS)}"
+        )
+    return backend
+
+
+def get_array_modules(backend: str | None = None) -> types.SimpleNamespace:
+    """
+    Get the array modules of a backend.
+
+    cupy is only imported when the cupy backend is used, so the NumPy
+    backend works on nodes without a GPU or cupy.
+
+    Parameters
+    ----------
+    backend : str | None, optional
+        ``"cupy"`` or ``"numpy"``, by default None (see get_array_backend).
+
+    Returns
+    -------
+    types.SimpleNamespace
+        ``name``, the array module ``xp``, its ``ndimage`` module,
+        ``asarray`` to move an array to the backend and ``asnumpy`` to
+        move it back to a NumPy array.
+    """
+    return _import_array_modules(get_array_backend(backend))
+
+
+@functools.cache
+def _import_array_modules(backend: str) -> types.SimpleNamespace:
+    """Import the array modules of a backend once."""
+    if backend == "cupy":
+        import cupy
+        import cupyx.scipy.ndimage
+
+        return types.SimpleNamespace(
+            name=backend,
+            xp=cupy,
+            ndimage=cupyx.scipy.ndimage,
+            asarray=cupy.asarray,
+            asnumpy=cupy.asnumpy,
+        )
+    import scipy.ndimage
+
+    return types.SimpleNamespace(
+        name=backend,
+        xp=np,
+        ndimage=scipy.ndimage,
+        asarray=np.asarray,
+        asnumpy=np.asarray,
+    )
@@ -0,0 +1,476 @@
+"""Segment the nuclei, cells and organoids of a well_fov in one process, keeping the images and masks in memory."""
+
+from __future__ import annotations
+
+import pathlib
+import queue
+import time
+import traceback
+import tracemalloc
+from collections.abc import Iterable
+
+import numpy as np
+import pandas as pd
+import scipy
+import skimage
+from image_analysis_2D.file_utils.artifact_catalog import (
+    get_artifact_catalog_path,
+    try_record_well_fov_artifacts,
+)
+from image_analysis_2D.file_utils.file_reading import (
+    find_files_available,
+    image_exists,
+    read_image,
+)
+from image_analysis_2D.file_utils.file_writing import write_image
+from image_analysis_2D.file_utils.profiling_utils import (
+    start_resource_profiling,
+    stop_resource_profiling,
+)
+from image_analysis_2D.segmentation_utils.nuclei_segmentation import (
+    get_job_overwrite,
+    get_twoD_method_dir,
+    iter_segmentation_jobs,
+    load_nuclei_model,
+    read_nuclei_image,
+)
+from image_analysis_2D.segmentation_utils.segmentation_processing import (
+    fill_holes_in_mask,
+    remove_small_objects_preserve_labels,
+)
+
+# clip limits of the adaptive histogram equalization of the 405 and 555 images,
+# as passed to 0.segment_nuclei and 1.segment_cells
+NUCLEI_CLIP_LIMIT = 0.02
+CELL_CLIP_LIMIT = 0.04
+
+
+def compute_foreground_mask(image: np.ndarray) -> np.ndarray:
+    """
+    Threshold the blurred image with Otsu and dilate it by one pixel.
+
+    1.segment_cells applies this to the equalized 555 image to mask the
+    watershed, and 2.segment_organoids to the raw 555 image.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        2D image.
+
+    Returns
+    -------
+    np.ndarray
+        Float mask with 1 for the foreground and 0 for the background.
+    """
+    elevation_map_threshold_signal = skimage.filters.gaussian(image, sigma=3)
+    threshold = skimage.filters.threshold_otsu(elevation_map_threshold_signal)
+    elevation_map_threshold_signal[elevation_map_threshold_signal < threshold] = 0
+    elevation_map_threshold_signal[elevation_map_threshold_signal > 0] = 1
+    return skimage.morphology.dilation(
+        elevation_map_threshold_signal,
+        skimage.morphology.disk(1),
+    )
+
+
+def segment_cells(
+    cell: np.ndarray,
+    nuclei_mask: np.ndarray,
+    clip_limit: float = CELL_CLIP_LIMIT,
+    connectivity: int = 1,
+    compactness: int = 1,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Segment the cells of the 555 image by a watershed from the nuclei, as
+    1.segment_cells does.
+
+    Parameters
+    ----------
+    cell : np.ndarray
+        Raw 555 image.
+    nuclei_mask : np.ndarray
+        Nuclei labels the watershed starts from, not modified.
+    clip_limit : float, optional
+        Clip limit of the adaptive histogram equalization, by default
+        CELL_CLIP_LIMIT.
+    connectivity : int, optional
+        Connectivity of the watershed, by default 1.
+    compactness : int, optional
+        Compactness of the watershed, by default 1.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        The cell labels and the nuclei labels, keeping only the labels with
+        both a cell and a nucleus.
+    """
+    nuclei_mask = np.array(nuclei_mask)
+    cell = np.array(cell)
+    cell = skimage.exposure.equalize_adapthist(cell, clip_limit=clip_limit)
+
+    elevation_map_threshold_signal = compute_foreground_mask(cell)
+
+    cell = skimage.filters.butterworth(
+        cell,
+        cutoff_frequency_ratio=0.08,
+        order=2,
+        high_pass=False,
+        squared_butterworth=False,
+    )
+    cell = skimage.filters.gaussian(cell, sigma=3)
+    cell = skimage.filters.sobel(cell, mask=cell > 0)
+    cell_mask = skimage.segmentation.watershed(
+        image=cell,
+        markers=nuclei_mask,
+        connectivity=connectivity,
+        compactness=compactness,
+        mask=elevation_map_threshold_signal,
+    )
+
+    # change the largest label (by area) to 0
+    # cleans up the output and sets the background properly
+    unique, counts = np.unique(cell_mask, return_counts=True)
+    largest_label = unique[np.argmax(counts)]
+    cell_mask[cell_mask == largest_label] = 0
+    # make sure the background is labeled as 0
+    largest_label = np.bincount(cell_mask.ravel()).argmax()
+    cell_mask[cell_mask == largest_label] = 0
+
+    cell_mask = fill_holes_in_mask(cell_mask, compartment="cell")
+
+    # Build a clean support mask (single main organoid only)
+    inside_mask = elevation_map_threshold_signal > 0
+    inside_mask = scipy.ndimage.binary_fill_holes(inside_mask)
+    inside_mask = skimage.morphology.binary_closing(
+        inside_mask, footprint=skimage.morphology.disk(3)
+    )
+    inside_mask = skimage.morphology.remove_small_objects(inside_mask, min_size=5000)
+
+    # keep only largest connected component to avoid background speckles
+    cc = skimage.measure.label(inside_mask)
+    if cc.max() > 0:
+        counts = np.bincount(cc.ravel())
+        counts[0] = 0
+        inside_mask = cc == np.argmax(counts)
+
+    # Fill unlabeled pixels only inside the clean support mask
+    gap_mask = inside_mask & (cell_mask == 0)
+    if np.any(gap_mask):
+        _, nearest_idx = scipy.ndimage.distance_transform_edt(
+            cell_mask == 0, return_indices=True
+        )
+        nearest_labels = cell_mask[tuple(nearest_idx)]
+        cell_mask[gap_mask] = nearest_labels[gap_mask]
+
+    # hard background clamp (do this before and after cleanup)
+    cell_mask[~inside_mask] = 0
+
+    # remove small objects while preserving label IDs
+    cell_mask = remove_small_objects_preserve_labels(cell_mask, min_size=150)
+    nuclei_mask = remove_small_objects_preserve_labels(nuclei_mask, min_size=150)
+
+    # clamp again to prevent any stray fragments
+    cell_mask[~inside_mask] = 0
+    cell_mask = remove_small_objects_preserve_labels(cell_mask, min_size=150)
+
+    unique_labels_across_cell_and_nuclei = set(np.unique(nuclei_mask)) - set(
+        np.unique(cell_mask)
+    )
+    if len(unique_labels_across_cell_and_nuclei) > 0:
+        # remove the labels that are not paired...
+        cell_mask[np.isin(cell_mask, list(unique_labels_across_cell_and_nuclei))] = 0
+        nuclei_mask[
+            np.isin(nuclei_mask, list(unique_labels_across_cell_and_nuclei))
+        ] = 0
+    return cell_mask, nuclei_mask
+
+
+def segment_organoids(cell: np.ndarray) -> np.ndarray:
+    """
+    Segment the organoids of the 555 image, as 2.segment_organoids does.
+
+    Parameters
+    ----------
+    cell : np.ndarray
+        Raw 555 image.
+
+    Returns
+    -------
+    np.ndarray
+        The organoid labels.
+    """
+    elevation_map_threshold_signal = compute_foreground_mask(cell)
+    organoid_mask = fill_holes_in_mask(
+        elevation_map_threshold_signal, compartment="organoid"
+    )
+
+    # clean each object independently and write to a fresh label image
+    cleaned_labels = np.zeros_like(organoid_mask, dtype=organoid_mask.dtype)
+    for organoid_mask_label in np.unique(organoid_mask):
+        if organoid_mask_label == 0:
+            continue
+        tmp_mask = organoid_mask == organoid_mask_label
+        tmp_mask = skimage.morphology.remove_small_holes(
+            tmp_mask, area_threshold=10_000
+        )
+        # closing
+        tmp_mask = skimage.morphology.closing(
+            tmp_mask, footprint=skimage.morphology.disk(3)
+        )
+        cleaned_labels[tmp_mask] = organoid_mask_label
+    organoid_mask = cleaned_labels
+
+    return remove_small_objects_preserve_labels(organoid_mask, min_size=500)
+
+
+def _stop_compartment_profiling(
+    start_time: float,
+    start_mem: float,
+    patient: str,
+    well_fov: str,
+    compartment: str,
+    input_dir: pathlib.Path,
+) -> None:
+    """
+    Save the run stats of a compartment like the segmentation scripts.
+
+    Parameters
+    ----------
+    start_time : float
+        Unix timestamp returned by start_resource_profiling.
+    start_mem : float
+        Starting RSS in MB returned by start_resource_profiling.
+    patient : str
+        Patient ID.
+    well_fov : str
+        Well and field of view.
+    compartment : str
+        "nuclei", "cell" or "organoid".
+    input_dir : pathlib.Path
+        Directory of the 2D images of the well_fov.
+    """
+    stop_resource_profiling(
+        start_time=start_time,
+        start_mem=start_mem,
+        feature_type="Segmentation",
+        well_fov=well_fov,
+        patient_id=patient,
+        channel="NoChannel",
+        compartment=compartment,
+        CPU_GPU="GPU",
+        output_file_dir=pathlib.Path(
+            f"{input_dir.parent}/run_stats/{well_fov}_{compartment}_segmentation.parquet"
+        ),
+    )
+
+
+def segment_well_fov_compartments(
+    image_base_dir: str | pathlib.Path,
+    patient: str,
+    well_fov: str,
+    twoD_method: str,
+    model=None,
+    nuclei_clip_limit: float = NUCLEI_CLIP_LIMIT,
+    cell_clip_limit: float = CELL_CLIP_LIMIT,
+    overwrite: bool = False,
+) -> bool:
+    """
+    Segment the nuclei, cells and organoids of a well_fov and write the three
+    masks, with the same outputs and run stats as 0.segment_nuclei,
+    1.segment_cells and 2.segment_organoids run one after the other.
+
+    The 555 image is read once and the nuclei mask is passed to the cell
+    segmentation in memory instead of through its file.
+
+    Parameters
+    ----------
+    image_base_dir : str | pathlib.Path
+        Directory holding the data directory.
+    patient : str
+        Patient ID.
+    well_fov : str
+        Well and field of view.
+    twoD_method : str
+        2D method, one of "zmax", "middle" or "middle_n".
+    model : cellpose.models.CellposeModel, optional
+        Model from load_nuclei_model, only needed to segment the nuclei.
+    nuclei_clip_limit : float, optional
+        Clip limit of the equalization of the 405 image, by default
+        NUCLEI_CLIP_LIMIT.
+    cell_clip_limit : float, optional
+        Clip limit of the equalization of the 555 image, by default
+        CELL_CLIP_LIMIT.
+    overwrite : bool, optional
+        Segment the nuclei even if their mask exists, by default False. The
+        cells and organoids are always segmented, as in the scripts. The
+        nuclei run stats are only written when the nuclei are segmented.
+
+    Returns
+    -------
+    bool
+        True if the nuclei were segmented, False if the existing nuclei mask
+        was used.
+
+    Raises
+    ------
+    ValueError
+        If the nuclei need to be segmented and no model was passed.
+    FileNotFoundError
+        If there is no 555 image.
+    """
+    input_dir = get_twoD_method_dir(image_base_dir, patient, well_fov, twoD_method)
+    nuclei_mask_path = input_dir / f"{well_fov}_nuclei_mask.tiff"
+    segment_nuclei = overwrite or not image_exists(nuclei_mask_path)
+    if segment_nuclei and model is None:
+        raise ValueError(f"A model is needed to segment the nuclei of {input_dir}")
+
+    try:
+        if segment_nuclei:
+            start_time, start_mem = start_resource_profiling()
+            nuclei = read_nuclei_image(input_dir, nuclei_clip_limit)
+            labels, details, _ = model.eval(nuclei)
+            # the mask as 0.segment_nuclei writes it
+            nuclei_mask = labels.astype(np.uint16)
+            _stop_compartment_profiling(
+                start_time, start_mem, patient, well_fov, "nuclei", input_dir
+            )
+        else:
+            # keep the run stats of the run that segmented the nuclei
+            nuclei_mask = read_image(nuclei_mask_path)
+
+        start_time, start_mem = start_resource_profiling()
+        # lists both tiff files and images stored in the zarr backend
+        cell_files = [f for f in find_files_available(input_dir) if "555" in f]
+        if len(cell_files) == 0:
+            raise FileNotFoundError(f"No 555 image found in {input_dir}")
+        cell = read_image(cell_files[-1])
+        cell_mask, nuclei_mask = segment_cells(
+            cell, nuclei_mask, clip_limit=cell_clip_limit
+        )
+        _stop_compartment_profiling(
+            start_time, start_mem, patient, well_fov, "cell", input_dir
+        )
+
+        start_time, start_mem = start_resource_profiling()
+        organoid_mask = segment_organoids(cell)
+        # save the labels
+        write_image(nuclei_mask_path, nuclei_mask.astype(np.uint16))
+        write_image(
+            input_dir / f"{well_fov}_cell_mask.tiff", cell_mask.astype(np.uint16)
+        )
+        write_image(
+            input_dir / f"{well_fov}_organoid_mask.tiff",
+            organoid_mask.astype(np.uint16),
+        )
+        # record the masks in the artifact catalog the completeness checks query
+        try_record_well_fov_artifacts(
+            catalog_path=get_artifact_catalog_path(f"{image_base_dir}/data"),
+            data_dir=f"{image_base_dir}/data",
+            stage="segmentation",
+            patient=patient,
+            well_fov=well_fov,
+            methods=[twoD_method],
+        )
+        _stop_compartment_profiling(
+            start_time, start_mem, patient, well_fov, "organoid", input_dir
+        )
+    except Exception:
+        # the next job starts its own profiling
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        raise
+    return segment_nuclei
+
+
+def run_compartment_segmentation_worker(
+    jobs: Iterable | queue.Queue,
+    image_base_dir: str | pathlib.Path,
+    nuclei_clip_limit: float = NUCLEI_CLIP_LIMIT,
+    cell_clip_limit: float = CELL_CLIP_LIMIT,
+    overwrite: bool = False,
+    model=None,
+) -> pd.DataFrame:
+    """
+    Segment the nuclei, cells and organoids of each job in this process.
+
+    The Cellpose model is loaded once, when the first nuclei mask that does
+    not exist yet is segmented. A failed job is reported and the worker moves
+    on to the next one.
+
+    Parameters
+    ----------
+    jobs : Iterable | queue.Queue
+        (patient, well_fov, twoD_method) jobs, optionally followed by their
+        own overwrite flag, see iter_segmentation_jobs.
+    image_base_dir : str | pathlib.Path
+        Directory holding the data directory.
+    nuclei_clip_limit : float, optional
+        Clip limit of the equalization of the 405 image, by default
+        NUCLEI_CLIP_LIMIT.
+    cell_clip_limit : float, optional
+        Clip limit of the equalization of the 555 image, by default
+        CELL_CLIP_LIMIT.
+    overwrite : bool, optional
+        Segment the nuclei of every job even if their mask exists, by default
+        False, which only segments them for the jobs flagged to overwrite.
+    model : cellpose.models.CellposeModel, optional
+        Model to use, by default load_nuclei_model() when it is first needed.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per job with its ``status`` (segmented, or nuclei_reused when
+        the existing nuclei mask was used, or failed), ``duration_seconds``
+        and ``error``.
+    """
+    job_summaries = []
+    for job_number, job in enumerate(iter_segmentation_jobs(jobs)):
+        patient, well_fov, twoD_method = job[:3]
+        job_overwrite = get_job_overwrite(job, overwrite)
+        print(f"[{job_number + 1}] {patient} - {well_fov} - {twoD_method}")
+        start_time = time.time()
+        error = None
+        try:
+            if model is None and (
+                job_overwrite
+                or not image_exists(
+                    get_twoD_method_dir(image_base_dir, patient, well_fov, twoD_method)
+                    / f"{well_fov}_nuclei_mask.tiff"
+                )
+            ):
+                model = load_nuclei_model()
+            segmented_nuclei = segment_well_fov_compartments(
+                image_base_dir=image_base_dir,
+                patient=patient,
+                well_fov=well_fov,
+                twoD_method=twoD_method,
+                model=model,
+                nuclei_clip_limit=nuclei_clip_limit,
+                cell_clip_limit=cell_clip_limit,
+                overwrite=job_overwrite,
+            )
+            status = "segmented" if segmented_nuclei else "nuclei_reused"
+        except Exception:
+            error = traceback.format_exc()
+            status = "failed"
+            print(error)
+        job_summaries.append(
+            {
+                "patient": patient,
+                "well_fov": well_fov,
+                "twoD_method": twoD_method,
+                "status": status,
+                "duration_seconds": time.time() - start_time,
+                "error": error,
+            }
+        )
+    return pd.DataFrame(
+        job_summaries,
+        columns=[
+            "patient",
+            "well_fov",
+            "twoD_method",
+            "status",
+            "duration_seconds",
+            "error",
+        ],
+    )
@@ -0,0 +1,682 @@
+"""Segment the nuclei of many well_fovs with one Cellpose model, loaded once per worker, one image or a batch of images per model.eval call."""
+
+from __future__ import annotations
+
+import os
+import pathlib
+import queue
+import time
+import traceback
+import tracemalloc
+from collections.abc import Iterable, Iterator
+
+import numpy as np
+import pandas as pd
+import psutil
+import skimage
+from image_analysis_2D.file_utils.artifact_catalog import (
+    ARTIFACT_STAGES,
+    get_artifact_catalog_path,
+    try_record_well_fov_artifacts,
+)
+from image_analysis_2D.file_utils.file_reading import (
+    find_files_available,
+    image_exists,
+    read_image,
+)
+from image_analysis_2D.file_utils.file_writing import write_image
+from image_analysis_2D.file_utils.profiling_utils import (
+    start_resource_profiling,
+    stop_resource_profiling,
+)
+
+# environment variable with the number of threads torch may use on the CPU
+TORCH_THREADS_ENV_VAR = "IMAGE_ANALYSIS_2D_TORCH_THREADS"
+
+
+def get_twoD_method_dir(
+    image_base_dir: str | pathlib.Path, patient: str, well_fov: str, twoD_method: str
+) -> pathlib.Path:
+    """
+    Get the directory of the 2D images and masks of a well_fov.
+
+    Parameters
+    ----------
+    image_base_dir : str | pathlib.Path
+        Directory holding the data directory.
+    patient : str
+        Patient ID.
+    well_fov : str
+        Well and field of view.
+    twoD_method : str
+        2D method, one of "zmax", "middle" or "middle_n".
+
+    Returns
+    -------
+    pathlib.Path
+        The ``2D_analysis/0*/{well_fov}`` directory.
+
+    Raises
+    ------
+    ValueError
+        If twoD_method is unknown.
+    """
+    twoD_method_dirs = ARTIFACT_STAGES["projection"]["directories"]
+    if twoD_method not in twoD_method_dirs:
+        raise ValueError(f"Unknown twoD_method: {twoD_method}")
+    return pathlib.Path(
+        f"{image_base_dir}/data/{patient}/2D_analysis/{twoD_method_dirs[twoD_method]}/{well_fov}"
+    ).resolve()
+
+
+def set_torch_threads(num_threads: int | None = None) -> int:
+    """
+    Set the number of threads torch uses on the CPU.
+
+    Parameters
+    ----------
+    num_threads : int | None, optional
+        Number of threads, by default None which reads the
+        IMAGE_ANALYSIS_2D_TORCH_THREADS environment variable and keeps the
+        torch default (one thread per core) when it is not set.
+
+    Returns
+    -------
+    int
+        The number of threads torch uses.
+    """
+    import torch
+
+    if num_threads is None and os.environ.get(TORCH_THREADS_ENV_VAR):
+        num_threads = int(os.environ[TORCH_THREADS_ENV_VAR])
+    if num_threads is not None:
+        torch.set_num_threads(max(1, num_threads))
+    return torch.get_num_threads()
+
+
+def load_nuclei_model(use_GPU: bool | None = None, num_threads: int | None = None):
+    """
+    Load the Cellpose model used to segment nuclei.
+
+    torch and cellpose are imported here, so their import time is only paid
+    by the process that segments.
+
+    Parameters
+    ----------
+    use_GPU : bool | None, optional
+        Run the model on the GPU, by default when CUDA is available.
+    num_threads : int | None, optional
+        Number of threads torch uses on the CPU, see set_torch_threads.
+
+    Returns
+    -------
+    cellpose.models.CellposeModel
+        The loaded model.
+    """
+    import torch
+    from cellpose import models
+
+    set_torch_threads(num_threads)
+    if use_GPU is None:
+        use_GPU = torch.cuda.is_available()
+    return models.CellposeModel(gpu=use_GPU)
+
+
+def read_nuclei_image(input_dir: pathlib.Path, clip_limit: float) -> np.ndarray:
+    """
+    Read the 405 image of a well_fov and equalize it for Cellpose.
+
+    Parameters
+    ----------
+    input_dir : pathlib.Path
+        Directory of the 2D images of the well_fov.
+    clip_limit : float
+        Clip limit of the adaptive histogram equalization.
+
+    Returns
+    -------
+    np.ndarray
+        The equalized nuclei image.
+
+    Raises
+    ------
+    FileNotFoundError
+        If there is no 405 image in input_dir.
+    """
+    # lists both tiff files and images stored in the zarr backend
+    files = find_files_available(input_dir)
+    # get the nuclei image
+    nuclei_files = [f for f in files if "405" in f]
+    if len(nuclei_files) == 0:
+        raise FileNotFoundError(f"No 405 image found in {input_dir}")
+    nuclei = np.array(read_image(nuclei_files[-1]))
+    return skimage.exposure.equalize_adapthist(nuclei, clip_limit=clip_limit)
+
+
+def segment_nuclei_well_fov(
+    model,
+    image_base_dir: str | pathlib.Path,
+    patient: str,
+    well_fov: str,
+    twoD_method: str,
+    clip_limit: float,
+    overwrite: bool = False,
+) -> bool:
+    """
+    Segment the nuclei of a well_fov and save the mask and run stats like
+    ``0.segment_nuclei.py``. The run stats are only written when the nuclei
+    are segmented.
+
+    Parameters
+    ----------
+    model : cellpose.models.CellposeModel
+        Model from load_nuclei_model.
+    image_base_dir : str | pathlib.Path
+        Directory holding the data directory.
+    patient : str
+        Patient ID.
+    well_fov : str
+        Well and field of view.
+    twoD_method : str
+        2D method, one of "zmax", "middle" or "middle_n".
+    clip_limit : float
+        Clip limit of the adaptive histogram equalization.
+    overwrite : bool, optional
+        Segment even if the mask exists, by default False.
+
+    Returns
+    -------
+    bool
+        True if the nuclei were segmented, False if the mask already existed.
+    """
+    input_dir = get_twoD_method_dir(image_base_dir, patient, well_fov, twoD_method)
+    labels_path = input_dir / f"{well_fov}_nuclei_mask.tiff"
+    if not overwrite and image_exists(labels_path):
+        # keep the run stats of the run that segmented the nuclei
+        return False
+    start_time, start_mem = start_resource_profiling()
+    try:
+        nuclei = read_nuclei_image(input_dir, clip_limit)
+        labels, details, _ = model.eval(nuclei)
+        # save the labels
+        write_image(labels_path, labels.astype(np.uint16))
+        # record the masks in the artifact catalog the completeness checks query
+        try_record_well_fov_artifacts(
+            catalog_path=get_artifact_catalog_path(f"{image_base_dir}/data"),
+            data_dir=f"{image_base_dir}/data",
+            stage="segmentation",
+            patient=patient,
+            well_fov=well_fov,
+            methods=[twoD_method],
+        )
+    except Exception:
+        # the next job starts its own profiling
+        tracemalloc.stop()
+        raise
+
+    stop_resource_profiling(
+        start_time=start_time,
+        start_mem=start_mem,
+        feature_type="Segmentation",
+        well_fov=well_fov,
+        patient_id=patient,
+        channel="NoChannel",
+        compartment="nuclei",
+        CPU_GPU="GPU",
+        output_file_dir=pathlib.Path(
+            f"{input_dir.parent}/run_stats/{well_fov}_nuclei_segmentation.parquet"
+        ),
+    )
+    return True
+
+
+def segment_nuclei_images(
+    model,
+    nuclei_images: list[np.ndarray],
+    batch_size: int | None = None,
+    tile_overlap: float | None = None,
+) -> list[np.ndarray]:
+    """
+    Segment the nuclei of several images with one ``model.eval`` call.
+
+    Parameters
+    ----------
+    model : cellpose.models.CellposeModel
+        Model from load_nuclei_model.
+    nuclei_images : list[np.ndarray]
+        Equalized nuclei images, e.g. the three 2D methods of a well_fov.
+    batch_size : int | None, optional
+        Number of tiles per forward pass of the network, by default the
+        Cellpose default.
+    tile_overlap : float | None, optional
+        Fraction of overlap between tiles, by default the Cellpose default.
+
+    Returns
+    -------
+    list[np.ndarray]
+        The label image of each input image.
+    """
+    eval_kwargs = {}
+    if batch_size is not None:
+        eval_kwargs["batch_size"] = batch_size
+    if tile_overlap is not None:
+        eval_kwargs["tile_overlap"] = tile_overlap
+    labels, _, _ = model.eval(list(nuclei_images), **eval_kwargs)
+    return [np.asarray(label) for label in labels]
+
+
+def _stop_batch_resource_profiling(
+    start_time: float,
+    start_mem: float,
+    jobs: list[tuple],
+    input_dirs: list[pathlib.Path],
+) -> None:
+    """
+    Stop the profiling of a batch and save the run stats of each of its jobs.
+
+    The run stats have the columns of stop_resource_profiling, with the time
+    of the batch split evenly over its jobs, and ``images_in_batch``.
+
+    Parameters
+    ----------
+    start_time : float
+        Unix timestamp returned by start_resource_profiling.
+    start_mem : float
+        Starting RSS in MB returned by start_resource_profiling.
+    jobs : list[tuple[str, str, str]]
+        (patient, well_fov, twoD_method) jobs of the batch.
+    input_dirs : list[pathlib.Path]
+        Directory of the 2D images of each job.
+    """
+    current_mem, peak_mem = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    end_time = time.time()
+    time_elapsed = end_time - start_time
+    end_mem_rss = psutil.Process(os.getpid()).memory_info().rss / 1024**2
+    print(
+        f"Segmented the nuclei of {len(jobs)} images in {time_elapsed:.2f} seconds, "
+        f"peak memory (tracemalloc): {peak_mem / 1024**2:.2f} MB"
+    )
+    for (patient, well_fov, *_), input_dir in zip(jobs, input_dirs):
+        run_stats = pd.DataFrame(
+            {
+                "start_time": [start_time],
+                "end_time": [end_time],
+                "start_mem_rss_mb": [start_mem],
+                "end_mem_rss_mb": [end_mem_rss],
+                "peak_mem_tracemalloc_mb": [peak_mem / 1024**2],
+                "current_mem_tracemalloc_mb": [current_mem / 1024**2],
+                "time_taken_seconds": [time_elapsed / len(jobs)],
+                "gpu": ["GPU"],
+                "well_fov": [well_fov],
+                "patient_id": [patient],
+                "feature_type": ["Segmentation"],
+                "channel": ["NoChannel"],
+                "compartment": ["nuclei"],
+                "images_in_batch": [len(jobs)],
+            }
+        )
+        output_file_dir = pathlib.Path(
+            f"{input_dir.parent}/run_stats/{well_fov}_nuclei_segmentation.parquet"
+        )
+        output_file_dir.parent.mkdir(parents=True, exist_ok=True)
+        run_stats.to_parquet(output_file_dir)
+
+
+def segment_nuclei_well_fovs(
+    model,
+    image_base_dir: str | pathlib.Path,
+    jobs: list[tuple[str, str, str]],
+    clip_limit: float,
+    overwrite: bool = False,
+    batch_size: int | None = None,
+    tile_overlap: float | None = None,
+) -> list[bool]:
+    """
+    Segment the nuclei of several well_fovs and 2D methods with one
+    ``model.eval`` call, saving the masks and run stats of each job whose
+    nuclei were segmented.
+
+    Parameters
+    ----------
+    model : cellpose.models.CellposeModel
+        Model from load_nuclei_model.
+    image_base_dir : str | pathlib.Path
+        Directory holding the data directory.
+    jobs : list[tuple]
+        (patient, well_fov, twoD_method) jobs, optionally followed by their
+        own overwrite flag, see get_job_overwrite.
+    clip_limit : float
+        Clip limit of the adaptive histogram equalization.
+    overwrite : bool, optional
+        Segment even if the mask exists, by default False.
+    batch_size : int | None, optional
+        Number of tiles per forward pass of the network, by default the
+        Cellpose default.
+    tile_overlap : float | None, optional
+        Fraction of overlap between tiles, by default the Cellpose default.
+
+    Returns
+    -------
+    list[bool]
+        Per job, True if the nuclei were segmented, False if the mask already
+        existed.
+    """
+    start_time, start_mem = start_resource_profiling()
+    try:
+        input_dirs = [
+            get_twoD_method_dir(image_base_dir, patient, well_fov, twoD_method)
+            for patient, well_fov, twoD_method, *_ in jobs
+        ]
+        labels_paths = [
+            input_dir / f"{well_fov}_nuclei_mask.tiff"
+            for input_dir, (_, well_fov, *_) in zip(input_dirs, jobs)
+        ]
+        segmented = [
+            get_job_overwrite(job, overwrite) or not image_exists(labels_path)
+            for job, labels_path in zip(jobs, labels_paths)
+        ]
+        to_segment = [index for index, segment in enumerate(segmented) if segment]
+        if len(to_segment) > 0:
+            nuclei_images = [
+                read_nuclei_image(input_dirs[index], clip_limit) for index in to_segment
+            ]
+            labels = segment_nuclei_images(
+                model, nuclei_images, batch_size=batch_size, tile_overlap=tile_overlap
+            )
+            for index, label in zip(to_segment, labels):
+                patient, well_fov, twoD_method = jobs[index][:3]
+                write_image(labels_paths[index], label.astype(np.uint16))
+                try_record_well_fov_artifacts(
+                    catalog_path=get_artifact_catalog_path(f"{image_base_dir}/data"),
+                    data_dir=f"{image_base_dir}/data",
+                    stage="segmentation",
+                    patient=patient,
+                    well_fov=well_fov,
+                    methods=[twoD_method],
+                )
+    except Exception:
+        # the next batch starts its own profiling
+        tracemalloc.stop()
+        raise
+
+    if len(to_segment) == 0:
+        # keep the run stats of the runs that segmented the nuclei
+        tracemalloc.stop()
+        return segmented
+    _stop_batch_resource_profiling(
+        start_time,
+        start_mem,
+        [jobs[index] for index in to_segment],
+        [input_dirs[index] for index in to_segment],
+    )
+    return segmented
+
+
+def read_segmentation_loadfile(
+    loadfile_path: str | pathlib.Path,
+) -> list[tuple[str, str, str, bool]]:
+    """
+    Read the (patient, well_fov, twoD_method, overwrite) jobs of a segmentation loadfile.
+
+    Parameters
+    ----------
+    loadfile_path : str | pathlib.Path
+        Tab separated file without a header, e.g.
+        ``loadfiles/segmentation_loadfile.txt``, whose optional fourth
+        column (from write_loadfile) is True for jobs whose masks have to
+        be rewritten.
+
+    Returns
+    -------
+    list[tuple[str, str, str, bool]]
+        One job per line, with overwrite False when the column is absent.
+    """
+    jobs = []
+    for line in pathlib.Path(loadfile_path).read_text().splitlines():
+        if line.strip() == "":
+            continue
+        parts = line.split("\t")
+        patient, well_fov, twoD_method = parts[:3]
+        overwrite = len(parts) > 3 and parts[3].strip() == "True"
+        jobs.append((patient, well_fov, twoD_method, overwrite))
+    return jobs
+
+
+def get_job_overwrite(job: tuple, overwrite: bool = False) -> bool:
+    """
+    Get whether the masks of a job are rewritten even if they exist.
+
+    Parameters
+    ----------
+    job : tuple
+        (patient, well_fov, twoD_method) job, optionally followed by its own
+        overwrite flag, e.g. from read_segmentation_loadfile.
+    overwrite : bool, optional
+        Overwrite flag of the worker, applied to every job, by default False.
+
+    Returns
+    -------
+    bool
+        True if the worker or the job asks to overwrite.
+    """
+    return overwrite or (len(job) > 3 and bool(job[3]))
+
+
+def iter_segmentation_jobs(
+    jobs: Iterable | queue.Queue,
+) -> Iterator[tuple]:
+    """
+    Iterate over a list of jobs, or pull jobs from a queue until a None job.
+
+    Parameters
+    ----------
+    jobs : Iterable | queue.Queue
+        (patient, well_fov, twoD_method) jobs, optionally followed by their
+        own overwrite flag, or a queue.Queue or multiprocessing.Queue they
+        are put on.
+
+    Yields
+    ------
+    tuple
+        The next job.
+    """
+    if hasattr(jobs, "get") and hasattr(jobs, "put"):
+        while (job := jobs.get()) is not None:
+            yield tuple(job)
+    else:
+        for job in jobs:
+            yield tuple(job)
+
+
+def _iter_job_batches(
+    jobs: Iterable | queue.Queue, images_per_batch: int
+) -> Iterator[list[tuple]]:
+    """
+    Group consecutive jobs into batches.
+
+    Parameters
+    ----------
+    jobs : Iterable | queue.Queue
+        (patient, well_fov, twoD_method) jobs, see iter_segmentation_jobs.
+    images_per_batch : int
+        Number of jobs per batch, the last batch may be smaller.
+
+    Yields
+    ------
+    list[tuple]
+        The next batch of jobs.
+    """
+    batch = []
+    for job in iter_segmentation_jobs(jobs):
+        batch.append(job)
+        if len(batch) >= images_per_batch:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def _segment_nuclei_job(
+    model,
+    image_base_dir: str | pathlib.Path,
+    job: tuple,
+    clip_limit: float,
+    overwrite: bool,
+) -> dict:
+    """
+    Segment the nuclei of one job, catching its error.
+
+    Parameters
+    ----------
+    model : cellpose.models.CellposeModel
+        Model from load_nuclei_model.
+    image_base_dir : str | pathlib.Path
+        Directory holding the data directory.
+    job : tuple
+        (patient, well_fov, twoD_method) job, optionally followed by its own
+        overwrite flag.
+    clip_limit : float
+        Clip limit of the adaptive histogram equalization.
+    overwrite : bool
+        Segment even if the mask exists.
+
+    Returns
+    -------
+    dict
+        The summary of the job.
+    """
+    patient, well_fov, twoD_method = job[:3]
+    start_time = time.time()
+    error = None
+    try:
+        segmented = segment_nuclei_well_fov(
+            model=model,
+            image_base_dir=image_base_dir,
+            patient=patient,
+            well_fov=well_fov,
+            twoD_method=twoD_method,
+            clip_limit=clip_limit,
+            overwrite=get_job_overwrite(job, overwrite),
+        )
+        status = "segmented" if segmented else "skipped"
+    except Exception:
+        error = traceback.format_exc()
+        status = "failed"
+        print(error)
+    return {
+        "patient": patient,
+        "well_fov": well_fov,
+        "twoD_method": twoD_method,
+        "status": status,
+        "duration_seconds": time.time() - start_time,
+        "error": error,
+    }
+
+
+def run_nuclei_segmentation_worker(
+    jobs: Iterable | queue.Queue,
+    image_base_dir: str | pathlib.Path,
+    clip_limit: float,
+    overwrite: bool = False,
+    model=None,
+    images_per_batch: int = 1,
+    batch_size: int | None = None,
+    tile_overlap: float | None = None,
+) -> pd.DataFrame:
+    """
+    Segment the nuclei of each job with one model, loaded once.
+
+    With ``images_per_batch`` above 1, consecutive jobs (e.g. the three 2D
+    methods of a well_fov in the loadfile) are segmented with one
+    ``model.eval`` call. A failed batch is rerun one job at a time, and a
+    failed job is reported and the worker moves on to the next one.
+
+    Parameters
+    ----------
+    jobs : Iterable | queue.Queue
+        (patient, well_fov, twoD_method) jobs, optionally followed by their
+        own overwrite flag, e.g. from read_segmentation_loadfile, or a queue
+        they are put on followed by None.
+    image_base_dir : str | pathlib.Path
+        Directory holding the data directory.
+    clip_limit : float
+        Clip limit of the adaptive histogram equalization.
+    overwrite : bool, optional
+        Segment every job even if its mask exists, by default False, which
+        only segments the jobs flagged to overwrite and the missing masks.
+    model : cellpose.models.CellposeModel, optional
+        Model to use, by default load_nuclei_model().
+    images_per_batch : int, optional
+        Number of jobs per ``model.eval`` call, by default 1 which segments
+        each job like 0.segment_nuclei.
+    batch_size : int | None, optional
+        Number of tiles per forward pass of the network for batched jobs, by
+        default the Cellpose default.
+    tile_overlap : float | None, optional
+        Fraction of overlap between tiles for batched jobs, by default the
+        Cellpose default.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per job with its ``status`` (segmented, skipped or failed),
+        ``duration_seconds`` and ``error``.
+    """
+    if model is None:
+        model = load_nuclei_model()
+    job_summaries = []
+    job_number = 0
+    for batch in _iter_job_batches(jobs, images_per_batch):
+        for patient, well_fov, twoD_method, *_ in batch:
+            job_number += 1
+            print(f"[{job_number}] {patient} - {well_fov} - {twoD_method}")
+        segmented = None
+        if len(batch) > 1:
+            start_time = time.time()
+            try:
+                segmented = segment_nuclei_well_fovs(
+                    model=model,
+                    image_base_dir=image_base_dir,
+                    jobs=batch,
+                    clip_limit=clip_limit,
+                    overwrite=overwrite,
+                    batch_size=batch_size,
+                    tile_overlap=tile_overlap,
+                )
+            except Exception:
+                print(traceback.format_exc())
+                print(
+                    f"Batch of {len(batch)} jobs failed, rerunning them one at a time"
+                )
+        if segmented is None:
+            for job in batch:
+                job_summaries.append(
+                    _segment_nuclei_job(
+                        model, image_base_dir, job, clip_limit, overwrite
+                    )
+                )
+            continue
+        duration_seconds = (time.time() - start_time) / len(batch)
+        for (patient, well_fov, twoD_method, *_), segment in zip(batch, segmented):
+            job_summaries.append(
+                {
+                    "patient": patient,
+                    "well_fov": well_fov,
+                    "twoD_method": twoD_method,
+                    "status": "segmented" if segment else "skipped",
+                    "duration_seconds": duration_seconds,
+                    "error": None,
+                }
+            )
+    return pd.DataFrame(
+        job_summaries,
+        columns=[
+            "patient",
+            "well_fov",
+            "twoD_method",
+            "status",
+            "duration_seconds",
+            "error",
+        ],
+    )
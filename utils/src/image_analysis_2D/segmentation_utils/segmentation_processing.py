@@ -1,25 +1,101 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union
 
-import cupy
-import cupyx.scipy.ndimage
 import numpy as np
 import scipy.ndimage
 import skimage
+from image_analysis_2D.segmentation_utils.array_backend import get_array_modules
+
+FILL_HOLES_THREADS_ENV_VAR = "IMAGE_ANALYSIS_2D_FILL_HOLES_THREADS"
+
+
+def get_fill_holes_threads(num_threads: Union[int, None] = None) -> int:
+    """
+    Get the number of threads the per-object hole filling may use.
+
+    Parameters
+    ----------
+    num_threads : int, optional
+        Number of threads, by default None which reads the
+        IMAGE_ANALYSIS_2D_FILL_HOLES_THREADS environment variable (default 1).
+
+    Returns
+    -------
+    int
+        The number of threads, at least 1.
+    """
+    if num_threads is None:
+        num_threads = int(os.environ.get(FILL_HOLES_THREADS_ENV_VAR, 1))
+    return max(1, num_threads)
+
+
+def get_padded_object_slices(
+    mask: np.ndarray,
+) -> list[tuple[int, tuple[slice, ...]]]:
+    """
+    Get the bounding box of every object, grown by one pixel on each side.
+
+    The padding is clipped to the image, so the border of a padded box is
+    either background or the border of the image. A hole of an object is
+    then a hole in its padded box exactly when it is a hole in the image.
+
+    Parameters
+    ----------
+    mask : np.ndarray
+        Instance segmented mask image with positive integer labels and background 0
+
+    Returns
+    -------
+    list[tuple[int, tuple[slice, ...]]]
+        (label, padded bounding box) of each object in increasing label order
+    """
+    object_slices = []
+    for label, slices in enumerate(scipy.ndimage.find_objects(mask), start=1):
+        if slices is None:
+            continue
+        object_slices.append(
+            (
+                label,
+                tuple(
+                    slice(max(s.start - 1, 0), min(s.stop + 1, size))
+                    for s, size in zip(slices, mask.shape)
+                ),
+            )
+        )
+    return object_slices
+
+
+def _fill_object_holes(mask, label: int, slices: tuple[slice, ...], ndimage):
+    """Fill the holes of one object inside its padded bounding box."""
+    object_mask = ndimage.binary_fill_holes(mask[slices] == label)
+    if object_mask.ndim == 3:
+        for z in range(object_mask.shape[0]):
+            object_mask[z] = ndimage.binary_fill_holes(object_mask[z])
+    return object_mask
 
 
 def fill_holes_in_mask(
     mask: np.ndarray,
     compartment: Union[str, None] = None,
+    backend: Union[str, None] = None,
+    num_threads: Union[int, None] = None,
 ) -> np.ndarray:
     """
     This function fills holes in instance segmented mask images
 
+    For cells, the holes of each object are filled inside its padded bounding box (see get_padded_object_slices) instead of in the whole image, and the objects are written in increasing label order as before, so an object filling a hole that holds another object gives the same mask.
+
     Parameters
     ----------
     mask : np.ndarray
         3D instance segmented mask image where each object has a unique integer label and background is 0
     compartment : str, optional
         Compartment type of the mask (e.g. "cell" or "organoid"), by default None. This is used to determine the hole filling strategy.
+    backend : str, optional
+        Array backend, "cupy" or "numpy", by default None which uses the GPU when cupy can use one (see get_array_backend). Both backends give the same mask.
+    num_threads : int, optional
+        Number of threads filling the holes of the cell objects with the NumPy backend, by default None (see get_fill_holes_threads).
 
     Errors
     ------
@@ -36,36 +112,48 @@ def fill_holes_in_mask(
 
     mask_ndim = mask.ndim
 
-    mask_cp = cupy.asarray(mask)
-    new_mask_cp = cupy.zeros_like(mask_cp)
+    array_modules = get_array_modules(backend)
+    xp = array_modules.xp
+    ndimage = array_modules.ndimage
+
+    mask_xp = array_modules.asarray(mask)
+    new_mask_xp = xp.zeros_like(mask_xp)
 
     if compartment.lower() == "cell":
-        for label in cupy.unique(mask_cp):
-            label = int(label)
-            if label == 0:
-                continue
-            tmp_mask = mask_cp == label
-            tmp_mask = cupyx.scipy.ndimage.binary_fill_holes(
-                tmp_mask,
+        object_slices = get_padded_object_slices(np.asarray(mask))
+        if array_modules.name == "numpy":
+            num_threads = get_fill_holes_threads(num_threads)
+        else:
+            # the GPU works through the objects one kernel at a time
+            num_threads = 1
+        if num_threads > 1:
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                filled_objects = list(
+                    executor.map(
+                        lambda obj: _fill_object_holes(mask_xp, *obj, ndimage),
+                        object_slices,
+                    )
+                )
+        else:
+            filled_objects = (
+                _fill_object_holes(mask_xp, *obj, ndimage) for obj in object_slices
             )
-            if tmp_mask.ndim == 3:
-                for z in range(tmp_mask.shape[0]):
-                    tmp_mask[z] = cupyx.scipy.ndimage.binary_fill_holes(tmp_mask[z])
-            elif tmp_mask.ndim == 2:
-                tmp_mask = cupyx.scipy.ndimage.binary_fill_holes(tmp_mask)
-            new_mask_cp[tmp_mask] = label
-        mask = cupy.asnumpy(new_mask_cp).astype(mask.dtype)
+        # write the objects in label order, so a higher label keeps the
+        # pixels of a lower label that fills a hole around it
+        for (label, slices), object_mask in zip(object_slices, filled_objects):
+            new_mask_xp[slices][object_mask] = label
+        mask = array_modules.asnumpy(new_mask_xp).astype(mask.dtype)
 
     elif compartment.lower() == "organoid":
-        new_mask_cp = cupyx.scipy.ndimage.binary_fill_holes(
-            mask_cp,
+        new_mask_xp = ndimage.binary_fill_holes(
+            mask_xp,
         )
-        if new_mask_cp.ndim == 3:
-            for z in range(new_mask_cp.shape[0]):
-                new_mask_cp[z] = cupyx.scipy.ndimage.binary_fill_holes(new_mask_cp[z])
-        elif new_mask_cp.ndim == 2:
-            new_mask_cp = cupyx.scipy.ndimage.binary_fill_holes(new_mask_cp)
-        mask = cupy.asnumpy(new_mask_cp).astype(mask.dtype)
+        if new_mask_xp.ndim == 3:
+            for z in range(new_mask_xp.shape[0]):
+                new_mask_xp[z] = ndimage.binary_fill_holes(new_mask_xp[z])
+        elif new_mask_xp.ndim == 2:
+            new_mask_xp = ndimage.binary_fill_holes(new_mask_xp)
+        mask = array_modules.asnumpy(new_mask_xp).astype(mask.dtype)
         mask = scipy.ndimage.label(mask)[0].astype(mask.dtype)
 
     return mask